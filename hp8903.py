@@ -1,33 +1,38 @@
 #!/usr/bin/python
 
-from gi.repository import Gtk, GObject
-
-from matplotlib.figure import Figure
-from matplotlib.backends.backend_gtk3cairo import FigureCanvasGTK3Cairo as FigureCanvas
-from matplotlib.backends.backend_gtk3 import NavigationToolbar2GTK3 as NavigationToolbar
-
-from datetime import datetime
+# GTK and matplotlib are only imported by the GUI (hp8903_gui), so
+# headless sweeps start quickly:
+#   python hp8903.py             GUI
+#   python hp8903.py sweep ...   headless sweep, see --help
 
 import serial
-import serial.tools.list_ports as list_ports
 
+import os
+import sys
+import json
+import gzip
+import zlib
+import select
+import struct
+import argparse
+import subprocess
 import math
 import numpy as np
 import time
+import types
+import threading
+import bisect
+from collections import namedtuple, OrderedDict
 from datetime import datetime
 
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+# Monotonic clock for deadlines where available
+_clock = getattr(time, 'monotonic', time.time)
 
-UI_INFO = """
-<ui>
-  <menubar name='MenuBar'>
-    <menu action='FileMenu'>
-      <menuitem action='FileSave' />
-    <separator />
-      <menuitem action='FileQuit' />
-    </menu>
-  </menubar>
-</ui>
-"""
 
 HP8903_errors = {10: "Reading too large for display.",
                  11: "Calculated value out of range.",
@@ -49,6 +54,35 @@ HP8903_errors = {10: "Reading too large for display.",
                  96: "No signal sensed at input."}
                  
 
+# Most points the HP 8903 takes in one of its own sweeps (error 32)
+HP8903_MAX_SWEEP_POINTS = 255
+
+# Readings lost in a row before a sweep gives up on the instrument
+HP8903_MAX_LOST = 3
+
+# Source limits, frequency (Hz) and level (V RMS)
+HP8903_FREQ_LIMITS = (20.0, 100000.0)
+HP8903_AMP_LIMITS = (0.0006, 6.0)
+
+# ISO 266 preferred numbers (R10) for 1/3 octave band frequencies
+ISO_R10 = [1.0, 1.25, 1.6, 2.0, 2.5, 3.15, 4.0, 5.0, 6.3, 8.0]
+
+# Adaptive sweeps: coarse pass density (points per decade), curve error
+# and step between neighbours (dB) worth adding a point for, and the
+# finest spacing (points per decade)
+ADAPTIVE_COARSE_PER_DECADE = 3
+ADAPTIVE_TOLERANCE_DB = 0.5
+ADAPTIVE_STEP_DB = 3.0
+ADAPTIVE_MAX_PER_DECADE = 100
+
+# HP-IB codes for the HP 8903's own log frequency sweep
+HP8903_sweep_codes = {"start": "FA%.4EHZ",
+                      "stop": "FB%.4EHZ",
+                      # Points per decade
+                      "step": "ST%.1fEN",
+                      "on": "W1",
+                      "off": "W0"}
+
 HP8903_filters = ["30 kHz Low Pass",
                   "80 kHz Low Pass",
                   "Left Plug-in Filter",
@@ -63,6 +97,18 @@ class GPIBDevice():
         self.ser = None
         # GPIB address of HP 8903
         self.gpib_addr = gpib_addr
+        # Received data not yet returned by read()
+        self.buffer = ''
+        # Bumped whenever the instrument state may have been reset
+        # (open, interface clear), see HP8903.invalidate()
+        self.generation = 0
+        # LatencyRecorder timing controller phases, if any
+        self.latency = None
+        # SessionRecorder seeing the raw controller traffic, if any
+        self.tap = None
+        # No real instrument behind it (emulator, replay), what is
+        # learned about it isn't kept
+        self.simulated = False
 
     def open(self, dev_name):
         """Open device"""
@@ -82,8 +128,11 @@ class GPIBDevice():
         """Close device"""
         pass
 
-    def write(self, data):
-        """Write to GPIB endpoint"""
+    def write(self, data, expect_reply = False):
+        """Write to GPIB endpoint
+
+        expect_reply tells controllers that can fetch the response
+        along with the write that a read() will follow."""
         pass
 
     # Blocking with timeout
@@ -96,8 +145,96 @@ class GPIBDevice():
 
     def flush_input(self):
         """Flush device input buffer"""
+        self.buffer = ''
+
+    def _frame(self, data, expect_reply = False):
+        """Bytes to send to the controller for a write()
+
+        Shared with the asyncio transports (hp8903_async), which do
+        their own I/O."""
+        return(data)
+
+    def _read_request(self):
+        """Bytes to send to the controller before a read(), if any"""
+        return('')
+
+    def _read_wait(self, remaining):
+        """How long (s) the reply to one read request may take
+
+        remaining is what is left of the read's timeout, if it is longer
+        the read is requested again."""
+        return(remaining)
+
+    def set_read_timeout(self, timeout):
+        """Tell the controller how long (ms) the next reads may take"""
         pass
 
+    def _write(self, data):
+        """Write raw data to the serial device"""
+        if (self.tap is not None):
+            self.tap.wire("out", data)
+        return(self.ser.write(data.encode('ascii')))
+
+    def _wait_readable(self, timeout):
+        """Block until input is available or timeout (s) expires"""
+        try:
+            fd = self.ser.fileno()
+        except (AttributeError, ValueError, serial.SerialException):
+            fd = None
+
+        if (fd is None):
+            # No selectable handle (e.g. Windows), poll gently
+            if (self.ser.inWaiting() > 0):
+                return(True)
+            time.sleep(min(timeout, 0.005))
+            return(self.ser.inWaiting() > 0)
+
+        r, w, x = select.select([fd], [], [], timeout)
+        return(len(r) > 0)
+
+    def _read_chunk(self):
+        """Read everything the serial device has available"""
+        n = self.ser.inWaiting()
+        if (n <= 0):
+            return('')
+
+        data = self.ser.read(n)
+        if (not isinstance(data, str)):
+            data = data.decode('ascii', 'replace')
+        if (self.tap is not None):
+            self.tap.wire("in", data)
+
+        return(data)
+
+    def _buffered_read(self, msg_len, timeout, end_char):
+        """Read from serial device into self.buffer until a message is complete
+
+        Data beyond the message is kept in self.buffer for the next call.
+        Returns (status, message) like read()."""
+        deadline = _clock() + timeout/1000.0
+        while (True):
+            if (msg_len <= 0):
+                i = self.buffer.find(end_char)
+                if (i >= 0):
+                    msg = self.buffer[0:i + 1]
+                    self.buffer = self.buffer[i + 1:]
+                    return((True, msg))
+            elif (len(self.buffer) >= msg_len):
+                msg = self.buffer[0:msg_len]
+                self.buffer = self.buffer[msg_len:]
+                return((True, msg))
+
+            remaining = deadline - _clock()
+            if (remaining <= 0.0):
+                return((False, None))
+
+            if (self._wait_readable(remaining)):
+                data = self._read_chunk()
+                if (not data):
+                    # Readable but nothing to read, the port hung up
+                    return((False, None))
+                self.buffer += data
+
     def _command(self, cmd):
         """Write a command to the GPIB communication device"""
         pass
@@ -129,6 +266,10 @@ class NI_GPIB_232CV_A(GPIBDevice):
         self.baud = 38400
         self.buffer = ''
         self.gpib_addr = gpib_addr
+        self.generation = 0
+        self.latency = None
+        self.tap = None
+        self.simulated = False
 
     def open(self, dev_name):
         self._set_dev_name(dev_name)
@@ -144,6 +285,7 @@ class NI_GPIB_232CV_A(GPIBDevice):
 
         if (self.is_open()):
             self.ser.flushInput()
+            self.generation += 1
         else:
             return(False)
 
@@ -164,9 +306,9 @@ class NI_GPIB_232CV_A(GPIBDevice):
 
         return(True)
 
-    def write(self, data):
+    def write(self, data, expect_reply = False):
         if (self.is_open()):
-            ret = self.ser.write(data)
+            ret = self._write(data)
         else:
             # Error!
             print("%s failed write" % self.name())
@@ -178,59 +320,10 @@ class NI_GPIB_232CV_A(GPIBDevice):
         if (not self.is_open()):
             return((False, None))
 
-        self.buffer = ''
-
-        start = datetime.now()
-        if (msg_len <= 0):
-            while(True):
-                # read... until newline
-                w = self.ser.inWaiting()
-                if (w > 0):
-                    for i in range(w):
-                        c = self.ser.read(1)
-                        if (c == end_char):
-                            # done!
-                            self.buffer += c
-                            temp_buf = self.buffer
-                            self.buffer = ''
-                            return((True, temp_buf))
-                        else:
-                            self.buffer += c
-
-                delta = datetime.now() - start
-                if ((delta.total_seconds()*1000.0) >= timeout):
-                    return((False, None))
-
-                # Keep GUI active
-                while Gtk.events_pending():
-                    Gtk.main_iteration_do(False)
-
-        else:
-            r = 0
-            while(True):
-                w = self.ser.inWaiting()
-                if (w > 0):
-                    if (w >= msg_len):
-                        self.buffer = self.ser.read(msg_len)
-                        return((True, self.buffer))
-                    else:
-                        self.buffer += self.ser.read(w)
-                        r += w
-                        if (r >= msg_len):
-                            # Received complete message
-                            temp_buf = self.buffer[0:msg_len]
-                            self.buffer = ''
-                            return((True, temp_buf))
-
-                delta = datetime.now() - start
-                if ((delta.total_seconds()*1000.0) >= timeout):
-                    return((False, None))
-
-                # Keep GUI active
-                while Gtk.events_pending():
-                    Gtk.main_iteration_do(False)
+        return(self._buffered_read(msg_len, timeout, end_char))
 
     def flush_input(self):
+        self.buffer = ''
         if (self.is_open()):
             self.ser.flushInput()
 
@@ -254,12 +347,42 @@ class NI_GPIB_232CV_A(GPIBDevice):
         return("National Instruments GPIB-232CV-A")
 
 
+# How Galvant_GPIB_USB fetches responses:
+#   "read": separate ++read before every read
+#   "coalesce": ++read goes out in the same USB write as the command
+#   "auto": adapter reads after every write (++auto 1), writes without
+#           a response temporarily turn auto read off
+Galvant_read_modes = ["read", "coalesce", "auto"]
+
+# Longest read timeout the Galvant adapter accepts, and how long (s)
+# after it the adapter is taken to have given up on a read
+GALVANT_MAX_READ_TMO_MS = 3000
+GALVANT_READ_MARGIN = 0.2
+
+
 class Galvant_GPIB_USB(GPIBDevice):
-    def __init__(self, gpib_addr = 0):
+    def __init__(self, gpib_addr = 0, read_mode = "coalesce"):
+        if (read_mode not in Galvant_read_modes):
+            raise ValueError("Unknown Galvant read mode: %s" % read_mode)
+
         self.gpib_addr = int(gpib_addr)
         self.dev_name = None
         self.ser = None
         self.baud = 460800
+        self.buffer = ''
+        self.generation = 0
+        self.latency = None
+        self.tap = None
+        self.simulated = False
+        self.read_mode = read_mode
+        # Response to the last write was already requested from the adapter
+        self.read_pending = False
+        # Adapter version string, confirms the adapter is configured
+        self.version = None
+        # Adapter read timeout (ms) and adapter commands to send with
+        # the next write
+        self.read_tmo = 2500
+        self.pending_setup = ""
 
     def open(self, dev_name):
         self._set_dev_name(dev_name)
@@ -275,25 +398,36 @@ class Galvant_GPIB_USB(GPIBDevice):
         if (self.is_open()):
             self.ser.flushInput()
 
-            # Note \n's are added by write()
-
-            self._command("++auto 0")
-            time.sleep(0.02)
-            # The 8903 can be quite slow...
-            self._command("++read_tmo_ms 2500")
-            time.sleep(0.02)
-            # Set \r\n to be appended to output, read will look for this in data.
-            self._command("++eos 0")
-            time.sleep(0.02)
-            self._command("++ifc")
-            time.sleep(0.02)
-            # Set HP 8903 address address
+            self.buffer = ''
+            self.read_pending = False
+            self.version = None
+            self.read_tmo = 2500
+            self.pending_setup = ""
+
+            # Configure the adapter in one write. The reply to the final
+            # ++ver confirms everything before it was processed, no need
+            # for fixed delays between commands.
             addr_command = "++addr " + str(self.gpib_addr)
-            self._command(addr_command)
-            time.sleep(0.1)
-            # remote addressed mode
-            self._command("++llo")
+            setup = ["++auto %d" % int(self.read_mode == "auto"),
+                     # The 8903 can be quite slow...
+                     "++read_tmo_ms %d" % self.read_tmo,
+                     # Set \r\n to be appended to output, read will look for this in data.
+                     "++eos 0",
+                     "++ifc",
+                     # Set HP 8903 address address
+                     addr_command,
+                     # remote addressed mode
+                     "++llo",
+                     "++ver"]
+            self.generation += 1
+            self._write("\n".join(setup) + "\n")
             print(addr_command)
+
+            status, msg = self._buffered_read(0, 1000, '\r')
+            if (status and (msg.strip()[0:7] == "Version")):
+                self.version = msg.strip()
+            else:
+                print("%s did not confirm setup" % self.name())
         else:
             return(False)
 
@@ -310,21 +444,24 @@ class Galvant_GPIB_USB(GPIBDevice):
 
     def close(self):
         if (self.is_open()):
-            # clearage
-            self._command("++ifc")
-            # Return instrument to local control
-            self._command("++loc")
+            try:
+                # clearage
+                self._command("++ifc")
+                # Return instrument to local control
+                self._command("++loc")
+            except (OSError, serial.SerialException):
+                # Adapter already gone (unplugged), just let go of it
+                pass
 
             self.ser.close()
 
         return(True)
 
-    def write(self, data):
-        # Galvant device requires a \n after any write to controller
-        data += "\n"
+    def write(self, data, expect_reply = False):
+        data = self._frame(data, expect_reply)
 
         if (self.is_open()):
-            ret = self.ser.write(data)
+            ret = self._write(data)
         else:
             # Error!
             print("%s failed write" % self.name())
@@ -332,83 +469,103 @@ class Galvant_GPIB_USB(GPIBDevice):
 
         return(ret)
 
+    def _frame(self, data, expect_reply = False):
+        # Galvant device requires a \n after any write to controller
+        data += "\n"
+
+        if (not data.startswith("++")):
+            if (self.read_mode == "coalesce"):
+                if (expect_reply):
+                    # Saves a USB transaction in read()
+                    data += "++read\n"
+                    self.read_pending = True
+            elif (self.read_mode == "auto"):
+                if (expect_reply):
+                    self.read_pending = True
+                else:
+                    # Nothing to read, don't let the adapter wait for it
+                    data = "++auto 0\n" + data + "++auto 1\n"
+
+        if (self.pending_setup):
+            data = self.pending_setup + data
+            self.pending_setup = ""
+
+        return(data)
+
     def read(self, msg_len = 0, timeout = 500, end_char = '\r'):
         if (not self.is_open()):
             return((False, None))
 
-        self.buffer = ''
+        deadline = _clock() + timeout/1000.0
+        while (True):
+            request = self._read_request()
+            if (request):
+                if (self.latency is None):
+                    self._write(request)
+                else:
+                    start = _clock()
+                    self._write(request)
+                    self.latency.add("request", _clock() - start)
+
+            remaining = deadline - _clock()
+            wait = self._read_wait(remaining)
+            status, msg = self._buffered_read(msg_len, wait*1000.0, end_char)
+            if (status or (wait >= remaining)):
+                return((status, msg))
+
+    def _read_request(self):
+        if (self.read_pending):
+            # Adapter already reading (coalesced ++read or auto read)
+            self.read_pending = False
+            return('')
 
         # Command adapter to read until EOS is reached
-        self._command("++read\n")
-
-        start = datetime.now()
-        if (msg_len <= 0):
-            while(True):
-                # read... until newline
-                w = self.ser.inWaiting()
-                if (w > 0):
-                    for i in range(w):
-                        c = self.ser.read(1)
-                        if (c == end_char):
-                            # done!
-                            self.buffer += c
-                            temp_buf = self.buffer
-                            self.buffer = ''
-                            return((True, temp_buf))
-                        else:
-                            self.buffer += c
-
-                delta = datetime.now() - start
-                if ((delta.total_seconds()*1000.0) >= timeout):
-                    return((False, None))
-
-                # Keep GUI active
-                while Gtk.events_pending():
-                    Gtk.main_iteration_do(False)
-
-        else:
-            r = 0
-            while(True):
-                w = self.ser.inWaiting()
-                if (w > 0):
-                    if (w >= msg_len):
-                        self.buffer = self.ser.read(msg_len)
-                        return((True, self.buffer))
-                    else:
-                        self.buffer += self.ser.read(w)
-                        r += w
-                        if (r >= msg_len):
-                            # Received complete message
-                            temp_buf = self.buffer[0:msg_len]
-                            self.buffer = ''
-                            return((True, temp_buf))
-
-                delta = datetime.now() - start
-                if ((delta.total_seconds()*1000.0) >= timeout):
-                    return((False, None))
-
-                # Keep GUI active
-                while Gtk.events_pending():
-                    Gtk.main_iteration_do(False)
+        return(self._frame("++read\n"))
+
+    def _read_wait(self, remaining):
+        # The adapter gives up after read_tmo, waits longer than it
+        # allows take several ++read requests
+        return(min(remaining, self.read_tmo/1000.0 + GALVANT_READ_MARGIN))
+
+    def set_read_timeout(self, timeout):
+        # Goes out with the next write, saves a USB transaction
+        timeout = min(int(math.ceil(timeout)), GALVANT_MAX_READ_TMO_MS)
+        if (timeout != self.read_tmo):
+            self.read_tmo = timeout
+            self.pending_setup += "++read_tmo_ms %d\n" % timeout
+
+    def set_address(self, gpib_addr):
+        """Talk to another instrument on the bus
+
+        Like the read timeout, ++addr goes out with the next write and
+        only when the address changes."""
+        gpib_addr = int(gpib_addr)
+        if (gpib_addr != self.gpib_addr):
+            self.gpib_addr = gpib_addr
+            self.pending_setup += "++addr %d\n" % gpib_addr
 
     def _command(self, cmd):
+        if (cmd.startswith("++ifc")):
+            # Interface clear, instrument state no longer known
+            self.generation += 1
         ret = self.write(cmd)
         return(ret)
 
     def test(self):
-        r = self._command("++ver")
-        if (r != 6):
-            return(False)
+        if (self.version is None):
+            # Setup was not confirmed in open(), ask again
+            r = self._command("++ver")
+            if (r != 6):
+                return(False)
 
-        # if first 7 chars are "Version" pass!
-        status, msg = self.read(timeout = 1000, end_char = '\r')
-        print("%s Version: %s" % (self.name(), msg))
-        if (status):
-            if (len(msg) >= 7):
-                if (msg[0:7] == "Version"):
-                    return(True)
+            status, msg = self._buffered_read(0, 1000, '\r')
+            if (status and (msg.strip()[0:7] == "Version")):
+                self.version = msg.strip()
 
-        return(False)
+        print("%s Version: %s" % (self.name(), self.version))
+
+        # if first 7 chars are "Version" pass!
+        return(self.version is not None)
 
     def status(self):
         # Not implemented here for now...
@@ -421,708 +578,913 @@ class Galvant_GPIB_USB(GPIBDevice):
         return(True)
 
 
-# Add thisto HP8903BWindow
-HP8903_GPIB_devices = [(Galvant_GPIB_USB, "Galvant GPIB USB Adapter"),
-                       (NI_GPIB_232CV_A, "National Instruments GPIB-232CV-A")]
+class HP8903_Emulator(Galvant_GPIB_USB):
+    def __init__(self, gpib_addr = 0, settle = None, read_mode = "coalesce",
+                 addrs = None, baud = None):
+        """Galvant adapter talking to a local HP 8903 emulator on a pty
+
+        settle is passed to the emulator as its settling table
+        ("freq:ms,freq:ms,..."), None uses the emulator default. addrs
+        lists GPIB addresses to emulate separate instruments at, by
+        default one instrument answers on any address. baud makes the
+        emulator pace traffic like a serial line of that speed."""
+        Galvant_GPIB_USB.__init__(self, gpib_addr = gpib_addr,
+                                  read_mode = read_mode)
+        self.settle = settle
+        self.addrs = addrs
+        # self.baud is the adapter's serial speed, unused on a pty
+        self.line_baud = baud
+        self.proc = None
+        self.simulated = True
+
+    def open(self, dev_name = None):
+        # dev_name is ignored, the emulator creates its own pty
+        emulator = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "hp8903_emulator.py")
+        cmd = [sys.executable, emulator, "--controller", "galvant"]
+        if (self.settle):
+            cmd += ["--settle", self.settle]
+        for addr in (self.addrs or []):
+            cmd += ["--addr", str(addr)]
+        if (self.line_baud):
+            cmd += ["--baud", str(self.line_baud)]
+
+        try:
+            self.proc = subprocess.Popen(cmd, stdout = subprocess.PIPE)
+        except OSError as e:
+            print("Failed to start HP 8903 emulator: %s" % str(e))
+            return(False)
 
+        # First line of output is the pty name
+        pty_name = self.proc.stdout.readline().decode('ascii').strip()
+        if (not pty_name):
+            self._stop_emulator()
+            return(False)
 
-class HP8903BWindow(Gtk.Window):
-    def __init__(self):
-        Gtk.Window.__init__(self, title="HP 8903B Control")
+        if (not Galvant_GPIB_USB.open(self, pty_name)):
+            self._stop_emulator()
+            return(False)
 
-        # Serial connection!
-        self.ser = None
-        self.gpib_dev = None
-        self.devices = list_ports.comports()
-        
-        # Menu Bar junk!
-        action_group = Gtk.ActionGroup("my_actions")
-        action_filemenu = Gtk.Action("FileMenu", "File", None, None)
-        action_group.add_action(action_filemenu)
-        self.action_filesave = Gtk.Action("FileSave", "Save Data", None, None)
-        
-        action_filequit = Gtk.Action("FileQuit", None, None, Gtk.STOCK_QUIT)
-        action_filequit.connect("activate", self.on_menu_file_quit)
-        action_group.add_action(self.action_filesave)
-        action_group.add_action(action_filequit)
-        self.action_filesave.set_sensitive(False)
-        self.action_filesave.connect('activate', self.save_data)
-
-        
-        uimanager = self.create_ui_manager()
-        uimanager.insert_action_group(action_group)
-
-        menubar = uimanager.get_widget("/MenuBar")
-
-        self.status_bar = Gtk.Statusbar()
-        self.status_bar.push(0, "HP 8903 Audio Analyzer Control")
-        
-        self.master_vbox = Gtk.Box(False, spacing = 2, orientation = 'vertical')
-        self.master_vbox.pack_start(menubar, False, False, 0)
-        master_hsep = Gtk.HSeparator()
-        self.master_vbox.pack_start(master_hsep, False, False, 0)
-        self.add(self.master_vbox)
-
-        self.hbox = Gtk.Box(spacing = 2)
-        self.master_vbox.pack_start(self.hbox, True, True, 0)
-
-        self.master_vbox.pack_start(self.status_bar, False, False, 0)
-
-        # Begin controls
-        bframe = Gtk.Frame(label = "Control")
-        left_vbox = Gtk.Box(spacing = 2, orientation = 'vertical')
-        self.box = Gtk.Box(spacing = 2)
-
-        bframe.add(left_vbox)
-
-        # GPIB device selector
-        gpib_frame = Gtk.Frame(label = "GPIB Communication Device")
-        self.gpib_big_box = Gtk.Box(spacing = 2)
-        gpib_frame.add(self.gpib_big_box)
-        self.gpib_box = Gtk.Box(spacing = 2)
-        self.gpib_vbox = Gtk.Box(spacing = 2, orientation = 'vertical')
-        gpib_label = Gtk.Label("GPIB Device: ")
-        self.gpib_box.pack_start(gpib_label, False, False, 0)
-
-        gpib_store = Gtk.ListStore(int, str)
-        for n, g_dev in enumerate(HP8903_GPIB_devices):
-            gpib_store.append([n, g_dev[1]])
-        self.gpib_combo = Gtk.ComboBox.new_with_model_and_entry(gpib_store)
-        self.gpib_combo.set_entry_text_column(1)
-        self.gpib_combo.set_active(0)
-
-        self.gpib_box.pack_start(self.gpib_combo, False, False, 0)
-
-        gpib_addr_box = Gtk.Box(spacing = 2)
-
-        self.gpib_addr = Gtk.SpinButton()
-        self.gpib_addr.set_range(0, 30)
-        self.gpib_addr.set_digits(0)
-        self.gpib_addr.set_value(0)
-        self.gpib_addr.set_increments(1.0, 1.0)
-
-
-        gpib_addr_label = Gtk.Label("GPIB Address: ")
-        gpib_addr_box.pack_start(gpib_addr_label, False, False, 0)
-        gpib_addr_box.pack_start(self.gpib_addr, False, False, 0)
-
-        self.gpib_vbox.pack_start(self.gpib_box, False, False, 0)
-        self.gpib_vbox.pack_start(gpib_addr_box, False, False, 0)
-
-        self.gpib_big_box.pack_start(self.gpib_vbox, False, False, 0)
-
-        left_vbox.pack_start(gpib_frame, False, False, 0)
-
-        # Device items
-        left_vbox.pack_start(self.box, False, False, 0)
-
-        self.hbox.pack_start(bframe, False, False, 0)
-
-        con_hbox = Gtk.Box(spacing = 2)
-        self.con_button = Gtk.Button(label = "Connect")
-        self.dcon_button = Gtk.Button(label = "Disconnect")
-
-        self.con_button.connect("clicked", self.setup_gpib)
-        self.dcon_button.connect("clicked", self.close_gpib)
-        
-        con_hbox.pack_start(self.con_button, False, False, 0)
-        con_hbox.pack_start(self.dcon_button, False, False, 0)
-
-        left_vbox.pack_start(con_hbox, False, False, 0)
-        
-        device_store = Gtk.ListStore(int, str)
-
-        for i, dev in enumerate(self.devices):
-            device_store.append([i, dev[0]])
-        self.device_combo = Gtk.ComboBox.new_with_model_and_entry(device_store)
-        self.device_combo.set_entry_text_column(1)
-        self.device_combo.set_active(0)
-
-        device_label = Gtk.Label("Device: ")
-        
-        self.box.pack_start(device_label, False, False, 0)
-        self.box.pack_start(self.device_combo, False, False, 0)
-
-        hsep0 = Gtk.HSeparator()
-        left_vbox.pack_start(hsep0, False, False, 2)
-
-        # Measurement Selection
-        mframe = Gtk.Frame(label = "Measurement Selection")
-        meas_box = Gtk.Box(spacing = 2)
-        meas_vbox = Gtk.Box(spacing = 2)
-
-        mframe.add(meas_box)
-        meas_box.pack_start(meas_vbox, False, False, 0)
-
-        meas_store = Gtk.ListStore(int, str)
-        meas_dict = {0: "THD+n",
-                     1:"Frequency Response",
-                     2: "THD+n (Ratio)",
-                     3: "Frequency Response (Ratio)",
-                     4: "Ouput Level"}
-        for k, v in meas_dict.iteritems():
-            meas_store.append([k, v])
-        self.meas_combo = Gtk.ComboBox.new_with_model_and_entry(meas_store)
-        self.meas_combo.set_entry_text_column(1)
-        self.meas_combo.set_active(0)
-
-        self.meas_combo.connect("changed", self.meas_changed)
-        
-        meas_vbox.pack_start(self.meas_combo, False, False, 0)
-        left_vbox.pack_start(mframe, False, False, 0)
-
-
-        units_frame = Gtk.Frame(label = "Units")
-        units_box = Gtk.Box(spacing = 2)
-        units_vbox = Gtk.Box(spacing = 2)
-
-        units_frame.add(units_box)
-        units_box.pack_start(units_vbox, False, False, 0)
-
-        self.thd_units_store = Gtk.ListStore(int, str)
-        self.ampl_units_store = Gtk.ListStore(int, str)
-        self.thdr_units_store = Gtk.ListStore(int, str)
-        self.amplr_units_store = Gtk.ListStore(int, str)
-        self.optlvl_units_store = Gtk.ListStore(int, str)
-        thd_units_dict = {0: "%", 1: "dB"}
-        ampl_units_dict = {0: "V", 1: "dBm"}
-        thdr_units_dict = {0: "%", 1: "dB"}
-        amplr_units_dict = {0: "%", 1:"dB"}
-        optlvl_units_dict = {0: "V"}
-
-        for k, v in thd_units_dict.iteritems():
-            self.thd_units_store.append([k, v])
-        for k, v in ampl_units_dict.iteritems():
-            self.ampl_units_store.append([k, v])
-        for k, v in thdr_units_dict.iteritems():
-            self.thdr_units_store.append([k, v])
-        for k, v in amplr_units_dict.iteritems():
-            self.amplr_units_store.append([k, v])
-        for k, v in optlvl_units_dict.iteritems():
-            self.optlvl_units_store.append([k, v])
-
-            
-        self.units_combo = Gtk.ComboBox.new_with_model_and_entry(self.thd_units_store)
-        self.units_combo.set_entry_text_column(1)
-        self.units_combo.set_active(0)
-
-        self.units_combo.connect("changed", self.units_changed)
-        
-        units_vbox.pack_start(self.units_combo, False, False, 0)
-        left_vbox.pack_start(units_frame, False, False, 0)
-        
-        # units_combo.set_model(ampl_units_store)
-        # units_combo.set_active(0)
-        #left_vbox.pack_start(units_combo, False, False, 0)
-        
-        
-        
-        hsep1 = Gtk.HSeparator()
-        left_vbox.pack_start(hsep1, False, False, 2)
-
-        # Frequency Sweep Control
-        #side_filler = Gtk.Box(spacing = 2, orientation = 'vertical')
-        swconf = Gtk.Frame(label = "Frequency Sweep Control")
-        swhbox = Gtk.Box(spacing = 2)
-        swbox = Gtk.Box(spacing = 2, orientation = 'vertical')
-        swconf.add(swhbox)
-        swhbox.pack_start(swbox, False, False, 0)
-        
-        left_vbox.pack_start(swconf, False, False, 0)
-        
-        startf = Gtk.Frame(label = "Start Frequency (Hz)")
-        
-        self.start_freq = Gtk.SpinButton()
-        self.start_freq.set_range(20.0, 100000.0)
-        self.start_freq.set_digits(5)
-        self.start_freq.set_value(20.0)
-        self.start_freq.set_increments(100.0, 1000.0)
-
-        startf.add(self.start_freq)
-        #left_vbox.pack_start(startf, False, False, 0)
-        swbox.pack_start(startf, False, False, 0)
-        self.start_freq.connect("value_changed", self.freq_callback)
-        
-        stopf = Gtk.Frame(label = "Stop Frequency (Hz)")
-        
-        self.stop_freq = Gtk.SpinButton()
-        self.stop_freq.set_range(20.0, 100000.0)
-        self.stop_freq.set_digits(5)
-        self.stop_freq.set_value(30000.0)
-        self.stop_freq.set_increments(100.0, 1000.0)
-
-        stopf.add(self.stop_freq)
-        #left_vbox.pack_start(stopf, False, False, 0)
-        swbox.pack_start(stopf, False, False, 0)
-        self.stop_freq.connect("value_changed", self.freq_callback)
-
-        stepsf = Gtk.Frame(label = "Steps per Decade")
-        
-        self.steps = Gtk.SpinButton()
-        self.steps.set_range(1.0, 1000.0)
-        self.steps.set_digits(1)
-        self.steps.set_value(10.0)
-        self.steps.set_increments(1.0, 10.0)
-
-        stepsf.add(self.steps)
-        swbox.pack_start(stepsf, False, False, 0)
-        #left_vbox.pack_start(stepsf, False, False, 0)
-
-        hsep2 = Gtk.HSeparator()
-        left_vbox.pack_start(hsep2, False, False, 2)
-
-        # Freq Control
-
-        freqf = Gtk.Frame(label = "Frequency")
-        freqbox = Gtk.Box(spacing = 2)
-        freqhbox = Gtk.Box(spacing = 2, orientation = 'vertical')
-
-        freqf.add(freqhbox)
-        freqhbox.pack_start(freqbox, False, False, 0)
-
-        self.freq = Gtk.SpinButton()
-        self.freq.set_range(20.0, 100000.0)
-        self.freq.set_digits(5)
-        self.freq.set_value(1000.0)
-        self.freq.set_increments(100.0, 1000.0)
-
-        self.freq.set_sensitive(False)
-        
-        freqbox.pack_start(self.freq, False, False, 0)
-        left_vbox.pack_start(freqf, False, False, 0)
-
-        freqhsep = Gtk.HSeparator()
-        left_vbox.pack_start(freqhsep, False, False, 2)
-        
-        # Source Control
-        sourcef = Gtk.Frame(label = "Source Control (V RMS)")
-        source_box = Gtk.Box(spacing = 2)
-        sourcef.add(source_box)
-        
-        self.source = Gtk.SpinButton()
-        self.source.set_range(0.0006, 6.0)
-        self.source.set_digits(4)
-        self.source.set_value(0.5)
-        self.source.set_increments(0.5, 1.0)
-        source_box.pack_start(self.source, False, False, 0)
-        left_vbox.pack_start(sourcef, False, False, 0)
-
-        hsep3 = Gtk.HSeparator()
-        left_vbox.pack_start(hsep3, False, False, 2)
-
-
-        vswconf = Gtk.Frame(label = "Voltage Sweep Control")
-        vswhbox = Gtk.Box(spacing = 2)
-        vswbox = Gtk.Box(spacing = 2, orientation = 'vertical')
-        vswconf.add(vswhbox)
-        vswhbox.pack_start(vswbox, False, False, 0)
-        
-        left_vbox.pack_start(vswconf, False, False, 0)
-        
-        startv = Gtk.Frame(label = "Start Voltage (V)")
-        
-        self.start_v = Gtk.SpinButton()
-        self.start_v.set_range(0.0006, 6.0)
-        self.start_v.set_digits(5)
-        self.start_v.set_value(0.1)
-        self.start_v.set_increments(0.1, 1)
-
-        startv.add(self.start_v)
-        #left_vbox.pack_start(startf, False, False, 0)
-        vswbox.pack_start(startv, False, False, 0)
-        self.start_v.connect("value_changed", self.volt_callback)
-        
-        stopv = Gtk.Frame(label = "Stop Voltage (V)")
-        
-        self.stop_v = Gtk.SpinButton()
-        self.stop_v.set_range(0.0006, 6.0)
-        self.stop_v.set_digits(5)
-        self.stop_v.set_value(1.0)
-        self.stop_v.set_increments(0.1, 1.0)
-
-        stopv.add(self.stop_v)
-        #left_vbox.pack_start(stopf, False, False, 0)
-        vswbox.pack_start(stopv, False, False, 0)
-        self.stop_v.connect("value_changed", self.volt_callback)
-
-        stepsv = Gtk.Frame(label = "Total Samples")
-        
-        self.stepsv = Gtk.SpinButton()
-        self.stepsv.set_range(1.0, 1000.0)
-        self.stepsv.set_digits(1)
-        self.stepsv.set_value(10.0)
-        self.stepsv.set_increments(1.0, 10.0)
-
-        stepsv.add(self.stepsv)
-        vswbox.pack_start(stepsv, False, False, 0)
-        #left_vbox.pack_start(stepsf, False, False, 0)
-
-        hsepsv = Gtk.HSeparator()
-        left_vbox.pack_start(hsepsv, False, False, 2)
-
-
-
-        
-        filterf = Gtk.Frame(label = "Filters")
-        filterb = Gtk.Box(spacing = 2)
-        filtervb = Gtk.Box(spacing = 2, orientation = 'vertical')
-        filterf.add(filterb)
-        filterb.pack_start(filtervb, False, False, 0)
-
-        self.f30k = Gtk.CheckButton("30 kHz LP")
-        self.f80k = Gtk.CheckButton("80 kHz LP")
-
-        self.lpi = Gtk.CheckButton("Left Plug-in filter")
-        self.rpi = Gtk.CheckButton("Right Plug-in filter")
-
-        self.f30k.connect("toggled", self.filter1_callback)
-        self.f80k.connect("toggled", self.filter1_callback)
-
-        self.lpi.connect("toggled", self.filter2_callback)
-        self.rpi.connect("toggled", self.filter2_callback)
-        
-        filtervb.pack_start(self.f30k, False, False, 0)
-        filtervb.pack_start(self.f80k, False, False, 0)
-        filtervb.pack_start(self.lpi, False, False, 0)
-        filtervb.pack_start(self.rpi, False, False, 0)
-
-        left_vbox.pack_start(filterf, False, False, 0)
-        
-        hsep = Gtk.HSeparator()
-        left_vbox.pack_start(hsep, False, False, 2)
-        
-        self.run_button = Gtk.Button(label = "Start Sequence")
-        self.run_button.set_sensitive(False)
-        left_vbox.pack_start(self.run_button, False, False, 0)
-        self.run_button.connect("clicked", self.run_test)
-        
-        
-        self.f = Figure(figsize=(5,4), dpi=100)
-        self.a = self.f.add_subplot(111)
-        #self.plt = self.a.plot(20,-90, marker = 'x')
-        self.plt = self.a.plot(marker = 'x')
-        self.a.grid(True)
-        self.a.set_xscale('log')
-        self.a.set_xlim((10.0, 30000.0))
-        self.a.set_ylim((0.0005, 0.01))
-        self.a.set_xlabel("Frequency (Hz)")
-        self.a.set_ylabel("THD+n (%)")
-        
-        self.canvas = FigureCanvas(self.f)
-
-        toolbar = NavigationToolbar(self.canvas, self)
-
-        plot_vbox = Gtk.Box(spacing = 2, orientation = 'vertical')
-        plot_vbox.pack_start(self.canvas, True, True, 0)
-        plot_vbox.pack_start(toolbar, False, False, 0)
-        
-        #self.hbox.pack_start(self.canvas, True, True, 0)
-        self.hbox.pack_start(plot_vbox, True, True, 0)
-
-        # Groups of widgets
-        self.measurement_widgets = [self.meas_combo, self.units_combo]
-        self.freq_sweep_widgets = [self.start_freq, self.stop_freq, self.steps]
-        self.source_widgets = [self.source]
-        self.filter_widgets = [self.f30k, self.f80k, self.lpi, self.rpi]
-        self.vsweep_widgets = [self.start_v, self.stop_v, self.stepsv]
-        
-        for w in self.measurement_widgets:
-            w.set_sensitive(False)
-        for w in self.freq_sweep_widgets:
-            w.set_sensitive(False)
-        for w in self.source_widgets:
-            w.set_sensitive(False)
-        for w in self.filter_widgets:
-            w.set_sensitive(False)
-        for w in self.vsweep_widgets:
-            w.set_sensitive(False)
-
-        
-        self.meas_string = "THD+n (%)"
-        self.units_string = "%"
-        self.measurements = None
-
-    def setup_gpib(self, button):
-        # Get GPIB info
-        gpib_model = self.gpib_combo.get_model()
-        gpib_tree_iter = self.gpib_combo.get_active_iter()
-
-        # Get address
-        gpib_addr = self.gpib_addr.get_value_as_int()
-
-        # Instantiate GPIB Device class
-        self.gpib_dev = HP8903_GPIB_devices[gpib_model[gpib_tree_iter][0]][0](gpib_addr = gpib_addr)
-        print("Using GPIB Device: %s" % self.gpib_dev.name())
-        print("Using GPIB Address: %s" % str(gpib_addr))
-
-        if (not self.gpib_dev.implements_addr()):
-            print("Warning: this GPIB communication device does not implement")
-            print("    address setting, check your hardware's settings!")
-
-        # Get device info
-        model = self.device_combo.get_model()
-
-        tree_iter = self.device_combo.get_active_iter()
-
-        print("Device: %s" % model[tree_iter][1])
-        dev_name = model[tree_iter][1]
-
-        # Disable gpib and devices buttons
-        self.con_button.set_sensitive(False)
-        self.device_combo.set_sensitive(False)
-        self.gpib_combo.set_sensitive(False)
-        self.gpib_addr.set_sensitive(False)
-
-
-        if(not self.gpib_dev.open(dev_name)):
-            # Make into warning window?
-            print("Failed to open GPIB Device: %s at %s" % (self.gpib_dev.name(), dev_name))
-            print("Verify hardware setup and try to connect again")
-
-            self.con_button.set_sensitive(True)
-            self.device_combo.set_sensitive(True)
-            self.gpib_combo.set_sensitive(True)
-            self.gpib_addr.set_sensitive(True)
+        return(True)
 
-            return(False)
+    def close(self):
+        Galvant_GPIB_USB.close(self)
+        self._stop_emulator()
+
+        return(True)
+
+    def _stop_emulator(self):
+        if (self.proc):
+            self.proc.terminate()
+            self.proc.wait()
+            self.proc = None
+
+    def name(self):
+        return("HP 8903 Emulator (pty)")
+
+
+class GalvantBus():
+    def __init__(self, adapter):
+        """Several GPIB instruments sharing one open Galvant adapter
+
+        device(addr) gives a controller for one address that can be
+        handed to HP8903 like any other. The adapter is only
+        re-addressed when a different instrument is used than last
+        time. Not thread safe, drive all instruments from one thread
+        (see BusSweep)."""
+        if (adapter.read_mode == "auto"):
+            # Auto read makes the last listener talk, holding the bus
+            # while it settles
+            raise ValueError("Galvant bus sharing needs read mode read or coalesce")
+
+        self.adapter = adapter
+        self.devices = {}
+
+    def device(self, gpib_addr):
+        """Controller for the instrument at gpib_addr"""
+        gpib_addr = int(gpib_addr)
+        if (gpib_addr not in self.devices):
+            self.devices[gpib_addr] = GalvantBusDevice(self, gpib_addr)
+
+        return(self.devices[gpib_addr])
+
+    def close(self):
+        self.adapter.close()
+
+
+class GalvantBusDevice(GPIBDevice):
+    def __init__(self, bus, gpib_addr):
+        """One address on a GalvantBus"""
+        self.bus = bus
+        self.gpib_addr = gpib_addr
+        self.dev_name = bus.adapter.dev_name
+        # Read timeout (ms) this instrument asked for, the adapter's
+        # is shared
+        self.read_tmo = None
+        self.latency = None
+
+    @property
+    def generation(self):
+        # Interface clear on the adapter resets every instrument
+        return(self.bus.adapter.generation)
+
+    @property
+    def simulated(self):
+        return(self.bus.adapter.simulated)
+
+    def _select(self):
+        """The adapter, set up for this instrument"""
+        adapter = self.bus.adapter
+        adapter.set_address(self.gpib_addr)
+        if (self.read_tmo is not None):
+            adapter.set_read_timeout(self.read_tmo)
+
+        return(adapter)
+
+    def open(self, dev_name = None):
+        # Adapter is opened once for the bus
+        return(self.is_open())
+
+    def is_open(self):
+        return(self.bus.adapter.is_open())
+
+    def close(self):
+        # Closing the adapter is up to the bus
+        return(True)
+
+    def write(self, data, expect_reply = False):
+        return(self._select().write(data, expect_reply = expect_reply))
+
+    def read(self, msg_len = 0, timeout = 500, end_char = '\r'):
+        return(self._select().read(msg_len = msg_len, timeout = timeout,
+                                   end_char = end_char))
+
+    def flush_input(self):
+        self.bus.adapter.flush_input()
+
+    def set_read_timeout(self, timeout):
+        self.read_tmo = timeout
+
+    def test(self):
+        return(self.bus.adapter.test())
+
+    def name(self):
+        return("%s (address %d)" % (self.bus.adapter.name(), self.gpib_addr))
+
+    def implements_addr(self):
+        return(True)
+
+
+# Session file format written by SessionRecorder
+SESSION_VERSION = 1
+# Seconds between session file flushes, at most this much is lost in a crash
+SESSION_FLUSH_INTERVAL = 1.0
+
+
+class SessionRecorder():
+    def __init__(self, fname):
+        """Gzipped JSON lines log of everything said to a controller
+
+        Every record has op and t, seconds since recording started. ops
+        are session (the header), open, write (data, expect_reply),
+        read (status, data, timeout ms, elapsed s), timeout (ms), flush,
+        close, and wire: raw bytes sent (out) or received (in),
+        controller ++ directives included."""
+        self.fname = fname
+        self.fid = gzip.open(fname, 'wb')
+        self.start = _clock()
+        self.flushed = self.start
+
+    def event(self, op, **fields):
+        fields["op"] = op
+        now = _clock()
+        fields["t"] = round(now - self.start, 6)
+        self.fid.write((json.dumps(fields) + "\n").encode('ascii'))
+        if ((now - self.flushed) > SESSION_FLUSH_INTERVAL):
+            self.flushed = now
+            self.fid.flush()
+
+    def wire(self, direction, data):
+        self.event("wire", **{direction: data})
+
+    def close(self):
+        if (self.fid is not None):
+            self.fid.close()
+            self.fid = None
+
+
+def read_session(fname):
+    """Records of a session file, see SessionRecorder
+
+    A session cut short (crash, unplugged adapter) is read as far as it
+    got."""
+    events = []
+    fid = gzip.open(fname, 'rb')
+    try:
+        for line in fid:
+            events.append(json.loads(line.decode('ascii')))
+    except (EOFError, ValueError, zlib.error):
+        if (not events):
+            raise ValueError("Not an hp8903 session: %s" % fname)
+    finally:
+        fid.close()
+
+    if ((not events) or (events[0].get("op") != "session")):
+        raise ValueError("Not an hp8903 session: %s" % fname)
 
-        # Do test?
-        if (not self.gpib_dev.test()):
-            print("GPIB device failed self test: %s at %s" % (self.gpib_dev.name(), dev_name))
-            print("Verify hardware setup and try to connect again")
+    return(events)
 
-            self.con_button.set_sensitive(True)
-            self.device_combo.set_sensitive(True)
-            self.gpib_combo.set_sensitive(True)
-            self.gpib_addr.set_sensitive(True)
 
+class RecordingDevice(GPIBDevice):
+    def __init__(self, dev, fname):
+        """Any GPIBDevice, with all its traffic recorded to a session file
+
+        Wrap dev before opening it so the controller setup is recorded
+        too. ReplayDevice plays the file back."""
+        self.inner = dev
+        self.session = SessionRecorder(fname)
+        self.session.event("session", version = SESSION_VERSION,
+                           controller = dev.name(), addr = dev.gpib_addr,
+                           created = time.time())
+        dev.tap = self.session
+
+    @property
+    def gpib_addr(self):
+        return(self.inner.gpib_addr)
+
+    @property
+    def dev_name(self):
+        return(self.inner.dev_name)
+
+    @property
+    def generation(self):
+        return(self.inner.generation)
+
+    @property
+    def simulated(self):
+        return(self.inner.simulated)
+
+    @property
+    def latency(self):
+        return(self.inner.latency)
+
+    @latency.setter
+    def latency(self, latency):
+        self.inner.latency = latency
+
+    def open(self, dev_name):
+        ok = self.inner.open(dev_name)
+        self.session.event("open", port = self.inner.dev_name, ok = ok)
+        return(ok)
+
+    def is_open(self):
+        return(self.inner.is_open())
+
+    def close(self):
+        ret = self.inner.close()
+        self.session.event("close")
+        self.session.close()
+        return(ret)
+
+    def write(self, data, expect_reply = False):
+        self.session.event("write", data = data, expect_reply = expect_reply)
+        return(self.inner.write(data, expect_reply = expect_reply))
+
+    def read(self, msg_len = 0, timeout = 500, end_char = None):
+        # Framing is the wrapped device's unless the caller sets it
+        kwargs = {}
+        if (end_char is not None):
+            kwargs["end_char"] = end_char
+        start = _clock()
+        status, msg = self.inner.read(msg_len = msg_len, timeout = timeout,
+                                      **kwargs)
+        self.session.event("read", status = status, data = msg,
+                           timeout = timeout, elapsed = _clock() - start)
+        return((status, msg))
+
+    def flush_input(self):
+        self.inner.flush_input()
+        self.session.event("flush")
+
+    def set_read_timeout(self, timeout):
+        self.inner.set_read_timeout(timeout)
+        self.session.event("timeout", ms = timeout)
+
+    def test(self):
+        return(self.inner.test())
+
+    def name(self):
+        return(self.inner.name())
+
+    def implements_addr(self):
+        return(self.inner.implements_addr())
+
+
+class ReplayDevice(GPIBDevice):
+    def __init__(self, gpib_addr = 0, speed = None):
+        """GPIB device answering with the replies of a recorded session
+
+        open() takes the session file (see RecordingDevice). Reads get
+        the recorded replies in order, right away or, with speed, after
+        the recorded read time divided by speed (1.0 keeps the original
+        timing). Writes that differ from the recording are counted in
+        mismatches. Once the recording runs out reads fail like a silent
+        instrument."""
+        GPIBDevice.__init__(self, gpib_addr)
+        self.speed = speed
+        self.header = None
+        self.events = []
+        self.cursor = 0
+        self.mismatches = 0
+        self.simulated = True
+
+    def open(self, dev_name):
+        self._set_dev_name(dev_name)
+        try:
+            events = read_session(self.dev_name)
+        except (IOError, OSError, ValueError) as e:
+            print("Failed to read session: %s" % str(e))
             return(False)
 
+        self.header = events[0]
+        self.events = [e for e in events if (e["op"] in ("write", "read"))]
+        self.cursor = 0
+        self.mismatches = 0
+        self.generation += 1
+
+        return(True)
+
+    def is_open(self):
+        return(self.header is not None)
 
-        if (self.gpib_dev.is_open()):
-            self.gpib_dev.flush_input()
-            # Initialize the HP 8903
-            status = self.init_hp8903()
-            if (not status):
-                print("Failed to initialize HP 8903")
-                print("Verify hardware setup and try to connect again")
+    def close(self):
+        self.header = None
+        return(True)
 
-                self.gpib_dev.close()
+    def write(self, data, expect_reply = False):
+        if (not self.is_open()):
+            print("%s failed write" % self.name())
+            return(0)
 
-                self.con_button.set_sensitive(True)
-                self.device_combo.set_sensitive(True)
-                self.gpib_combo.set_sensitive(True)
-                self.gpib_addr.set_sensitive(True)
+        if ((self.cursor < len(self.events)) and
+            (self.events[self.cursor]["op"] == "write")):
+            if (self.events[self.cursor]["data"] != data):
+                self.mismatches += 1
+            self.cursor += 1
+        else:
+            self.mismatches += 1
+
+        return(len(data))
+
+    def read(self, msg_len = 0, timeout = 500, end_char = '\r'):
+        if (not self.is_open()):
+            return((False, None))
+
+        # Recorded writes not replayed are skipped
+        while ((self.cursor < len(self.events)) and
+               (self.events[self.cursor]["op"] != "read")):
+            self.mismatches += 1
+            self.cursor += 1
+        if (self.cursor >= len(self.events)):
+            return((False, None))
 
+        e = self.events[self.cursor]
+        self.cursor += 1
+        if (self.speed):
+            time.sleep(e["elapsed"]/self.speed)
+
+        return((e["status"], e["data"]))
+
+    def name(self):
+        controller = "session"
+        if (self.header is not None):
+            controller = self.header.get("controller", controller)
+        return("Replay of %s" % controller)
+
+
+class TimedReplayDevice(ReplayDevice):
+    def __init__(self, gpib_addr = 0):
+        """ReplayDevice keeping the recorded read times"""
+        ReplayDevice.__init__(self, gpib_addr, speed = 1.0)
+
+
+# Add thisto HP8903BWindow and HP8903_controllers
+HP8903_GPIB_devices = [(Galvant_GPIB_USB, "Galvant GPIB USB Adapter"),
+                       (NI_GPIB_232CV_A, "National Instruments GPIB-232CV-A"),
+                       (HP8903_Emulator, "HP 8903 Emulator (pty)")]
+
+
+# Read timeouts (ms) used by TimingModel
+TIMING_DEFAULT_MS = 2500
+TIMING_MIN_MS = 200
+TIMING_MAX_MS = 10000
+# Settle times kept per frequency band, and needed before trusting them
+TIMING_SAMPLES = 50
+TIMING_MIN_SAMPLES = 3
+# Readings collected within this (s) of being ready still give a
+# trustworthy settle time
+TIMING_SLACK = 0.01
+
+TIMING_PATH = os.path.join(os.path.expanduser("~"), ".hp8903", "timing.json")
+
+
+class TimingModel():
+    def __init__(self, key, path = TIMING_PATH, bins = None,
+                 transitions = None):
+        """Observed HP 8903 settle times for one instrument/controller
+
+        Times (s) from trigger to reading are kept per measurement code
+        and octave band above 20 Hz, and used for read deadlines,
+        retries and ETA. transitions are the TransitionCost weights
+        learned for the instrument, if any. key identifies the
+        instrument/controller in the file at path, None keeps it
+        in memory only."""
+        self.key = key
+        self.path = path
+        if (bins is None):
+            bins = {}
+        self.bins = bins
+        self.transitions = transitions
+
+    @classmethod
+    def load(cls, key, path = TIMING_PATH):
+        """Timing model for key from path, empty if there is none yet"""
+        if (path is None):
+            return(cls(key, path = None))
+
+        try:
+            with open(path) as fid:
+                models = json.load(fid)
+        except (IOError, OSError, ValueError):
+            models = {}
+
+        bins = dict(models.get(key, {}))
+        transitions = bins.pop("transitions", None)
+        return(cls(key, path = path, bins = bins, transitions = transitions))
+
+    def save(self):
+        """Store the model, keeping those of other instruments"""
+        if (self.path is None):
+            return(True)
+
+        try:
+            with open(self.path) as fid:
+                models = json.load(fid)
+        except (IOError, OSError, ValueError):
+            models = {}
+
+        models[self.key] = dict(self.bins)
+        if (self.transitions):
+            models[self.key]["transitions"] = self.transitions
+
+        try:
+            d = os.path.dirname(self.path)
+            if (d and (not os.path.isdir(d))):
+                os.makedirs(d)
+            tmp = self.path + ".tmp"
+            with open(tmp, 'w') as fid:
+                json.dump(models, fid)
+            os.rename(tmp, self.path)
+        except (IOError, OSError) as e:
+            print("Failed to save timing model: %s" % str(e))
+            return(False)
+
+        return(True)
+
+    def _bin(self, meas_code, freq):
+        band = int(math.floor(math.log(max(freq, 20.0)/20.0, 2)))
+        return("%s:%d" % (meas_code, band))
+
+    def record(self, meas_code, freq, elapsed):
+        """Add an observed trigger to reading time (s)"""
+        samples = self.bins.setdefault(self._bin(meas_code, freq), [])
+        samples.append(round(elapsed, 4))
+        if (len(samples) > TIMING_SAMPLES):
+            del samples[0]
+
+    def expected(self, meas_code, freq):
+        """Typical time (s) for a reading, None if not known yet"""
+        samples = self.bins.get(self._bin(meas_code, freq), [])
+        if (len(samples) < TIMING_MIN_SAMPLES):
+            return(None)
+
+        return(float(np.median(samples)))
+
+    def timeout(self, meas_code, freq):
+        """Read deadline (ms) for a reading"""
+        samples = self.bins.get(self._bin(meas_code, freq), [])
+        if (len(samples) < TIMING_MIN_SAMPLES):
+            return(TIMING_DEFAULT_MS)
+
+        # Generous margin over the slowest reading seen
+        t = 1.5*max(samples)*1000.0 + 100.0
+        t = 100.0*math.ceil(t/100.0)
+
+        return(min(max(t, TIMING_MIN_MS), TIMING_MAX_MS))
+
+    def retry_timeout(self, meas_code, freq):
+        """Deadline (ms) for one more read if the first expires, or None
+
+        Learned deadlines that were too tight get the default, bands
+        not learned yet or slower than that get the longest so their
+        settle time can be learned at all."""
+        timeout = self.timeout(meas_code, freq)
+        if (timeout < TIMING_DEFAULT_MS):
+            return(TIMING_DEFAULT_MS)
+        elif (timeout < TIMING_MAX_MS):
+            return(TIMING_MAX_MS)
+
+        return(None)
+
+    def eta(self, meas_code, freqs):
+        """Expected time (s) to measure freqs, None if unknown"""
+        known = [self.expected(meas_code, f) for f in freqs]
+        seen = [t for t in known if (t is not None)]
+        if ((len(seen) == 0) and (len(freqs) > 0)):
+            return(None)
+
+        # Bands not seen yet are guessed from those that have been
+        guess = 0.0
+        if (seen):
+            guess = max(seen)
+
+        return(sum(t if (t is not None) else guess for t in known))
+
+
+# Result of a single HP 8903 measurement, cached is True when it came
+# from a MeasurementCache instead of the instrument. Averaged
+# measurements (see Averager) are the mean of reads readings with
+# standard deviation std.
+Measurement = namedtuple('Measurement', ['freq', 'amp', 'value', 'raw',
+                                         'error', 'payload', 'timestamp',
+                                         'cached', 'reads', 'std'])
+Measurement.__new__.__defaults__ = (False, 1, None)
+
+
+# Host side averaging: target 95% confidence interval half width
+# relative to the mean, most readings per point, and points with
+# several readings a frequency decade needs before its noise estimate
+# lets quiet points stop at one reading
+AVERAGE_TARGET = 0.01
+AVERAGE_MAX_READS = 16
+AVERAGE_PRIOR_POINTS = 3
+
+# Two sided 95% Student t quantiles by degrees of freedom (1, 2, ...)
+_T95 = [12.706, 4.303, 3.182, 2.776, 2.571, 2.447, 2.365, 2.306, 2.262,
+        2.228, 2.201, 2.179, 2.160, 2.145, 2.131]
+
+
+class Averager():
+    def __init__(self, target = AVERAGE_TARGET, max_reads = AVERAGE_MAX_READS):
+        """When to stop averaging readings of a point
+
+        Readings are averaged until the 95% confidence interval of the
+        mean is within target of it (a ratio, the same ratio in dB for
+        log units) or max_reads were taken. The noise of points that
+        took several readings is remembered per frequency decade, a
+        decade known to be quiet lets a point stop at one reading."""
+        self.target = target
+        self.max_reads = max_reads
+        # (decade, log units) -> list of variances (relative for linear units)
+        self.noise = {}
+
+    def _band(self, freq, log_units):
+        return((int(math.floor(math.log10(freq))), log_units))
+
+    def done(self, freq, log_units, n, mean, m2):
+        """Is the mean of n readings good enough?
+
+        m2 is the sum of squared differences from the mean (Welford)."""
+        if (n >= self.max_reads):
+            return(True)
+
+        if (log_units):
+            limit = 20.0*math.log10(1.0 + self.target)
+        else:
+            limit = self.target*abs(mean)
+
+        if (n == 1):
+            known = self.noise.get(self._band(freq, log_units), [])
+            if (len(known) < AVERAGE_PRIOR_POINTS):
                 return(False)
+            var = sum(known)/len(known)
+            if (not log_units):
+                var *= mean**2
+            return((1.96*math.sqrt(var)) <= limit)
+
+        t = 1.96
+        if ((n - 1) <= len(_T95)):
+            t = _T95[n - 2]
+        return((t*math.sqrt(m2/(n - 1)/n)) <= limit)
+
+    def learn(self, freq, log_units, n, mean, m2):
+        """Remember the noise of a point averaged from n readings"""
+        if ((n < 2) or ((not log_units) and (mean == 0.0))):
+            return
+
+        var = m2/(n - 1)
+        if (not log_units):
+            var /= mean**2
+        self.noise.setdefault(self._band(freq, log_units), []).append(var)
+
+
+# Settling detection: readings over the last STABLE_SPAN of the time T3
+# is expected to take must agree with the latest to within this ratio,
+# STABLE_POLLS readings are spread over that time. Bands the timing
+# model knows nothing about yet are expected to take STABLE_SETTLED_MARGIN
+# times as long as points of the band took to settle, or when that isn't
+# known either STABLE_DEFAULT_TIME s, about the default read deadline.
+# With nothing known polls start STABLE_FIRST_WAIT s apart and spread
+# out by STABLE_BACKOFF each time up to the usual spacing, so quick
+# points settle within a few ms and slow ones aren't polled needlessly.
+STABLE_TOLERANCE = 0.005
+STABLE_SPAN = 0.25
+STABLE_POLLS = 16
+STABLE_SETTLED_MARGIN = 2.0
+STABLE_DEFAULT_TIME = 2.5
+STABLE_FIRST_WAIT = 0.002
+STABLE_BACKOFF = 1.2
+
+
+class StabilityDetector():
+    def __init__(self, tolerance = STABLE_TOLERANCE, span = STABLE_SPAN,
+                 polls = STABLE_POLLS):
+        """When immediately triggered readings of a point have settled
+
+        A point has settled once every reading in the last span (a
+        fraction of polls) agrees with the latest to within tolerance (a
+        ratio, the same ratio in dB for log units). Judging a span
+        rather than successive readings keeps noise from passing off a
+        slow tail as settled. Readings are spaced so polls of them would
+        take as long as T3, anything slower falls back to T3."""
+        self.tolerance = tolerance
+        self.polls = polls
+        self.window = max(2, int(round(span*polls))) + 1
+
+    def settled(self, readings, log_units):
+        """Have readings (oldest first) settled?"""
+        if (len(readings) < self.window):
+            return(False)
 
+        last = readings[-1]
+        if (log_units):
+            limit = 20.0*math.log10(1.0 + self.tolerance)
         else:
-            print("Failed to use GPIB device")
-            print("Verify hardware setup and try to connect again")
+            limit = self.tolerance*abs(last)
+
+        return(all(abs(r - last) <= limit
+                   for r in readings[-self.window:-1]))
+
+
+# Seconds a cached reading stays valid, and most readings kept
+CACHE_TTL = 300.0
+CACHE_SIZE = 10000
+
+
+class MeasurementCache():
+    def __init__(self, ttl = CACHE_TTL, size = CACHE_SIZE):
+        """Recent readings by the settings they were measured with
+
+        Readings older than ttl seconds are not used, beyond size
+        readings the least recently used are dropped. Call invalidate()
+        when the device under test changes."""
+        self.ttl = ttl
+        self.size = size
+        # key -> (time stored, Measurement), least recently used first
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, meas, unit, freq, amp, filters, ratio = 0):
+        """Key for send_measurement arguments
+
+        Frequency and level are compared as programmed over HP-IB."""
+        return((meas, unit, "%.4E" % freq, "%.4E" % amp,
+                tuple(bool(f) for f in filters), ratio))
+
+    def get(self, key):
+        """Cached Measurement for key, or None"""
+        entry = self.entries.pop(key, None)
+        if ((entry is None) or ((_clock() - entry[0]) > self.ttl)):
+            self.misses += 1
+            return(None)
+
+        # Most recently used goes last
+        self.entries[key] = entry
+        self.hits += 1
+        return(entry[1]._replace(cached = True))
+
+    def put(self, key, m):
+        """Keep a reading, failed readings are not worth keeping"""
+        if (np.isnan(m.value)):
+            return
+
+        self.entries.pop(key, None)
+        self.entries[key] = (_clock(), m)
+        while (len(self.entries) > self.size):
+            self.entries.popitem(last = False)
+
+    def invalidate(self, meas = None):
+        """Forget readings, only those of the meas measurements if given"""
+        if (meas is None):
+            self.entries.clear()
+            return
 
-            self.gpib_dev.close()
+        for key in list(self.entries):
+            if (key[0] in meas):
+                del self.entries[key]
 
-            self.con_button.set_sensitive(True)
-            self.device_combo.set_sensitive(True)
-            self.gpib_combo.set_sensitive(True)
-            self.gpib_addr.set_sensitive(True)
+    def __len__(self):
+        return(len(self.entries))
 
+
+# Latency histogram bin edges (s), log spaced from 10 us to 100 s
+LATENCY_BINS = np.logspace(-5, 2, 36)
+# Phases timed for every measured point, in the order they happen
+LATENCY_PHASES = ["encode", "write", "request", "read", "reading", "decode",
+                  "total", "consumer"]
+# Keys of a recorded point that aren't phases
+LATENCY_KEYS = ("start", "index", "readings")
+
+
+class LatencyRecorder():
+    def __init__(self):
+        """Time spent in each phase of each measured point
+
+        encode is building the HP-IB codes, write sending them, request
+        the Galvant ++read when not coalesced with the write, read
+        waiting for the reading (settling, includes request), decode
+        parsing it, total the whole point and consumer how long the
+        sweep's user (journal, GUI queue) held up the next point. A
+        point averaged or polled for settling takes several readings,
+        its phases add them up so every phase is counted once per
+        point; reading has the wait of each single reading. Other
+        phases not tied to a point, like the GUI's plot redraws, are
+        added with sample(). Times are seconds."""
+        # One dict per point: start (_clock() time), index, readings,
+        # phase -> s
+        self.points = []
+        self.current = None
+        # Phase -> list of all durations
+        self.samples = {}
+        self.lock = threading.Lock()
+
+    def start(self):
+        """A point is starting
+
+        Returns False if one already is, its readings belong to it."""
+        if (self.current is not None):
             return(False)
+        self.current = {"start": _clock(), "readings": 0}
+        return(True)
+
+    def add(self, phase, elapsed):
+        """Time spent in phase by the current point, or the last one"""
+        point = self.current
+        if (point is not None):
+            # Sampled once the point is done
+            point[phase] = point.get(phase, 0.0) + elapsed
+            return
+        if (self.points):
+            point = self.points[-1]
+            point[phase] = point.get(phase, 0.0) + elapsed
+        self.sample(phase, elapsed)
+
+    def reading(self, elapsed):
+        """The current point waited elapsed for one of its readings"""
+        if (self.current is not None):
+            self.current["readings"] += 1
+        self.add("read", elapsed)
+        self.sample("reading", elapsed)
+
+    def sample(self, phase, elapsed):
+        """Time spent in phase, not tied to a point"""
+        with self.lock:
+            self.samples.setdefault(phase, []).append(elapsed)
+
+    def finish(self, index = None):
+        """The current point is done, its total is taken from start()"""
+        point = self.current
+        if (point is None):
+            return
+        point["total"] = _clock() - point["start"]
+        point["index"] = index
+        for phase, elapsed in point.items():
+            if (phase not in LATENCY_KEYS):
+                self.sample(phase, elapsed)
+        self.points.append(point)
+        self.current = None
+
+    def summary(self):
+        """Phase -> dict of count, mean and percentiles (ms) and histogram
+
+        The histogram counts durations in LATENCY_BINS."""
+        with self.lock:
+            samples = dict((k, list(v)) for k, v in self.samples.items())
+
+        stats = {}
+        for phase, t in samples.items():
+            t = np.array(t)
+            p50, p90, p99 = np.percentile(t, [50, 90, 99])*1e3
+            counts = np.histogram(t, bins = LATENCY_BINS)[0]
+            stats[phase] = {"count": len(t),
+                            "mean": float(np.mean(t)*1e3),
+                            "p50": float(p50),
+                            "p90": float(p90),
+                            "p99": float(p99),
+                            "max": float(np.max(t)*1e3),
+                            "histogram": [int(c) for c in counts]}
+
+        return(stats)
+
+    def report(self):
+        """Summary as text lines for people"""
+        stats = self.summary()
+        phases = [p for p in LATENCY_PHASES if (p in stats)]
+        phases += sorted(p for p in stats if (p not in LATENCY_PHASES))
+
+        lines = ["Latency (ms)       n      mean       p50       p90       p99       max"]
+        for phase in phases:
+            st = stats[phase]
+            lines.append("%-10s %9d %9.3f %9.3f %9.3f %9.3f %9.3f" %
+                         (phase, st["count"], st["mean"], st["p50"],
+                          st["p90"], st["p99"], st["max"]))
+
+        return(lines)
+
+    def to_dict(self):
+        """Everything recorded, JSON serializable"""
+        return({"bins": [float(b) for b in LATENCY_BINS],
+                "summary": self.summary(),
+                "points": list(self.points)})
+
+
+class _Steps():
+    def __init__(self, steps):
+        """Drive nested protocol step generators
+
+        HP8903's measurement logic is written as generators yielding I/O
+        operations, ("write", payload, expect_reply), ("read", timeout)
+        and ("sleep", s), that are sent their result back, nested step
+        generators, sent their result once done, and finally ("return",
+        result). HP8903 does the I/O blocking and AsyncHP8903
+        (hp8903_async) awaits it, the logic is the same."""
+        self.stack = [steps]
+
+    def send(self, value):
+        """Result of the last I/O operation in, next operation out
+
+        The last one is ("return", result)."""
+        while (True):
+            op = self.stack[-1].send(value)
+            value = None
+            if (isinstance(op, types.GeneratorType)):
+                self.stack.append(op)
+            elif (op[0] == "return"):
+                self.stack.pop().close()
+                if (not self.stack):
+                    return(op)
+                value = op[1]
+            else:
+                return(op)
 
-        # Enable measurement controls
-        self.run_button.set_sensitive(True)
-        for w in self.measurement_widgets:
-            w.set_sensitive(True)
-        for w in self.freq_sweep_widgets:
-            w.set_sensitive(True)
-        for w in self.source_widgets:
-            w.set_sensitive(True)
-        for w in self.filter_widgets:
-            w.set_sensitive(True)
-        for w in self.vsweep_widgets:
-            w.set_sensitive(False)
-
-
-        self.status_bar.push(0, "Connected to  HP 8903, ready for measurements")
-
-    def close_gpib(self, button):
-        if (self.gpib_dev):
-            self.gpib_dev.close()
-
-        # Activate device/connection buttons
-        self.con_button.set_sensitive(True)
-        self.device_combo.set_sensitive(True)
-        self.gpib_combo.set_sensitive(True)
-        self.gpib_addr.set_sensitive(True)
-
-        # Disable measurement controls
-        for w in self.measurement_widgets:
-            w.set_sensitive(False)
-        for w in self.freq_sweep_widgets:
-            w.set_sensitive(False)
-        for w in self.source_widgets:
-            w.set_sensitive(False)
-        for w in self.filter_widgets:
-            w.set_sensitive(False)
-        for w in self.vsweep_widgets:
-            w.set_sensitive(False)
-
-        self.freq.set_sensitive(False)
-
-        self.run_button.set_sensitive(False)
-
-    def run_test(self, button):
-        # Disable all control widgets during sweep
-        self.run_button.set_sensitive(False)
-        self.action_filesave.set_sensitive(False)
-
-        for w in self.measurement_widgets:
-            w.set_sensitive(False)
-        for w in self.freq_sweep_widgets:
-            w.set_sensitive(False)
-        for w in self.source_widgets:
-            w.set_sensitive(False)
-        for w in self.filter_widgets:
-            w.set_sensitive(False)
-        for w in self.vsweep_widgets:
-            w.set_sensitive(False)
-
-        self.freq.set_sensitive(False)
-
-        
-        self.x = []
-        self.y = []
-        
-        # 30, 80, LPI, RPI
-        filters = [False, False, False, False]
-        filters[0] = self.f30k.get_active()
-        filters[1] = self.f80k.get_active()
-        filters[2] = self.lpi.get_active()
-        filters[3] = self.rpi.get_active()
-        #print(filters)
-
-        amp = self.source.get_value()
-        
-        strtf = self.start_freq.get_value()
-        stopf = self.stop_freq.get_value()
-        
-        num_steps = self.steps.get_value_as_int()
-        step_size = 10**(1.0/num_steps)
-
-        strt_dec = math.floor(math.log10(strtf))
-        stop_dec = math.floor(math.log10(stopf))
-
-        meas = self.meas_combo.get_active()
-        units = self.units_combo.get_active()
-
-        lsteps = []
-        vsteps = []
-        if ((meas < 4) and (meas >= 0)):
-            decs = math.log10(stopf/strtf)
-            npoints = int(decs*num_steps)
-
-            for n in range(npoints + 1):
-                lsteps.append(strtf*10.0**(float(n)/float(num_steps)))
-                
-            self.a.set_xlim((lsteps[0]*10**(-2.0/10.0), lsteps[-1]*10**(2.0/10.0)))
-            self.a.set_xscale('log')
-        elif (meas == 4):
-            start_amp = self.start_v.get_value()
-            stop_amp = self.stop_v.get_value()
-            num_vsteps = self.stepsv.get_value()
-            vsteps = np.linspace(start_amp, stop_amp, num_vsteps)
-            amp_buf = ((stop_amp - start_amp)*0.1)/2.0
-            print(amp_buf)
-            self.a.set_xlim(((start_amp - amp_buf), (stop_amp + amp_buf)))
-            self.a.set_xscale('linear')
-            # print(start_amp)
-            # print(stop_amp)
-            # print(num_vsteps)
-
-
-        center_freq = self.freq.get_value()
-            
-        # center freq...
-        self.measurements = [amp, filters, meas, units, self.meas_string, self.units_string]
-        
-        if ((meas == 0) or (meas == 1)):
-            #pass
-            pt = self.send_measurement(meas, units, center_freq, amp, filters, ratio = 2)
-        elif ((meas == 2) or (meas == 3)):
-            pt = self.send_measurement(meas, units, center_freq, amp, filters)
-            #print(pt)
-            pt = self.send_measurement(meas, units, center_freq, amp, filters, ratio = 1)
-            #print("PT: %s" % pt)
-        elif (meas == 4):
-            pt = self.send_measurement(meas, units, center_freq, start_amp, filters, ratio = 2)
-
-        if ((meas < 4) and (meas >= 0)):
-            for i in lsteps:
-                meas_point = self.send_measurement(meas, units, i, amp, filters)
-                self.x.append(float(i))
-                self.y.append(float(meas_point))
-                print(float(meas_point))
-                self.update_plot(self.x, self.y)
-                # plot new measures
-                #print(meas_point)
-        elif (meas == 4):
-            #pass
-            for v in vsteps:
-                meas_point = self.send_measurement(meas, units, center_freq, v, filters)
-                self.x.append(v)
-                self.y.append(float(meas_point))
-                print("in: %f, out %f" % (v, float(meas_point)))
-                self.update_plot(self.x, self.y)
-        
-
-        for w in self.measurement_widgets:
-            w.set_sensitive(True)
-        for w in self.filter_widgets:
-            w.set_sensitive(True)
-
-        if ((meas < 4) and (meas >= 0)):
-            for w in self.freq_sweep_widgets:
-                w.set_sensitive(True)
-            for w in self.source_widgets:
-                w.set_sensitive(True)
-        if (meas == 4):
-            for w in self.vsweep_widgets:
-                w.set_sensitive(True)
-
-        if (meas > 1):
-            self.freq.set_sensitive(True)
-
-        self.run_button.set_sensitive(True)
-        self.action_filesave.set_sensitive(True)
-
-    def update_plot(self, x, y):
-        if (len(self.plt) < 1):
-            self.plt = self.a.plot(x, y, marker = 'x')
-        self.plt[0].set_data(x, y)
-        ymin = min(y)
-        ymax = max(y)
-
-        
-        # if (ymin == 0.0):
-        #     ymin = -0.01
-        # if (ymax == 0.0):
-        #     ymax = 0.01
-
-        sep = abs(ymax - ymin)
-        sep = sep/10.0
-
-        if (sep == 0.0):
-            sep = 0.01
-
-        #self.a.set_ylim((ymin - abs(ymin*0.10), ymax + abs(ymax*0.10)))
-        self.a.set_ylim((ymin - abs(sep), ymax + abs(sep)))
-        self.canvas.draw()
-            
-    def init_hp8903(self):
+    def close(self):
+        """Stop, running what the steps have pending in finally clauses"""
+        while (self.stack):
+            self.stack.pop().close()
+
+
+class HP8903():
+    def __init__(self, gpib_dev, timing = None, cache = None,
+                 averaging = None, stability = None):
+        """HP 8903 measurement driver on an open GPIB communication device
+
+        timing is an optional TimingModel used for read deadlines, cache
+        an optional MeasurementCache send_measurement answers from,
+        averaging an optional Averager for noisy readings, stability an
+        optional StabilityDetector used instead of T3's fixed settling.
+        Does not depend on GTK, the GUI runs it from a SweepWorker."""
+        self.gpib_dev = gpib_dev
+        self.timing = timing
+        self.cache = cache
+        self.averaging = averaging
+        self.stability = stability
+        # LatencyRecorder, see record_latency()
+        self.latency = None
+        # Readings lost in a row (no reply, not instrument errors)
+        self.lost = 0
+        # Last programmed HP-IB code per group, e.g. {"FR": "FR1.0000E+03HZ"}
+        self.state = {}
+        self.state_generation = gpib_dev.generation
+
+    def init(self):
+        """Check the HP 8903 responds to a simple measurement"""
+        self.invalidate()
         self.gpib_dev.flush_input()
-        # Arbitrary but simple measurement to check device
-        self.gpib_dev.write("FR1000.0HZAP0.100E+00VLM1LNL0LNT3")
-        status, meas = self.gpib_dev.read(msg_len = 12, timeout = 5000)
+        # Arbitrary but simple measurement to check device, triggered
+        # immediately (T2) so no settling time is spent waiting
+        self.gpib_dev.write("FR1000.0HZAP0.100E+00VLM1LNL0LNT2", expect_reply = True)
+        status, meas = self.gpib_dev.read(msg_len = 12, timeout = 1500)
 
         if (status):
             print(meas)
@@ -1132,13 +1494,309 @@ class HP8903BWindow(Gtk.Window):
             return(False)
 
         return(True)
-        
+
+    def record_latency(self, latency):
+        """Time the phases of each point with a LatencyRecorder, None stops
+
+        Costs a few clock reads per point, nothing when off."""
+        self.latency = latency
+        self.gpib_dev.latency = latency
+
     def send_measurement(self, meas, unit, freq, amp, filters, ratio = 0):
-        # Store parameters for saving after any measure
-        #self.measurements = [amp, filters, meas, unit]
+        """Program the HP 8903, trigger and read a measurement
+
+        Only codes that differ from the last programmed state are sent.
+        With a cache, settings measured recently aren't measured again,
+        except reference and ratio off (ratio 1 and 2) calls, which have
+        to reach the instrument. With averaging, readings are repeated
+        until their mean is good enough. With stability, readings are
+        taken until they stop changing instead of waiting T3's fixed
+        settling time. Returns a Measurement, value is NaN on failure or
+        instrument error. Latency is recorded once for the point, however
+        many readings it took, answers from the cache aren't recorded."""
+        return(self._run(self._measurement_steps(meas, unit, freq, amp,
+                                                 filters, ratio)))
+
+    def _run(self, steps):
+        """Run protocol steps (see _Steps) with blocking I/O
+
+        Returns their result."""
+        steps = _Steps(steps)
+        value = None
+        try:
+            while (True):
+                op = steps.send(value)
+                if (op[0] == "return"):
+                    return(op[1])
+                elif (op[0] == "write"):
+                    value = self.gpib_dev.write(op[1], expect_reply = op[2])
+                elif (op[0] == "read"):
+                    value = self.gpib_dev.read(timeout = op[1])
+                elif (op[0] == "sleep"):
+                    value = time.sleep(op[1])
+        finally:
+            steps.close()
+
+    def _measurement_steps(self, meas, unit, freq, amp, filters, ratio = 0):
+        """Steps of send_measurement(), result is the Measurement"""
+        key = None
+        if (self.cache is not None):
+            if (ratio == 1):
+                # New reference, earlier ratio readings no longer apply
+                self.cache.invalidate(meas = (2, 3))
+            elif (ratio == 0):
+                key = self.cache.key(meas, unit, freq, amp, filters, ratio)
+                m = self.cache.get(key)
+                if (m is not None):
+                    yield(("return", m))
+
+        latency = self.latency
+        if (latency is not None):
+            latency.start()
+        try:
+            if ((self.stability is not None) and (ratio != 1)):
+                m = yield(self._settled(meas, unit, freq, amp, filters, ratio))
+            else:
+                m = yield(self._trigger_steps(meas, unit, freq, amp, filters,
+                                              ratio, expect_reply = True))
+            if ((self.averaging is not None) and (ratio != 1)):
+                m = yield(self._average(m, meas, unit, freq, amp, filters,
+                                        ratio))
+        finally:
+            if (latency is not None):
+                latency.finish()
+        if (key is not None):
+            self.cache.put(key, m)
+
+        yield(("return", m))
+
+    def _settled(self, meas, unit, freq, amp, filters, ratio):
+        """Steps reading once immediately triggered (T2) readings have settled
+
+        Falls back to T3 if they haven't within the time T3 is expected
+        to take, or on a failed reading. How long readings took to
+        settle is learned (as meas code + "T2") for bands T3 hasn't
+        been timed on."""
+        log_units = (unit == 1)
+        meas_code = self._codes(meas, unit, freq, amp, filters, ratio)[2][1]
+        limit = None
+        if (self.timing):
+            limit = self.timing.expected(meas_code, freq)
+            settled = self.timing.expected(meas_code + "T2", freq)
+            if ((limit is None) and (settled is not None)):
+                limit = STABLE_SETTLED_MARGIN*settled
+        if (limit is None):
+            limit = STABLE_DEFAULT_TIME
+            spacing = limit/self.stability.polls
+            wait = min(STABLE_FIRST_WAIT, spacing)
+        else:
+            spacing = limit/self.stability.polls
+            wait = spacing
+
+        start = _clock()
+        readings = []
+        while (True):
+            m = yield(self._trigger_steps(meas, unit, freq, amp, filters,
+                                          ratio, expect_reply = True,
+                                          trig = "T2"))
+            if (np.isnan(m.value)):
+                break
+
+            readings.append(m.value)
+            if (self.stability.settled(readings, log_units)):
+                self._record(meas_code + "T2", freq, _clock() - start, m)
+                yield(("return", m))
+
+            if ((_clock() - start + wait) > limit):
+                break
+            yield(("sleep", wait))
+            wait = min(wait*STABLE_BACKOFF, spacing)
+
+        # Still changing (or failed), let the instrument wait it out
+        m = yield(self._trigger_steps(meas, unit, freq, amp, filters, ratio,
+                                      expect_reply = True))
+        yield(("return", m))
+
+    def _average(self, m, meas, unit, freq, amp, filters, ratio):
+        """Steps repeating the reading m until self.averaging is satisfied
+
+        The instrument is left as programmed and has settled, only an
+        immediate trigger (T2) is sent for each further reading."""
+        if (np.isnan(m.value)):
+            yield(("return", m))
+
+        log_units = (unit == 1)
+        n = 1
+        mean = m.value
+        m2 = 0.0
+        while (not self.averaging.done(freq, log_units, n, mean, m2)):
+            r = yield(self._trigger_steps(meas, unit, freq, amp, filters,
+                                          ratio, expect_reply = True,
+                                          trig = "T2"))
+            if (np.isnan(r.value)):
+                break
+            # Welford running mean and variance
+            n += 1
+            delta = r.value - mean
+            mean += delta/n
+            m2 += delta*(r.value - mean)
+
+        self.averaging.learn(freq, log_units, n, mean, m2)
+        std = None
+        if (n > 1):
+            std = math.sqrt(m2/(n - 1))
+
+        yield(("return", m._replace(value = mean, reads = n, std = std)))
+
+    def _trigger_steps(self, meas, unit, freq, amp, filters, ratio,
+                       expect_reply, trig = "T3"):
+        """Steps of trigger() then collect(), result is the Measurement"""
+        pending = yield(self._pending(meas, unit, freq, amp, filters, ratio,
+                                      expect_reply, trig))
+        m = yield(self._collected(pending))
+        yield(("return", m))
+
+    def trigger(self, meas, unit, freq, amp, filters, ratio = 0,
+                expect_reply = False, trig = "T3"):
+        """Program the HP 8903 and trigger a measurement without reading it
+
+        The HP 8903 settles on its own, so other instruments on the bus
+        can be programmed meanwhile. trig is the trigger code, T3 waits
+        for settling. Returns a pending measurement for collect()."""
+        return(self._run(self._pending(meas, unit, freq, amp, filters, ratio,
+                                       expect_reply, trig)))
+
+    def _pending(self, meas, unit, freq, amp, filters, ratio, expect_reply,
+                 trig):
+        """Steps of trigger(), result is the pending measurement"""
+        begin = _clock()
+        latency = self.latency
+        # Timed as a point of its own unless send_measurement() is
+        timed = (latency is not None) and latency.start()
+
+        codes = self._codes(meas, unit, freq, amp, filters, ratio)
+        payload = self._delta(codes) + trig
+        meas_code = codes[2][1]
+
+        timeout = self._timeout(meas_code, freq)
+        start = _clock()
+
+        written = yield(("write", payload, expect_reply))
+        if (not written):
+            self.invalidate()
+        if (latency is not None):
+            latency.add("encode", start - begin)
+            latency.add("write", _clock() - start)
+
+        yield(("return", (meas_code, freq, amp, payload, timeout, start, trig,
+                          timed)))
+
+    def collect(self, pending, index = None):
+        """Read a measurement started by trigger(), returns a Measurement
+
+        index is recorded with the point's latency when trigger() started
+        timing it."""
+        return(self._run(self._collected(pending, index)))
+
+    def _collected(self, pending, index = None):
+        """Steps of collect(), result is the Measurement"""
+        meas_code, freq, amp, payload, timeout, start, trig, timed = pending
+
+        # Others may have used the controller since the trigger
+        self.gpib_dev.set_read_timeout(timeout)
+        read_start = _clock()
+        status, samp = yield(self._read(meas_code, freq, timeout))
+        now = _clock()
+
+        m = self._decode(freq, amp, status, samp, payload)
+        if ((trig == "T3") and
+            (((read_start - start) < TIMING_SLACK) or
+             ((now - read_start) > TIMING_SLACK))):
+            # Only learn from readings that weren't sitting there
+            # waiting to be collected
+            self._record(meas_code, freq, now - start, m)
+
+        if (self.latency is not None):
+            self.latency.reading(now - read_start)
+            self.latency.add("decode", _clock() - now)
+            if (timed):
+                self.latency.finish(index)
+
+        yield(("return", m))
+
+    def _timeout(self, meas_code, freq):
+        """Read deadline (ms) for a point, also set on the controller"""
+        timeout = TIMING_DEFAULT_MS
+        if (self.timing):
+            timeout = self.timing.timeout(meas_code, freq)
+        self.gpib_dev.set_read_timeout(timeout)
+
+        return(timeout)
+
+    def _read(self, meas_code, freq, timeout):
+        """Steps reading a reading, retrying as the timing model allows"""
+        status, samp = yield(("read", timeout))
+
+        retry = TIMING_MAX_MS
+        if (self.timing):
+            retry = self.timing.retry_timeout(meas_code, freq)
+        if ((not status) and (retry is not None)):
+            # Deadline was too tight (or the band is slow), read once
+            # more with a longer one
+            self.gpib_dev.set_read_timeout(retry)
+            status, samp = yield(("read", retry))
+
+        yield(("return", (status, samp)))
+
+    def _record(self, meas_code, freq, elapsed, m):
+        if (self.timing and (not np.isnan(m.value))):
+            self.timing.record(meas_code, freq, elapsed)
+
+    def eta(self, meas, freqs):
+        """Expected time (s) to measure freqs, None if unknown"""
+        if (not self.timing):
+            return(None)
+
+        meas_code = self._codes(meas, 0, 1000.0, 1.0, [False]*4)[2][1]
+        return(self.timing.eta(meas_code, freqs))
+
+    def transition_cost(self, weights = None):
+        """TransitionCost for ordering sweep points on this instrument
+
+        Starts from the weights learned by learn_transitions(), weights
+        overrides some or all of them."""
+        learned = {}
+        if (self.timing and self.timing.transitions):
+            learned.update(self.timing.transitions)
+        learned.update(weights or {})
+
+        return(TransitionCost(learned))
+
+    def learn_transitions(self, meas, plan, results):
+        """Learn transition costs from a point by point sweep of plan
+
+        results are the (index, x, Measurement) measured, in order. The
+        weights are kept in the timing model. Averaged or settling
+        detected readings don't take a fixed time, sweeps with them
+        aren't learned from."""
+        if ((not self.timing) or (self.averaging is not None) or
+            (self.stability is not None)):
+            return
+
+        meas_code = self._codes(meas, 0, 1000.0, 1.0, [False]*4)[2][1]
+        model = TransitionCost.fit(plan, results,
+                                   weights = self.timing.transitions,
+                                   settle = lambda f: self.timing.expected(meas_code, f))
+        if (model is not None):
+            learned = dict(self.timing.transitions or {})
+            learned.update((k, model.weights[k]) for k in model.fitted)
+            self.timing.transitions = learned
+
+    def _codes(self, meas, unit, freq, amp, filters, ratio = 0):
+        """(group, code) list of HP-IB codes for a measurement"""
         measurement = ""
         meas_unit = ""
-        
+
         if (filters[0]):
             fs1 = "L1"
         elif (filters[1]):
@@ -1162,215 +1820,1820 @@ class HP8903BWindow(Gtk.Window):
             meas_unit = "LN"
         elif (unit == 1):
             meas_unit = "LG"
-            
+
         source_freq = ("FR%.4EHZ" % freq)
         source_ampl = ("AP%.4EVL" % amp)
-        filter_s = fs1 + fs2
 
         rat = ""
         if (ratio == 1):
             rat = "R1"
         elif (ratio == 2):
             rat = "R0"
-        
-        #payload = source_freq + source_ampl + "M3LN" + filter_s + "LNT3"
-        payload = source_freq + source_ampl + measurement + filter_s + meas_unit + rat + "T3"
-        #print(payload)
-        #print("FR%.4EHZAP1VLM1LNL0LNT3" % freq)
-        #print("FR%.4EHZAP%.4EVLM3LNL0LNT3" % (freq, amp))
-        #self.ser.write(("FR%.4EHZAP%.4EVLM3LNL2LNT3" % (freq, amp)))
-
-        # Send and read measurement via GPIB controller
-        self.gpib_dev.write(payload)
-        status, samp = self.gpib_dev.read(timeout = 2500)
+
+        return([("FR", source_freq),
+                ("AP", source_ampl),
+                ("M", measurement),
+                ("L", fs1),
+                ("H", fs2),
+                ("unit", meas_unit),
+                ("R", rat)])
+
+    def invalidate(self):
+        """Forget the state the HP 8903 was last programmed to"""
+        self.state = {}
+        self.state_generation = self.gpib_dev.generation
+
+    def _delta(self, codes):
+        """HP-IB codes from the (group, code) list that change the instrument state"""
+        if (self.state_generation != self.gpib_dev.generation):
+            # Reconnected or interface cleared since last measurement
+            self.invalidate()
+
+        payload = ""
+        for group, code in codes:
+            if (code == ""):
+                continue
+            if ((group == "R") and (code == "R1")):
+                # R1 takes a new reference every time it is sent
+                payload += code
+            elif (self.state.get(group) != code):
+                payload += code
+                if (group == "M"):
+                    # Measurement change may reset units and ratio
+                    self.state.pop("unit", None)
+                    self.state.pop("R", None)
+            else:
+                continue
+            self.state[group] = code
+
+        return(payload)
+
+    def _decode(self, freq, amp, status, samp, payload):
+        """Turn a raw reading into a Measurement"""
+        error = None
         if (status):
-            sampf = float(samp)
+            try:
+                sampf = float(samp)
+            except ValueError:
+                sampf = np.nan
+                print("Bad sample: %r" % samp)
         else:
-            sampf = np.NAN
+            sampf = np.nan
             print("Failed to get sample")
 
+        if (status):
+            self.lost = 0
+        else:
+            self.lost += 1
+
         if (sampf > 4.0e9):
-            print(("Error: %s" % samp[4:6]) + " " + HP8903_errors[int(samp[4:6])])
-            samp = np.NAN
-
-        self.status_bar.push(0, "Freq: %f, Amp: %f, Return: %f,    GPIB: %s" % (freq, amp, sampf, payload))
-            
-        return(samp)
-
-    def save_data(self, button):
-        fname = datetime.now().strftime("%Y-%m-%d-%H%M%S")
-        fid = open(fname + '.txt', 'w')
-
-        # Write source voltage info
-        source_v = str(self.measurements[0])
-        fid.write("# Measurement: " + self.measurements[4] + "\n")
-        fid.write("# Source Voltage: " + source_v + " V RMS\n")
-        # write filter info
-        for n, f in enumerate(self.measurements[1]):
-            if f:
-                fid.write("# " + HP8903_filters[n] + " active\n")
-
-        fid.write("# Frequency (Hz)    " + self.measurements[5] + "\n")
-        n = np.array([np.array(self.x), np.array(self.y)])
+            error = int(samp.strip()[4:6])
+            print(("Error: %02d" % error) + " " + HP8903_errors.get(error, "Unknown error"))
+            sampf = np.nan
+
+        if (np.isnan(sampf)):
+            # Instrument may not be in the state we think it is
+            self.invalidate()
+
+        return(Measurement(freq, amp, sampf, samp, error, payload, time.time()))
+
+    def reference(self, meas, units, freq, amp, filters):
+        """Set up ratio mode before a sweep
+
+        Ratio measurements take their reference at freq/amp, others
+        turn ratio off."""
+        return(self._run(self._reference_steps(meas, units, freq, amp,
+                                               filters)))
+
+    def _reference_steps(self, meas, units, freq, amp, filters):
+        """Steps of reference(), result is the reference Measurement"""
+        if ((meas == 2) or (meas == 3)):
+            yield(self._measurement_steps(meas, units, freq, amp, filters))
+            ratio = 1
+        else:
+            ratio = 2
+        m = yield(self._measurement_steps(meas, units, freq, amp, filters,
+                                          ratio))
+        yield(("return", m))
+
+    def native_sweep(self, meas, units, filters, amp, start, per_decade,
+                     npoints, abort = None):
+        """Log frequency sweep run by the HP 8903 itself
+
+        Sweeps longer than HP8903_MAX_SWEEP_POINTS are split into several
+        instrument sweeps. Generator yielding (index, freq, Measurement)
+        like sweep(). If the instrument stops answering, the rest of the
+        chunk is measured point by point."""
+        freqs = [start*10.0**(float(n)/per_decade) for n in range(npoints)]
+        codes = HP8903_sweep_codes
+        latency = self.latency
+
+        for k in range(0, npoints, HP8903_MAX_SWEEP_POINTS):
+            if ((abort is not None) and abort.is_set()):
+                return
+            chunk = freqs[k:k + HP8903_MAX_SWEEP_POINTS]
+
+            # The chunk's command is timed with its first point
+            if (latency is not None):
+                latency.start()
+            begin = _clock()
+            setup = [c for c in self._codes(meas, units, chunk[0], amp, filters)
+                     if (c[0] != "FR")]
+            payload = self._delta(setup)
+            payload += codes["start"] % chunk[0]
+            payload += codes["stop"] % chunk[-1]
+            payload += codes["step"] % per_decade
+            payload += codes["on"]
+            # Source frequency is left wherever the sweep ends
+            self.state.pop("FR", None)
+            meas_code = setup[1][1]
+
+            timeout = self._timeout(meas_code, chunk[0])
+            start = _clock()
+            if (not self.gpib_dev.write(payload, expect_reply = True)):
+                self.invalidate()
+            if (latency is not None):
+                latency.add("encode", start - begin)
+                latency.add("write", _clock() - start)
+
+            for j, f in enumerate(chunk):
+                if (j > 0):
+                    if ((abort is not None) and abort.is_set()):
+                        self._stop_native_sweep()
+                        return
+                    if (latency is not None):
+                        latency.start()
+                    timeout = self._timeout(meas_code, f)
+                read_start = _clock()
+                status, samp = self._run(self._read(meas_code, f, timeout))
+                if (latency is not None):
+                    latency.reading(_clock() - read_start)
+                if (not status):
+                    # Lost the instrument sweep, finish chunk by hand.
+                    # The point stays open for latency, its first reading
+                    # by hand adds to it.
+                    self._stop_native_sweep()
+                    self.lost += 1
+                    rest = chunk[j:]
+                    points = SweepPlan(rest, rest, [amp]*len(rest),
+                                       index = range(k + j, k + len(chunk)))
+                    for pt in self.sweep(meas, units, filters, points, abort):
+                        yield(pt)
+                    if (latency is not None):
+                        # Aborted before measuring the point again
+                        latency.finish(k + j)
+                    break
+
+                m = self._decode(f, amp, status, samp, payload)
+                now = _clock()
+                self._record(meas_code, f, now - start, m)
+                start = now
+
+                if (latency is None):
+                    yield((k + j, f, m))
+                else:
+                    latency.add("decode", _clock() - now)
+                    latency.finish(k + j)
+                    yielded = _clock()
+                    yield((k + j, f, m))
+                    latency.add("consumer", _clock() - yielded)
+                self.check_lost()
+                # Command only went out with the first point
+                payload = ""
+
+    def adaptive_sweep(self, meas, units, filters, plan,
+                       tolerance = ADAPTIVE_TOLERANCE_DB, budget = None,
+                       step = ADAPTIVE_STEP_DB, abort = None, measured = None):
+        """Frequency sweep that adds points where the curve needs them
+
+        plan (a SweepPlan or (x, freq, amp) list) is measured first as
+        a coarse pass. Then points are added halfway (in log frequency)
+        between neighbours where the curve bends by more than tolerance
+        or steps by more than step (dB), worst first, until none do or
+        budget points were measured. Added points use the level and
+        settings of the point below them.
+        Generator like sweep(), points have no place in a plan so their
+        index is the frequency (plan order is frequency order).
+        measured are (index, x, Measurement) from before a resume, they
+        count towards the budget and are refined like the rest."""
+        # freq -> (amp, settings, value) of points measured so far
+        curve = {}
+        for i, x, m in (measured or []):
+            curve[m.freq] = (m.amp, None, m.value)
+        for n, (i, x, m) in enumerate(self.sweep(meas, units, filters, plan, abort)):
+            point = plan[n]
+            curve[point[1]] = (point[2], (point[3] if (len(point) > 3) else None),
+                               m.value)
+            yield((point[1], x, m))
+
+        while ((budget is None) or (len(curve) < budget)):
+            if ((abort is not None) and abort.is_set()):
+                return
+
+            freqs = sorted(curve)
+            values = [curve[f][2] for f in freqs]
+            new = refine_points(freqs, values, units == 1, tolerance, step)
+            if (budget is not None):
+                new = new[0:budget - len(curve)]
+            if (len(new) == 0):
+                return
+
+            points = []
+            for f in sorted(new):
+                amp, settings = curve[freqs[bisect.bisect(freqs, f) - 1]][0:2]
+                points.append(SweepPoint(f, f, amp, settings))
+
+            for i, x, m in self.sweep(meas, units, filters, points, abort):
+                curve[x] = (points[i][2], points[i][3], m.value)
+                yield((x, x, m))
+
+    def check_lost(self):
+        """Raise IOError once too many readings were lost in a row
+
+        Sweeps stop instead of recording NaNs when the controller or
+        instrument drops out, they can be resumed from their journal."""
+        if (self.lost >= HP8903_MAX_LOST):
+            lost = self.lost
+            self.lost = 0
+            raise IOError("No reading from the HP 8903 %d times in a row" % lost)
+
+    def _stop_native_sweep(self):
+        self.gpib_dev.write(HP8903_sweep_codes["off"])
+        self.gpib_dev.flush_input()
+        self.invalidate()
+
+    def sweep(self, meas, units, filters, points, abort = None):
+        """Measure each (x, freq, amp) in points, or SweepPoint of a SweepPlan
+
+        Generator yielding (index, x, Measurement), index being the
+        point's place in the plan before any reordering. Stops early when the
+        abort event is set."""
+        for i, point in enumerate(points):
+            if ((abort is not None) and abort.is_set()):
+                return
+            index = _plan_index(points, i)
+            m, timed = self._run(self._point_steps(meas, units, filters,
+                                                   point, index))
+            if (not timed):
+                yield((index, point[0], m))
+            else:
+                yielded = _clock()
+                yield((index, point[0], m))
+                self.latency.add("consumer", _clock() - yielded)
+            self.check_lost()
+
+    def _point_steps(self, meas, units, filters, point, index):
+        """Steps measuring a point of sweep(), index its place in the plan
+
+        Result is (Measurement, timed), timed if the point's latency was
+        recorded (not when answered from the cache)."""
+        args = self._point_args(meas, units, filters, point)
+        latency = self.latency
+        if (latency is not None):
+            timed = len(latency.points)
+        m = yield(self._measurement_steps(**args))
+        if ((latency is None) or (len(latency.points) == timed)):
+            yield(("return", (m, False)))
+
+        latency.points[-1]["index"] = index
+        yield(("return", (m, True)))
+
+    def _point_args(self, meas, units, filters, point):
+        """send_measurement arguments for an (x, freq, amp) or SweepPoint"""
+        args = {"meas": meas, "unit": units, "filters": filters,
+                "freq": point[1], "amp": point[2]}
+        if ((len(point) > 3) and point[3]):
+            args.update(point[3])
+
+        return(args)
+
+
+def _plan_index(points, i):
+    """Place in the original plan of the i-th point measured"""
+    if (not isinstance(points, SweepPlan)):
+        return(i)
+
+    return(int(points.index[i]))
+
+
+def run_sweep(hp, meas, units, filters, ref_freq, ref_amp, points,
+              native = None, adaptive = None, measured = None, abort = None):
+    """Take the ratio reference and run a sweep, see SweepWorker
+
+    Generator yielding (index, x, Measurement). measured are points
+    from before a resume (only adaptive sweeps need them)."""
+    hp.reference(meas, units, ref_freq, ref_amp, filters)
+    if (native):
+        start, per_decade, npoints = native
+        sweep = hp.native_sweep(meas, units, filters, ref_amp, start,
+                                per_decade, npoints, abort = abort)
+    elif (adaptive):
+        tolerance, budget = adaptive
+        sweep = hp.adaptive_sweep(meas, units, filters, points,
+                                  tolerance = tolerance, budget = budget,
+                                  abort = abort, measured = measured)
+    else:
+        sweep = hp.sweep(meas, units, filters, points, abort = abort)
+
+    for pt in sweep:
+        yield(pt)
+
+
+class SweepWorker(threading.Thread):
+    def __init__(self, hp, meas, units, filters, ref_freq, ref_amp, points,
+                 native = None, journal = None, adaptive = None,
+                 measured = None):
+        """Run a sweep on its own thread
+
+        native is (start, per_decade, npoints) to have the HP 8903 run
+        the frequency sweep itself instead of measuring points.
+        adaptive is (tolerance, budget) to refine points as the coarse
+        pass of an adaptive sweep (see HP8903.adaptive_sweep), measured
+        the points an adaptive sweep is resumed with. Points
+        are logged to journal (a SweepJournal) as they arrive, it is
+        closed when the sweep ends.
+        Results are put on self.results as ("point", (index, x,
+        Measurement)), ("error", message) and finally ("done", None)."""
+        threading.Thread.__init__(self)
+        self.daemon = True
+
+        self.hp = hp
+        self.meas = meas
+        self.units = units
+        self.filters = filters
+        self.ref_freq = ref_freq
+        self.ref_amp = ref_amp
+        self.points = points
+        self.native = native
+        self.journal = journal
+        self.adaptive = adaptive
+        self.measured = measured
+
+        self.results = queue.Queue()
+        self.abort = threading.Event()
+
+    def run(self):
+        try:
+            sweep = run_sweep(self.hp, self.meas, self.units, self.filters,
+                              self.ref_freq, self.ref_amp, self.points,
+                              native = self.native, adaptive = self.adaptive,
+                              measured = self.measured, abort = self.abort)
+            for pt in sweep:
+                if (self.journal):
+                    self.journal.append(*pt)
+                self.results.put(("point", pt))
+            failed = False
+        except Exception as e:
+            self.results.put(("error", str(e)))
+            failed = True
+
+        if (self.journal):
+            self.journal.close(aborted = failed or self.abort.is_set())
+        self.results.put(("done", None))
+
+    def stop(self):
+        """Ask the sweep to stop after the current point"""
+        self.abort.set()
+
+
+class BusSweep():
+    def __init__(self):
+        """Sweeps on several HP 8903s sharing one GPIB bus, overlapped
+
+        Each round triggers the next point on every instrument before
+        reading any of them, so one instrument is programmed while the
+        others settle and a round takes about as long as the slowest
+        point instead of all of them. Readings are collected by GPIB
+        address in self.results."""
+        self.jobs = []
+        # GPIB address -> list of (index, x, Measurement)
+        self.results = {}
+
+    def add(self, hp, meas, units, filters, ref_freq, ref_amp, points):
+        """Sweep (x, freq, amp) points on hp, referenced like SweepWorker"""
+        self.jobs.append((hp, meas, units, filters, ref_freq, ref_amp, points))
+        self.results[hp.gpib_dev.gpib_addr] = []
+
+    def run(self, abort = None):
+        """Generator yielding (gpib_addr, index, x, Measurement)
+
+        Stops early when the abort event is set."""
+        for hp, meas, units, filters, ref_freq, ref_amp, points in self.jobs:
+            hp.reference(meas, units, ref_freq, ref_amp, filters)
+
+        npoints = max([len(job[6]) for job in self.jobs] + [0])
+        for i in range(npoints):
+            if ((abort is not None) and abort.is_set()):
+                return
+
+            pending = []
+            for hp, meas, units, filters, ref_freq, ref_amp, points in self.jobs:
+                if (i < len(points)):
+                    point = points[i]
+                    args = hp._point_args(meas, units, filters, point)
+                    pending.append((hp, _plan_index(points, i), point[0],
+                                    hp.trigger(**args)))
+
+            for hp, n, x, p in pending:
+                m = hp.collect(p, n)
+                addr = hp.gpib_dev.gpib_addr
+                self.results[addr].append((n, x, m))
+                yield((addr, n, x, m))
+                hp.check_lost()
+
+
+class BusWorker(threading.Thread):
+    def __init__(self, bus_sweep, journals = None):
+        """Run a BusSweep on its own thread
+
+        journals maps GPIB address to a SweepJournal, closed when the
+        sweep ends. Results are put on self.results like SweepWorker,
+        points as ("point", (gpib_addr, (index, x, Measurement)))."""
+        threading.Thread.__init__(self)
+        self.daemon = True
+
+        self.bus_sweep = bus_sweep
+        if (journals is None):
+            journals = {}
+        self.journals = journals
+
+        self.results = queue.Queue()
+        self.abort = threading.Event()
+
+    def run(self):
+        try:
+            for addr, i, x, m in self.bus_sweep.run(abort = self.abort):
+                if (addr in self.journals):
+                    self.journals[addr].append(i, x, m)
+                self.results.put(("point", (addr, (i, x, m))))
+            failed = False
+        except Exception as e:
+            self.results.put(("error", str(e)))
+            failed = True
+
+        for journal in self.journals.values():
+            journal.close(aborted = failed or self.abort.is_set())
+        self.results.put(("done", None))
+
+    def stop(self):
+        """Ask the sweeps to stop after the current round"""
+        self.abort.set()
+
+
+# Names and units for headless sweeps, indices match the meas/unit
+# arguments of HP8903.send_measurement
+HP8903_measurements = [("thd", "THD+n", ["%", "dB"]),
+                       ("level", "AC Level", ["V RMS", "dB V"]),
+                       ("thd-ratio", "THD+n (Ratio)", ["%", "dB"]),
+                       ("level-ratio", "AC Level (Ratio)", ["%", "dB"]),
+                       ("output", "Output Level", ["V"])]
+
+# replay controllers take a session file (see RecordingDevice) as port
+HP8903_controllers = {"galvant": Galvant_GPIB_USB,
+                      "ni": NI_GPIB_232CV_A,
+                      "emulator": HP8903_Emulator,
+                      "replay": ReplayDevice,
+                      "replay-timed": TimedReplayDevice}
+
+
+def log_steps(start, stop, per_decade):
+    """Log spaced frequencies from start, per_decade points per decade up to stop"""
+    decs = math.log10(stop/start)
+    npoints = int(decs*per_decade)
+
+    n = np.arange(npoints + 1, dtype = float)
+    return(list(start*10.0**(n/per_decade)))
+
+
+# One point of a SweepPlan. settings holds send_measurement arguments
+# (meas, unit, filters) that differ from the sweep's for this point.
+SweepPoint = namedtuple('SweepPoint', ['x', 'freq', 'amp', 'settings'])
+
+
+class SweepPlan():
+    def __init__(self, x, freq, amp, settings = None, per_decade = None,
+                 index = None):
+        """Points of a sweep, x is what results are plotted against
+
+        x, freq and amp are arrays of equal length, settings an optional
+        list of per-point setting dicts (None where the sweep's apply).
+        Use the log/linear/freqs/levels/third_octave constructors.
+        Iterating gives SweepPoints, HP8903.sweep() measures them.
+        per_decade is set for log plans the HP 8903 can sweep itself.
+        index is each point's place in the plan it was reordered from
+        (see ordered()), results carry it so they can be put back."""
+        self.x = np.asarray(x, dtype = float)
+        self.freq = np.asarray(freq, dtype = float)
+        self.amp = np.asarray(amp, dtype = float)
+        if (settings is None):
+            settings = [None]*len(self.x)
+        self.settings = list(settings)
+        self.per_decade = per_decade
+        if (index is None):
+            index = np.arange(len(self.x))
+        self.index = np.asarray(index, dtype = int)
+
+    @classmethod
+    def log(cls, start, stop, per_decade, amp):
+        """per_decade log spaced frequencies from start up to stop"""
+        freq = np.array(log_steps(start, stop, per_decade))
+        return(cls(freq, freq, np.full(len(freq), float(amp)),
+                   per_decade = per_decade))
+
+    @classmethod
+    def linear(cls, start, stop, npoints, amp):
+        """npoints linearly spaced frequencies from start to stop"""
+        freq = np.linspace(start, stop, int(npoints))
+        return(cls(freq, freq, np.full(len(freq), float(amp))))
+
+    @classmethod
+    def freqs(cls, freqs, amp):
+        """Explicit list of frequencies"""
+        freq = np.asarray(freqs, dtype = float)
+        return(cls(freq, freq, np.full(len(freq), float(amp))))
+
+    @classmethod
+    def third_octave(cls, start, stop, amp):
+        """ISO 1/3 octave band centre frequencies from start to stop"""
+        # Nominal frequencies are rounded, compare those with the limits
+        n = np.arange(int(math.floor(10.0*math.log10(start))) - 1,
+                      int(math.ceil(10.0*math.log10(stop))) + 2)
+        freq = np.take(ISO_R10, n % 10)*10.0**(n//10)
+        freq = freq[(freq >= start) & (freq <= stop)]
+        return(cls(freq, freq, np.full(len(freq), float(amp))))
+
+    @classmethod
+    def levels(cls, start, stop, npoints, freq):
+        """Source level sweep, npoints from start to stop (V RMS) at freq"""
+        amp = np.linspace(start, stop, int(npoints))
+        return(cls(amp, np.full(len(amp), float(freq)), amp))
+
+    def clamp(self, freq_limits = HP8903_FREQ_LIMITS,
+              amp_limits = HP8903_AMP_LIMITS):
+        """Plan with points limited to what the source can do
+
+        Points that end up programming the same frequency and level
+        (to the 5 digits sent over HP-IB) are measured once, the first
+        keeps its place."""
+        freq = np.clip(self.freq, *freq_limits)
+        amp = np.clip(self.amp, *amp_limits)
+        # x follows frequency or level if that is what it was
+        x = np.where(self.x == self.freq, freq,
+                     np.where(self.x == self.amp, amp, self.x))
+
+        keys = np.column_stack((_round_digits(freq), _round_digits(amp)))
+        unused, first = np.unique(keys, axis = 0, return_index = True)
+        keep = np.sort(first)
+
+        per_decade = self.per_decade
+        if ((len(keep) != len(self.x)) or np.any(freq != self.freq)):
+            # No longer the HP 8903's own log sweep
+            per_decade = None
+
+        return(SweepPlan(x[keep], freq[keep], amp[keep],
+                         [self.settings[i] for i in keep],
+                         per_decade = per_decade))
+
+    def ordered(self, cost = None, start = None):
+        """Plan with points reordered for fewer range and filter changes
+
+        cost is a TransitionCost (default weights if None), start the
+        (freq, amp) the HP 8903 is programmed to. Results still carry
+        the index of the point in this plan, see plan_order()."""
+        if (cost is None):
+            cost = TransitionCost()
+        order = cost.order(self, start = start)
+
+        per_decade = self.per_decade
+        if (np.any(order != np.arange(len(order)))):
+            per_decade = None
+
+        return(SweepPlan(self.x[order], self.freq[order], self.amp[order],
+                         [self.settings[i] for i in order],
+                         per_decade = per_decade, index = self.index[order]))
+
+    def remaining(self, done):
+        """Plan of the points whose index is not in done"""
+        keep = np.flatnonzero(~np.isin(self.index, list(done)))
+        return(SweepPlan(self.x[keep], self.freq[keep], self.amp[keep],
+                         [self.settings[i] for i in keep],
+                         index = self.index[keep]))
+
+    def to_dict(self):
+        """Plan as plain lists, for JSON"""
+        return({"x": self.x.tolist(),
+                "freq": self.freq.tolist(),
+                "amp": self.amp.tolist(),
+                "settings": self.settings,
+                "index": self.index.tolist(),
+                "per_decade": self.per_decade})
+
+    @classmethod
+    def from_dict(cls, d):
+        return(cls(d["x"], d["freq"], d["amp"], d["settings"],
+                   per_decade = d["per_decade"], index = d["index"]))
+
+    def __add__(self, other):
+        """Points of both plans, e.g. frequency sweeps at several levels"""
+        return(SweepPlan(np.concatenate((self.x, other.x)),
+                         np.concatenate((self.freq, other.freq)),
+                         np.concatenate((self.amp, other.amp)),
+                         self.settings + other.settings))
+
+    def set(self, where, **settings):
+        """Use settings (meas, unit, filters) for points where is True
+
+        where is a boolean array or a function of the frequency array,
+        e.g. plan.set(lambda f: f > 20000.0, filters = [False]*4)."""
+        if (callable(where)):
+            where = where(self.freq)
+        for i in np.flatnonzero(where):
+            point = dict(self.settings[i] or {})
+            point.update(settings)
+            self.settings[i] = point
+
+        return(self)
+
+    def native(self):
+        """(start, per_decade, npoints) for HP8903.native_sweep, or None"""
+        if (self.per_decade is None):
+            return(None)
+
+        return((float(self.freq[0]), self.per_decade, len(self.x)))
+
+    def __len__(self):
+        return(len(self.x))
+
+    def __getitem__(self, i):
+        if (isinstance(i, slice)):
+            return(SweepPlan(self.x[i], self.freq[i], self.amp[i],
+                             self.settings[i], index = self.index[i]))
+
+        return(SweepPoint(float(self.x[i]), float(self.freq[i]),
+                          float(self.amp[i]), self.settings[i]))
+
+    def __iter__(self):
+        for i in range(len(self.x)):
+            yield(self[i])
+
+
+# Estimated cost (s) of the HP 8903 changing filters, source/input
+# range (10 dB steps) or source band (decades) between two points.
+# Learning them takes readings from a sweep of at least
+# TRANSITION_MIN_POINTS points, and a weight is only learned from a
+# sweep making that change TRANSITION_MIN_CHANGES times.
+TRANSITION_COSTS = {"filters": 0.5, "range": 0.3, "band": 0.2}
+TRANSITION_MIN_POINTS = 8
+TRANSITION_MIN_CHANGES = 2
+
+
+class TransitionCost():
+    def __init__(self, weights = None):
+        """Cost model for the order points of a SweepPlan are measured in
+
+        weights maps "filters", "range" and "band" to the estimated
+        time (s) one such change costs, defaults TRANSITION_COSTS.
+        Ranges are estimated from the source level, the input range
+        follows it for most devices under test."""
+        self.weights = dict(TRANSITION_COSTS)
+        if (weights):
+            self.weights.update(weights)
+        self.keys = ["filters", "range", "band"]
+        # Weights learned by fit()
+        self.fitted = []
+
+    def states(self, plan):
+        """(npoints, 3) array of filter, range and band per point"""
+        settings = {}
+        filters = [settings.setdefault(repr(sorted((s or {}).items())),
+                                       len(settings))
+                   for s in plan.settings]
+        ranges = np.floor(2.0*np.log10(plan.amp))
+        bands = np.floor(np.log10(plan.freq))
+
+        return(np.column_stack((filters, ranges, bands)).astype(int))
+
+    def cost(self, plan, order = None):
+        """Estimated transition time (s) of measuring plan in order"""
+        states = self.states(plan)
+        if (order is not None):
+            states = states[order]
+
+        changes = (np.diff(states, axis = 0) != 0).sum(axis = 0)
+        return(float(sum(self.weights[k]*c for k, c in zip(self.keys, changes))))
+
+    def order(self, plan, start = None):
+        """Order (indices of plan) to measure plan's points in
+
+        Points are grouped by the most expensive state first. Each
+        group is walked from the end nearest the previous one, so
+        neighbouring groups meet at the same state. Within a group plan
+        order is kept. start (freq, amp) picks the direction beginning
+        nearest the instrument."""
+        states = self.states(plan)
+        keys = sorted(range(len(self.keys)),
+                      key = lambda k: -self.weights[self.keys[k]])
+        # Same level points together within a range
+        levels = np.unique(plan.amp, return_inverse = True)[1]
+        order = []
+        self._snake(np.column_stack((states, levels)), keys + [len(self.keys)],
+                    np.arange(len(plan)), order)
+        order = np.array(order, dtype = int)
+
+        if ((start is not None) and (len(order) > 1)):
+            first = SweepPlan([0.0], [start[0]], [start[1]])
+            here = self.states(first)[0, 1:]
+            ends = states[[order[0], order[-1]], 1:]
+            w = np.array([self.weights[k] for k in self.keys[1:]])
+            if ((w*(ends[1] != here)).sum() < (w*(ends[0] != here)).sum()):
+                order = order[::-1]
+
+        return(order)
+
+    def _snake(self, states, keys, idx, order):
+        """Append idx to order grouped by keys, nearest group first"""
+        if (len(keys) == 0):
+            # Plan order, from the end nearest the last point
+            if (order and (abs(idx[-1] - order[-1]) < abs(idx[0] - order[-1]))):
+                idx = idx[::-1]
+            order.extend(idx)
+            return
+
+        column = states[idx, keys[0]]
+        values = np.unique(column)
+        if (order):
+            last = states[order[-1], keys[0]]
+            if (abs(values[-1] - last) < abs(values[0] - last)):
+                values = values[::-1]
+
+        for v in values:
+            self._snake(states, keys[1:], idx[column == v], order)
+
+    @classmethod
+    def fit(cls, plan, results, weights = None, settle = None):
+        """Cost model learned from a sweep of plan
+
+        results are (index, x, Measurement) in the order measured, the
+        time between readings is fitted to the changes before them.
+        settle(freq) gives the expected settle time (s) of a reading,
+        or None, which is taken off first. Only the weights of changes
+        the sweep made TRANSITION_MIN_CHANGES times are fitted, the
+        others are kept from weights. Returns None without enough
+        readings to go by."""
+        model = cls(weights)
+        position = dict((int(ix), k) for k, ix in enumerate(plan.index))
+        states = model.states(plan)
+
+        rows = []
+        dt = []
+        for prev, (i, x, m) in zip(results[:-1], results[1:]):
+            if (prev[2].cached or m.cached or (m.reads > 1) or
+                np.isnan(m.value)):
+                continue
+            t = m.timestamp - prev[2].timestamp
+            if (settle is not None):
+                expected = settle(m.freq)
+                if (expected is None):
+                    continue
+                t -= expected
+            rows.append(states[position[i]] != states[position[prev[0]]])
+            dt.append(t)
+        if (len(dt) < TRANSITION_MIN_POINTS):
+            return(None)
+
+        changes = np.array(rows, dtype = float)
+        a = np.column_stack((np.ones(len(dt)), changes))
+        coef = np.linalg.lstsq(a, np.array(dt), rcond = None)[0]
+
+        for k, c, n in zip(model.keys, coef[1:], changes.sum(axis = 0)):
+            if (n >= TRANSITION_MIN_CHANGES):
+                model.weights[k] = max(float(c), 0.0)
+                model.fitted.append(k)
+
+        return(model)
+
+
+def plan_order(results):
+    """(index, x, Measurement) results sorted back into plan order"""
+    return(sorted(results, key = lambda r: r[0]))
+
+
+def refine_points(freqs, values, log_units, tolerance = ADAPTIVE_TOLERANCE_DB,
+                  step = ADAPTIVE_STEP_DB,
+                  max_per_decade = ADAPTIVE_MAX_PER_DECADE):
+    """Frequencies to add between measured points of a curve, worst first
+
+    freqs are ascending, values the readings (dB if log_units, else
+    linear and compared in dB). An interval gets its log midpoint when
+    the curve steps by more than step across it, or bends by more than
+    tolerance at either end (distance of a point from the line through
+    its neighbours). Intervals that would be split finer than
+    max_per_decade and those with failed readings are left alone."""
+    lf = np.log10(np.asarray(freqs, dtype = float))
+    y = np.asarray(values, dtype = float)
+    if (not log_units):
+        y = 20.0*np.log10(np.maximum(np.abs(y), 1e-12))
+    if (len(lf) < 2):
+        return([])
+
+    score = np.abs(np.diff(y))/step
+    # Bend at interior points, blamed on the intervals either side
+    if (len(lf) > 2):
+        t = (lf[1:-1] - lf[:-2])/(lf[2:] - lf[:-2])
+        bend = np.abs(y[1:-1] - (y[:-2] + t*(y[2:] - y[:-2])))/tolerance
+        score[:-1] = np.maximum(score[:-1], bend)
+        score[1:] = np.maximum(score[1:], bend)
+
+    wide = np.diff(lf) > 2.0/max_per_decade
+    worth = (score > 1.0) & wide & ~np.isnan(score)
+    worst = np.flatnonzero(worth)[np.argsort(-score[worth])]
+
+    return([float(10.0**((lf[i] + lf[i + 1])/2.0)) for i in worst])
+
+
+def _round_digits(a, digits = 5):
+    """Round to the significant digits of the HP-IB entry format"""
+    a = np.asarray(a, dtype = float)
+    scale = 10.0**(digits - 1 - np.floor(np.log10(np.abs(np.where(a == 0.0, 1.0, a)))))
+    return(np.round(a*scale)/scale)
+
+
+def write_text(fid, measurements, x, y, cached = None, latency = None):
+    """Write sweep results as text
+
+    measurements is [amp, filters, meas, units, meas_string, units_string],
+    cached optionally flags points that came from a MeasurementCache,
+    latency is a LatencyRecorder whose summary goes in the header."""
+    # Write source voltage info
+    source_v = str(measurements[0])
+    fid.write("# Measurement: " + measurements[4] + "\n")
+    fid.write("# Source Voltage: " + source_v + " V RMS\n")
+    # write filter info
+    for n, f in enumerate(measurements[1]):
+        if f:
+            fid.write("# " + HP8903_filters[n] + " active\n")
+    if (latency is not None):
+        for line in latency.report():
+            fid.write("# " + line + "\n")
+
+    fid.write("# Frequency (Hz)    " + measurements[5] + "\n")
+    if ((cached is None) or (not any(cached))):
+        n = np.array([np.array(x), np.array(y)])
         np.savetxt(fid, n.transpose(), fmt = ["%f", "%f"])
+        return
+
+    # Marked with a comment so the columns still load with loadtxt
+    fid.write("# Points marked cached were not measured again\n")
+    for xv, yv, c in zip(x, y, cached):
+        fid.write("%f %f%s\n" % (xv, yv, ("  # cached" if c else "")))
+
+
+# Binary sweep archive: magic, header length (uint32), JSON header,
+# then fixed size records starting at an ARCHIVE_ALIGN boundary
+ARCHIVE_MAGIC = b"HP8903A1"
+ARCHIVE_ALIGN = 64
+
+archive_dtype = np.dtype([("x", "<f8"),
+                          ("freq", "<f8"),
+                          ("amp", "<f8"),
+                          ("value", "<f8"),
+                          # HP 8903 error code, 0 if none
+                          ("error", "<i2"),
+                          ("timestamp", "<f8"),
+                          ("raw", "S16"),
+                          # 1 if the reading came from the cache
+                          ("cached", "u1"),
+                          # Readings averaged and their standard
+                          # deviation (NaN for a single reading)
+                          ("reads", "<u2"),
+                          ("std", "<f8")])
+
+
+def _measurements_header(measurements, metadata = None):
+    """Dict describing a sweep for archive and journal headers"""
+    return({"amp": measurements[0],
+            "filters": [bool(f) for f in measurements[1]],
+            "meas": measurements[2],
+            "units": measurements[3],
+            "meas_string": measurements[4],
+            "units_string": measurements[5],
+            "created": time.time(),
+            "metadata": metadata or {}})
+
+
+def write_archive(fname, measurements, points, metadata = None):
+    """Write sweep results as a binary archive
+
+    points is a list of (index, x, Measurement), values are stored at
+    full precision with their raw readings, error codes and timestamps.
+    measurements is the list written by write_text, metadata an optional
+    dict of anything else worth keeping."""
+    records = np.zeros(len(points), dtype = archive_dtype)
+    for n, (i, x, m) in enumerate(points):
+        raw = ""
+        if (m.raw):
+            raw = m.raw.strip()
+        std = np.nan
+        if (m.std is not None):
+            std = m.std
+        records[n] = (x, m.freq, m.amp, m.value, m.error or 0, m.timestamp,
+                      raw.encode('ascii'), m.cached, m.reads, std)
+
+    header = _measurements_header(measurements, metadata)
+    header["dtype"] = archive_dtype.descr
+    header["count"] = len(records)
+    text = json.dumps(header).encode('ascii')
+
+    # Pad so records start aligned
+    start = len(ARCHIVE_MAGIC) + 4 + len(text)
+    pad = (-start) % ARCHIVE_ALIGN
+    text += b" "*pad
+
+    with open(fname, 'wb') as fid:
+        fid.write(ARCHIVE_MAGIC)
+        fid.write(struct.pack("<I", len(text)))
+        fid.write(text)
+        fid.write(records.tobytes())
+
+
+def read_archive(fname):
+    """Read a binary archive, returns (header, records)
+
+    records is a read only memory map of the file, nothing is copied."""
+    with open(fname, 'rb') as fid:
+        if (fid.read(len(ARCHIVE_MAGIC)) != ARCHIVE_MAGIC):
+            raise ValueError("Not an hp8903 archive: %s" % fname)
+        length = struct.unpack("<I", fid.read(4))[0]
+        header = json.loads(fid.read(length).decode('ascii'))
+
+    dtype = np.dtype([tuple(str(f) for f in d) for d in header["dtype"]])
+    offset = len(ARCHIVE_MAGIC) + 4 + length
+    if (header["count"] == 0):
+        return((header, np.zeros(0, dtype = dtype)))
+
+    records = np.memmap(fname, dtype = dtype, mode = 'r', offset = offset,
+                        shape = (header["count"],))
+
+    return((header, records))
+
+
+# Seconds between journal fsyncs, at most this much is lost in a crash
+JOURNAL_SYNC_INTERVAL = 1.0
+
+
+class SweepJournal(threading.Thread):
+    def __init__(self, fname, measurements, metadata = None,
+                 sync_interval = JOURNAL_SYNC_INTERVAL, sweep = None,
+                 measured = None):
+        """Append-only log of a sweep, written point by point
+
+        One JSON record per line: a header, the points, and an end
+        record. A background thread does the writing and fsyncs at least
+        every sync_interval seconds. Until close() the file is named
+        fname + ".partial", then it is renamed to fname. A journal
+        closed as aborted ends in an aborted record instead and keeps
+        the .partial name.
+        sweep is the _sweep_setup dict, with it in the header the sweep
+        can be resumed (see resume_setup). measured are (index, x,
+        Measurement) points from before a resume, they are written
+        with the header to a new file that only replaces an existing
+        .partial journal (the one resumed from) once it is on disk."""
+        threading.Thread.__init__(self)
+        self.daemon = True
+
+        self.fname = fname
+        self.partial = fname + ".partial"
+        self.header = _measurements_header(measurements, metadata)
+        self.header["type"] = "header"
+        if (sweep is not None):
+            self.header["sweep"] = _sweep_record(sweep)
+        self.sync_interval = sync_interval
+        self.aborted = False
+        self.measured = [_point_record(*pt) for pt in (measured or [])]
+
+        self.records = queue.Queue()
+        self.start()
+
+    def append(self, index, x, m):
+        """Log a (index, x, Measurement) sweep point"""
+        self.records.put(_point_record(index, x, m))
+
+    def close(self, aborted = False):
+        """Finish the journal and wait for it to be written
+
+        aborted when the sweep was stopped or failed before its end."""
+        self.aborted = aborted
+        self.records.put(None)
+        self.join()
+
+    def run(self):
+        tmp = self.partial + ".tmp"
+        fid = open(tmp, 'w')
+        fid.write(json.dumps(self.header) + "\n")
+        for record in self.measured:
+            fid.write(json.dumps(record) + "\n")
+        fid.flush()
+        os.fsync(fid.fileno())
+        os.rename(tmp, self.partial)
+
+        last_sync = _clock()
+        while (True):
+            wait = max(0.0, last_sync + self.sync_interval - _clock())
+            try:
+                record = self.records.get(timeout = wait)
+            except queue.Empty:
+                record = {}
+
+            if (record is None):
+                break
+
+            if (record):
+                fid.write(json.dumps(record) + "\n")
+
+            if ((_clock() - last_sync) >= self.sync_interval):
+                fid.flush()
+                os.fsync(fid.fileno())
+                last_sync = _clock()
+
+        end = "aborted" if self.aborted else "end"
+        fid.write(json.dumps({"type": end, "timestamp": time.time()}) + "\n")
+        fid.flush()
+        os.fsync(fid.fileno())
         fid.close()
-        
-        
-    def freq_callback(self, spinb):
-        if (self.start_freq.get_value() > self.stop_freq.get_value()):
-            self.start_freq.set_value(self.stop_freq.get_value())
-
-    def volt_callback(self, spinb):
-        if (self.start_v.get_value() > self.stop_v.get_value()):
-            self.start_v.set_value(self.stop_v.get_value())
-
-    # 30k/80k toggle
-    def filter1_callback(self, cb):
-        if (cb.get_active()):
-            if (cb.get_label() == "30 kHz LP"):
-                self.f80k.set_active(False)
-            elif (cb.get_label() == "80 kHz LP"):
-                self.f30k.set_active(False)
-
-    # left plugin/right plugin toggle
-    def filter2_callback(self, cb):
-        if (cb.get_active()):
-            if (cb.get_label() == "Left Plug-in filter"):
-                self.rpi.set_active(False)
-            elif (cb.get_label() == "Right Plug-in filter"):
-                self.lpi.set_active(False)
-
-    def on_menu_file_quit(self, widget):
-        if (self.gpib_dev):
-            self.gpib_dev.close()
-        Gtk.main_quit()
-
-    def meas_changed(self, widget):
-        meas_ind = self.meas_combo.get_active()
-        if (meas_ind == 0):
-            self.units_combo.set_model(self.thd_units_store)
-            self.units_combo.set_active(0)
-            self.a.set_ylabel("THD+n (%)")
-            self.a.set_xlabel("Frequency (Hz)")            
-            self.canvas.draw()
-            self.freq.set_sensitive(False)
-            self.source.set_sensitive(True)
-            for w in self.freq_sweep_widgets:
-                w.set_sensitive(True)
-            for w in self.vsweep_widgets:
-                w.set_sensitive(False)
-        elif (meas_ind == 1):
-            self.units_combo.set_model(self.ampl_units_store)
-            self.units_combo.set_active(0)
-            self.a.set_ylabel("AC Level (V RMS)")
-            self.a.set_xlabel("Frequency (Hz)")            
-            self.canvas.draw()
-            self.freq.set_sensitive(False)
-            self.source.set_sensitive(True)
-            for w in self.freq_sweep_widgets:
-                w.set_sensitive(True)
-            for w in self.vsweep_widgets:
-                w.set_sensitive(False)
-        elif (meas_ind == 2):
-            self.units_combo.set_model(self.thdr_units_store)
-            self.units_combo.set_active(0)
-            self.a.set_ylabel("THD+n Ratio (%)")
-            self.a.set_xlabel("Frequency (Hz)")
-            self.canvas.draw()
-            self.freq.set_sensitive(True)
-            self.source.set_sensitive(True)
-            for w in self.freq_sweep_widgets:
-                w.set_sensitive(True)
-            for w in self.vsweep_widgets:
-                w.set_sensitive(False)
-        elif (meas_ind == 3):
-            self.units_combo.set_model(self.amplr_units_store)
-            self.units_combo.set_active(0)
-            self.a.set_ylabel("AC Level Ratio (%)")
-            self.a.set_xlabel("Frequency (Hz)")
-            self.canvas.draw()
-            self.freq.set_sensitive(True)
-            self.source.set_sensitive(True)
-            for w in self.freq_sweep_widgets:
-                w.set_sensitive(True)
-            for w in self.vsweep_widgets:
-                w.set_sensitive(False)
-        elif (meas_ind == 4):
-            self.units_combo.set_model(self.optlvl_units_store)
-            self.units_combo.set_active(0)
-            self.a.set_ylabel("Output Level (V)")
-            self.a.set_xlabel("Input Level (V)")
-            self.canvas.draw()
-            self.freq.set_sensitive(True)
-            self.source.set_sensitive(False)
-            for w in self.freq_sweep_widgets:
-                w.set_sensitive(False)
-            for w in self.vsweep_widgets:
-                w.set_sensitive(True)
-
-
-            
-
-
-    def units_changed(self, widget):
-        meas_ind = self.meas_combo.get_active()
-        units_ind = self.units_combo.get_active()
-        #print("meas ind: %d units ind: %d" % (meas_ind, units_ind))
-        # Set units on plot
-        meas = ""
-        if (meas_ind == 0):
-            meas = "THD+n "
-            if (units_ind == 0):
-                meas += "(%)"
-                self.units_string = "%"
-            elif (units_ind == 1):
-                meas += "(dB)"
-                self.units_string = "dB"
-        elif (meas_ind == 1):
-            meas = "AC Level "
-            if (units_ind == 0):
-                meas += "(V RMS)"
-                self.units_string = "V RMS"
-            elif (units_ind == 1):
-                meas += "(dB V)"
-                self.units_string = "dB V"
-        elif (meas_ind == 2):
-            meas = "THD+n (Ratio) "
-            if (units_ind == 0):
-                meas += "(%)"
-                self.units_string = "%"
-            elif (units_ind == 1):
-                meas += "(dB)"
-                self.units_string = "dB"
-        elif (meas_ind == 3):
-            meas = "AC Level (Ratio) "
-            if (units_ind == 0):
-                meas += "(%)"
-                self.units_string = "%"
-            elif (units_ind == 1):
-                meas += "(dB)"
-                self.units_string = "dB"
-
-        # Save text info about units
-        self.meas_string = meas
-        # Updated plot
-        self.a.set_ylabel(meas)
-        self.canvas.draw()
-
-    # menu bar junk
-    def create_ui_manager(self):
-        uimanager = Gtk.UIManager()
-
-        # Throws exception if something went wrong
-        uimanager.add_ui_from_string(UI_INFO)
-
-        # Add the accelerator group to the toplevel window
-        accelgroup = uimanager.get_accel_group()
-        self.add_accel_group(accelgroup)
-        return uimanager
+        if (not self.aborted):
+            os.rename(self.partial, self.fname)
+
+
+def _point_record(index, x, m):
+    """Journal record of a (index, x, Measurement) sweep point"""
+    return({"type": "point",
+            "index": index,
+            "x": float(x),
+            "freq": float(m.freq),
+            "amp": float(m.amp),
+            "value": float(m.value),
+            "raw": m.raw,
+            "error": m.error,
+            "payload": m.payload,
+            "timestamp": m.timestamp,
+            "cached": m.cached,
+            "reads": m.reads,
+            "std": m.std})
+
+
+def read_journal(fname):
+    """Read a (possibly unfinished) journal
+
+    Returns (header, points, state), points being the logged point
+    records and state "finished", "aborted" or "partial" (the program
+    died mid sweep). A truncated last line from a crash is ignored."""
+    header = None
+    points = []
+    state = "partial"
+    with open(fname) as fid:
+        for line in fid:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                break
+            if (record["type"] == "header"):
+                header = record
+            elif (record["type"] == "point"):
+                points.append(record)
+            elif (record["type"] == "end"):
+                state = "finished"
+            elif (record["type"] == "aborted"):
+                state = "aborted"
+
+    return((header, points, state))
+
+
+def _sweep_record(setup):
+    """What a journal needs to resume the sweep of a _sweep_setup dict"""
+    points = setup["points"]
+    if (not isinstance(points, SweepPlan)):
+        points = SweepPlan([p[0] for p in points], [p[1] for p in points],
+                           [p[2] for p in points])
+
+    return({"ref_freq": setup["ref_freq"],
+            "ref_amp": setup["ref_amp"],
+            "native": setup["native"],
+            "adaptive": setup.get("adaptive"),
+            "averaging": setup.get("averaging"),
+            "stability": setup.get("stability"),
+            "reorder": setup.get("reorder"),
+            "plan": points.to_dict()})
+
+
+def _journal_measurement(record):
+    """Measurement of a journal point record"""
+    return(Measurement(record["freq"], record["amp"], record["value"],
+                       record["raw"], record["error"], record["payload"],
+                       record["timestamp"], record.get("cached", False),
+                       record.get("reads", 1), record.get("std")))
+
+
+def resume_setup(fname):
+    """Pick up an interrupted sweep from its journal
+
+    Returns (setup, results): setup like _sweep_setup with points
+    narrowed to those not measured yet, results the (index, x,
+    Measurement) already measured. Lost readings (NaN without an
+    instrument error) are measured again. An unfinished journal
+    (fname + ".partial") is preferred, it is the newer one. Finished
+    sweeps can't be resumed."""
+    if (os.path.exists(fname + ".partial")):
+        fname = fname + ".partial"
+
+    header, records, state = read_journal(fname)
+    if ((header is None) or ("sweep" not in header)):
+        raise ValueError("%s has no sweep to resume" % fname)
+    if (state == "finished"):
+        raise ValueError("%s is a finished sweep" % fname)
+
+    sweep = header["sweep"]
+    results = [(r["index"], r["x"], _journal_measurement(r)) for r in records
+               if (not ((r["error"] is None) and np.isnan(r["value"])))]
+
+    plan = SweepPlan.from_dict(sweep["plan"])
+    done = [r[0] for r in results]
+    adaptive = sweep["adaptive"]
+    if (adaptive):
+        # Adaptive points are indexed by frequency
+        done = plan.index[np.isin(plan.freq, done)]
+    points = plan.remaining(done)
+
+    setup = {"meas": header["meas"],
+             "units": header["units"],
+             "filters": header["filters"],
+             "ref_freq": sweep["ref_freq"],
+             "ref_amp": sweep["ref_amp"],
+             "points": points,
+             # Whatever is left is measured point by point
+             "native": None,
+             "adaptive": adaptive,
+             "averaging": sweep.get("averaging"),
+             "stability": sweep.get("stability"),
+             # Reordered again once connected, see _sweep_points
+             "reorder": sweep.get("reorder"),
+             "measurements": [header["amp"], header["filters"], header["meas"],
+                              header["units"], header["meas_string"],
+                              header["units_string"]]}
+
+    return((setup, results))
+
+
+def _sweep_parser(prog, description):
+    """Command line options describing one sweep"""
+    parser = argparse.ArgumentParser(prog = prog, description = description)
+    parser.add_argument("--controller", choices = sorted(HP8903_controllers),
+                        default = "galvant", help = "GPIB controller")
+    parser.add_argument("--port", default = None,
+                        help = "Serial device of the controller (e.g. /dev/ttyUSB0)")
+    parser.add_argument("--addr", type = int, default = 0,
+                        help = "GPIB address of the HP 8903")
+    parser.add_argument("--meas", choices = [m[0] for m in HP8903_measurements],
+                        default = "thd", help = "Measurement")
+    parser.add_argument("--log", action = "store_true",
+                        help = "Log units (dB) instead of linear")
+    parser.add_argument("--lp", choices = ["30k", "80k"],
+                        help = "Low pass filter")
+    parser.add_argument("--plugin", choices = ["left", "right"],
+                        help = "Plug-in filter")
+    parser.add_argument("--start", type = float, default = 20.0,
+                        help = "Start frequency (Hz)")
+    parser.add_argument("--stop", type = float, default = 30000.0,
+                        help = "Stop frequency (Hz)")
+    parser.add_argument("--steps", type = int, default = 10,
+                        help = "Steps per decade")
+    parser.add_argument("--third-octave", action = "store_true",
+                        help = "ISO 1/3 octave frequencies from start to stop instead")
+    parser.add_argument("--freqs", default = None,
+                        help = "Comma separated frequencies (Hz) instead")
+    parser.add_argument("--amp", type = float, default = 0.5,
+                        help = "Source level (V RMS)")
+    parser.add_argument("--freq", type = float, default = 1000.0,
+                        help = "Ratio reference and output level frequency (Hz)")
+    parser.add_argument("--start-v", type = float, default = 0.1,
+                        help = "Output level start voltage (V)")
+    parser.add_argument("--stop-v", type = float, default = 1.0,
+                        help = "Output level stop voltage (V)")
+    parser.add_argument("--samples", type = int, default = 10,
+                        help = "Output level total samples")
+    parser.add_argument("--native", action = "store_true",
+                        help = "Let the HP 8903 run the frequency sweep")
+    parser.add_argument("--adaptive", action = "store_true",
+                        help = "Coarse log sweep, then add points where the curve needs them")
+    parser.add_argument("--tolerance", type = float, default = ADAPTIVE_TOLERANCE_DB,
+                        help = "Adaptive sweep curve error target (dB)")
+    parser.add_argument("--budget", type = int, default = None,
+                        help = "Adaptive sweep most points (default: as many as --steps gives)")
+    parser.add_argument("--reorder", action = "store_true",
+                        help = "Measure points in the order with fewest range and filter changes")
+    parser.add_argument("--transition-costs", default = None,
+                        help = "With --reorder, time (s) a change costs instead of the learned or default estimate, e.g. filters=0.5,range=0.3,band=0.2")
+    parser.add_argument("--average", action = "store_true",
+                        help = "Average repeated readings of noisy points")
+    parser.add_argument("--average-target", type = float, default = AVERAGE_TARGET,
+                        help = "Stop averaging once the 95%% confidence interval is within this ratio of the mean")
+    parser.add_argument("--max-reads", type = int, default = AVERAGE_MAX_READS,
+                        help = "Most readings averaged per point")
+    parser.add_argument("--stable", action = "store_true",
+                        help = "Take readings until they stop changing instead of waiting the fixed settling time (T3)")
+    parser.add_argument("--stable-tolerance", type = float, default = STABLE_TOLERANCE,
+                        help = "Settled readings differ from the latest by at most this ratio")
+    parser.add_argument("-o", "--output", default = None,
+                        help = "Output file (default: timestamp name, - for stdout)")
+    parser.add_argument("--archive", default = None,
+                        help = "Also write a full precision binary archive")
+    parser.add_argument("--journal", default = None,
+                        help = "Log points to this file as they are measured")
+    parser.add_argument("--latency", action = "store_true",
+                        help = "Time each phase of each point, percentiles are saved with the data")
+
+    return(parser)
+
+
+def _sweep_setup(parser, args):
+    """Check parsed sweep options, returns a dict describing the sweep
+
+    Keys are the SweepWorker arguments (meas, units, filters, ref_freq,
+    ref_amp, points, native, adaptive) plus averaging, (target,
+    max_reads) or None, stability, the StabilityDetector tolerance or
+    None, reorder, configured transition costs if points are to be
+    reordered once connected (see _sweep_points) or None, and
+    measurements for saving."""
+    if ((args.port is None) and (args.controller != "emulator")):
+        parser.error("--port is required for %s" % args.controller)
+
+    meas = [m[0] for m in HP8903_measurements].index(args.meas)
+    units = int(args.log)
+    if (units >= len(HP8903_measurements[meas][2])):
+        parser.error("%s has no log units" % args.meas)
+
+    # 30, 80, LPI, RPI
+    filters = [args.lp == "30k", args.lp == "80k",
+               args.plugin == "left", args.plugin == "right"]
+
+    name, unit_names = HP8903_measurements[meas][1:]
+    measurements = [args.amp, filters, meas, units,
+                    "%s (%s)" % (name, unit_names[units]), unit_names[units]]
+
+    if (meas < 4):
+        if (args.freqs):
+            try:
+                freqs = [float(f) for f in args.freqs.split(",")]
+            except ValueError:
+                parser.error("--freqs must be a comma separated list of numbers")
+            plan = SweepPlan.freqs(freqs, args.amp)
+        elif (args.third_octave):
+            plan = SweepPlan.third_octave(args.start, args.stop, args.amp)
+        else:
+            plan = SweepPlan.log(args.start, args.stop, args.steps, args.amp)
+        ref_amp = args.amp
+    else:
+        plan = SweepPlan.levels(args.start_v, args.stop_v, args.samples,
+                                args.freq)
+        ref_amp = args.start_v
+    points = plan.clamp()
+
+    adaptive = None
+    if (args.adaptive):
+        if ((meas >= 4) or args.freqs or args.third_octave):
+            parser.error("--adaptive needs a log frequency sweep")
+        if (args.native or args.reorder):
+            parser.error("--adaptive can't be combined with --native or --reorder")
+        # Uniform sweep sets the budget, the coarse pass starts off
+        budget = args.budget
+        if (budget is None):
+            budget = len(points)
+        points = SweepPlan.log(args.start, args.stop,
+                               min(args.steps, ADAPTIVE_COARSE_PER_DECADE),
+                               args.amp).clamp()
+        adaptive = (args.tolerance, budget)
+
+    native = None
+    if (args.native):
+        native = points.native()
+        if (native is None):
+            parser.error("--native needs a log frequency sweep within the source limits")
+        if (args.reorder):
+            parser.error("--native and --reorder can't be combined")
+    reorder = None
+    if (args.reorder):
+        # Ordered once connected, the learned costs are needed
+        reorder = {}
+        for w in (args.transition_costs or "").split(","):
+            if (not w):
+                continue
+            k, _, v = w.partition("=")
+            if (k not in TRANSITION_COSTS):
+                parser.error("Unknown transition in --transition-costs: %s" % k)
+            try:
+                reorder[k] = float(v)
+            except ValueError:
+                parser.error("Bad time in --transition-costs: %s" % w)
+    elif (args.transition_costs):
+        parser.error("--transition-costs needs --reorder")
+
+    averaging = None
+    if (args.average):
+        if (args.native):
+            parser.error("--native sweeps can't be averaged")
+        if ((args.average_target <= 0.0) or (args.max_reads < 1)):
+            parser.error("--average-target and --max-reads must be positive")
+        averaging = (args.average_target, args.max_reads)
+
+    stability = None
+    if (args.stable):
+        if (args.native):
+            parser.error("--native sweeps settle on the HP 8903's own timing")
+        if (args.stable_tolerance <= 0.0):
+            parser.error("--stable-tolerance must be positive")
+        stability = args.stable_tolerance
+
+    return({"meas": meas,
+            "units": units,
+            "filters": filters,
+            "ref_freq": args.freq,
+            "ref_amp": ref_amp,
+            "points": points,
+            "native": native,
+            "adaptive": adaptive,
+            "averaging": averaging,
+            "stability": stability,
+            "reorder": reorder,
+            "measurements": measurements})
+
+
+def _averager(setup):
+    """Averager for a _sweep_setup dict, None when not averaging"""
+    if (not setup.get("averaging")):
+        return(None)
+
+    target, max_reads = setup["averaging"]
+    return(Averager(target, max_reads))
+
+
+def _stability(setup):
+    """StabilityDetector for a _sweep_setup dict, None to use T3"""
+    if (not setup.get("stability")):
+        return(None)
+
+    return(StabilityDetector(tolerance = setup["stability"]))
+
+
+def _sweep_points(setup, hp):
+    """Points of a _sweep_setup dict to measure on hp
+
+    Reordered if asked to. The sweep starts from the ratio reference,
+    so that's where the instrument is before the first point."""
+    if (setup.get("reorder") is None):
+        return(setup["points"])
+
+    return(setup["points"].ordered(hp.transition_cost(setup["reorder"]),
+                                   start = (setup["ref_freq"], setup["ref_amp"])))
+
+
+def connect_hp8903(controller, port, addr, dev = None, record = None):
+    """Open a controller and check the HP 8903 behind it
+
+    controller is a key of HP8903_controllers. dev is an already open
+    controller to use instead (e.g. a GalvantBusDevice). record is a
+    session file to record the controller's traffic to. Returns an
+    HP8903 with its TimingModel, or None on failure."""
+    if (dev is None):
+        dev = HP8903_controllers[controller](gpib_addr = addr)
+        if (record):
+            dev = RecordingDevice(dev, record)
+        if ((not dev.open(port)) or (not dev.test())):
+            print("Failed to open GPIB Device: %s at %s" % (dev.name(), port))
+            dev.close()
+            return(None)
+
+    hp = HP8903(dev, timing = load_timing(dev, port, addr))
+    if (not hp.init()):
+        print("Failed to initialize HP 8903")
+        dev.close()
+        return(None)
+
+    return(hp)
+
+
+def load_timing(dev, port, addr):
+    """TimingModel of the instrument behind an open controller
+
+    Simulated instruments (emulator, replay) get one that isn't saved,
+    their settle times say nothing about a real HP 8903."""
+    path = TIMING_PATH
+    if (dev.simulated):
+        path = None
+
+    return(TimingModel.load("%s %s %d" % (dev.name(), port, addr),
+                            path = path))
+
+
+def _metadata(hp):
+    """Connection details stored with saved data"""
+    return({"controller": hp.gpib_dev.name(),
+            "port": hp.gpib_dev.dev_name,
+            "addr": hp.gpib_dev.gpib_addr})
+
+
+def _save_results(output, archive, measurements, results, metadata,
+                  latency = None):
+    """Write (index, x, Measurement) results as text and optional archive
+
+    A LatencyRecorder's summary goes in the text header, everything it
+    recorded in the archive metadata."""
+    results = plan_order(results)
+    x = [r[1] for r in results]
+    y = [r[2].value for r in results]
+    cached = [r[2].cached for r in results]
+
+    if (output == "-"):
+        write_text(sys.stdout, measurements, x, y, cached, latency)
+    else:
+        fname = output
+        if (fname is None):
+            fname = datetime.now().strftime("%Y-%m-%d-%H%M%S") + ".txt"
+        with open(fname, 'w') as fid:
+            write_text(fid, measurements, x, y, cached, latency)
+        print("Saved %s" % fname)
+
+    if (latency is not None):
+        metadata = dict(metadata, latency = latency.to_dict())
+    if (archive):
+        write_archive(archive, measurements, results, metadata = metadata)
+        print("Saved %s" % archive)
+
+
+def sweep_main(argv):
+    """Run a sweep without the GUI, returns exit status"""
+    parser = _sweep_parser("hp8903.py sweep", "Run an HP 8903 sweep without the GUI")
+    parser.add_argument("--resume", default = None,
+                        help = "Continue the sweep logged in this journal (sweep options are taken from it)")
+    parser.add_argument("--record", default = None,
+                        help = "Record all controller traffic to this session file (replay it with --controller replay --port SESSION)")
+    args = parser.parse_args(argv)
+
+    measured = []
+    if (args.resume):
+        if ((args.port is None) and (args.controller != "emulator")):
+            parser.error("--port is required for %s" % args.controller)
+        try:
+            setup, measured = resume_setup(args.resume)
+        except (IOError, OSError, ValueError) as e:
+            parser.error(str(e))
+        if (args.journal is None):
+            # Keep logging to the same journal, it can be resumed again
+            args.journal = args.resume
+            if (args.journal.endswith(".partial")):
+                args.journal = args.journal[:-len(".partial")]
+        print("Resuming with %d points measured, %d to go" %
+              (len(measured), len(setup["points"])))
+    else:
+        setup = _sweep_setup(parser, args)
+
+    hp = connect_hp8903(args.controller, args.port, args.addr,
+                        record = args.record)
+    if (hp is None):
+        return(1)
+    if (args.latency):
+        hp.record_latency(LatencyRecorder())
+    hp.averaging = _averager(setup)
+    hp.stability = _stability(setup)
+    setup["points"] = _sweep_points(setup, hp)
+
+    metadata = _metadata(hp)
+    journal = None
+    if (args.journal):
+        journal = SweepJournal(args.journal, setup["measurements"], metadata,
+                               sweep = setup, measured = measured)
+
+    points = setup["points"]
+    results = list(measured)
+    total = len(measured) + len(points)
+    if (setup["adaptive"]):
+        total = setup["adaptive"][1]
+
+    completed = False
+    try:
+        sweep = run_sweep(hp, setup["meas"], setup["units"], setup["filters"],
+                          setup["ref_freq"], setup["ref_amp"], points,
+                          native = setup["native"],
+                          adaptive = setup["adaptive"], measured = measured)
+        for i, px, m in sweep:
+            results.append((i, px, m))
+            if (journal):
+                journal.append(i, px, m)
+            sys.stderr.write("%d/%d %g %g\n" % (len(results), total, px, m.value))
+        completed = True
+    except KeyboardInterrupt:
+        print("Sweep interrupted, saving %d points" % len(results))
+    except (IOError, OSError, serial.SerialException) as e:
+        print("Sweep stopped: %s" % str(e))
+        if (journal):
+            print("Continue it with --resume %s" % args.journal)
+    finally:
+        if (journal):
+            journal.close(aborted = not completed)
+        if ((not setup["native"]) and (not setup["adaptive"])):
+            hp.learn_transitions(setup["meas"], points, results[len(measured):])
+        hp.timing.save()
+        hp.gpib_dev.close()
+
+    _save_results(args.output, args.archive, setup["measurements"], results,
+                  metadata, latency = hp.latency)
+    if (hp.latency is not None):
+        sys.stderr.write("\n".join(hp.latency.report()) + "\n")
+
+    return(0)
+
+
+class Station():
+    def __init__(self):
+        """Several HP 8903s sweeping in parallel
+
+        Instruments on their own controllers each get a SweepWorker
+        thread, so a slow reading on one controller doesn't hold up the
+        others. Instruments sharing a Galvant adapter (same port) are
+        put on a GalvantBus and swept together by a BusWorker."""
+        # name -> HP8903, names in order added
+        self.instruments = {}
+        self.names = []
+        # port -> GalvantBus
+        self.buses = {}
+        # name -> worker, and the workers to start
+        self.workers = {}
+        self.threads = []
+        # port -> (BusSweep, journals) collecting bus sweeps until run()
+        self.bus_sweeps = {}
+        self.setups = {}
+        # name -> list of (index, x, Measurement)
+        self.results = {}
+        self.finished = set()
+
+    def connect(self, name, controller, port, addr):
+        """Add an instrument, returns False if it can't be used"""
+        dev = None
+        if (controller == "galvant"):
+            bus = self.buses.get(port)
+            if (bus is None):
+                adapter = Galvant_GPIB_USB(gpib_addr = addr)
+                if ((not adapter.open(port)) or (not adapter.test())):
+                    print("Failed to open GPIB Device: %s at %s" %
+                          (adapter.name(), port))
+                    adapter.close()
+                    return(False)
+                bus = GalvantBus(adapter)
+                self.buses[port] = bus
+            dev = bus.device(addr)
+
+        hp = connect_hp8903(controller, port, addr, dev = dev)
+        if (hp is None):
+            return(False)
+
+        self.instruments[name] = hp
+        self.names.append(name)
+        return(True)
+
+    def start(self, name, setup, journal = None):
+        """Set up a sweep (a _sweep_setup dict) on instrument name
+
+        Sweeps begin with run()."""
+        hp = self.instruments[name]
+        hp.averaging = _averager(setup)
+        hp.stability = _stability(setup)
+        args = dict((k, setup[k]) for k in ("meas", "units", "filters",
+                                            "ref_freq", "ref_amp", "points"))
+        self.setups[name] = setup
+        self.results[name] = []
+        self.finished.discard(name)
+
+        if (isinstance(hp.gpib_dev, GalvantBusDevice)):
+            # Native sweeps would hold the bus, measure points instead
+            port = hp.gpib_dev.dev_name
+            if (port not in self.bus_sweeps):
+                self.bus_sweeps[port] = (BusSweep(), {})
+            bus_sweep, journals = self.bus_sweeps[port]
+            if (setup["adaptive"]):
+                print("%s: adaptive sweeps need the instrument to themselves, "
+                      "measuring the coarse pass only" % name)
+            if ((hp.averaging is not None) or (hp.stability is not None)):
+                print("%s: readings on a shared bus are triggered with "
+                      "settling (T3) and not averaged" % name)
+            bus_sweep.add(hp, **args)
+            if (journal):
+                journals[hp.gpib_dev.gpib_addr] = journal
+        else:
+            worker = SweepWorker(hp, native = setup["native"],
+                                 adaptive = setup["adaptive"],
+                                 journal = journal, **args)
+            self.workers[name] = worker
+            self.threads.append(worker)
+
+    def run(self):
+        """Start all sweeps"""
+        for port, (bus_sweep, journals) in self.bus_sweeps.items():
+            worker = BusWorker(bus_sweep, journals)
+            for name in self.names:
+                if ((name in self.setups) and
+                    (self.instruments[name].gpib_dev.dev_name == port) and
+                    isinstance(self.instruments[name].gpib_dev, GalvantBusDevice)):
+                    self.workers[name] = worker
+            self.threads.append(worker)
+        self.bus_sweeps = {}
+
+        for worker in self.threads:
+            if (not worker.is_alive()):
+                worker.start()
+
+    def _name(self, worker, addr):
+        for name, w in self.workers.items():
+            if ((w is worker) and
+                (self.instruments[name].gpib_dev.gpib_addr == addr)):
+                return(name)
+
+    def poll(self):
+        """Collect worker output, returns a list of (name, kind, data)
+
+        Points are also added to self.results[name]."""
+        events = []
+        for worker in self.threads:
+            names = [n for n in self.names if (self.workers.get(n) is worker)]
+            while (True):
+                try:
+                    kind, data = worker.results.get_nowait()
+                except queue.Empty:
+                    break
+
+                if ((kind == "point") and isinstance(worker, BusWorker)):
+                    # Bus workers tag points with the GPIB address
+                    addr, data = data
+                    targets = [self._name(worker, addr)]
+                else:
+                    targets = names
+
+                for name in targets:
+                    if (kind == "point"):
+                        self.results[name].append(data)
+                    elif (kind == "done"):
+                        self.finished.add(name)
+                        self._learn(name)
+                    events.append((name, kind, data))
+
+        return(events)
+
+    def running(self):
+        """Are any sweeps still going?"""
+        return(len(self.finished) < len(self.workers))
+
+    def stop(self):
+        """Stop all sweeps and wait for them"""
+        for worker in self.threads:
+            worker.stop()
+        for worker in self.threads:
+            if (worker.is_alive()):
+                worker.join(5.0)
+
+    def _learn(self, name):
+        """Learn transition costs from the finished sweep of name
+
+        Bus sweeps interleave instruments, their reading times don't
+        tell."""
+        hp = self.instruments[name]
+        setup = self.setups[name]
+        if ((not setup["native"]) and (not setup["adaptive"]) and
+            (not isinstance(hp.gpib_dev, GalvantBusDevice))):
+            hp.learn_transitions(setup["meas"], setup["points"],
+                                 self.results[name])
+
+    def close(self):
+        self.stop()
+        # Collect what the stopped sweeps measured
+        self.poll()
+        for hp in self.instruments.values():
+            hp.timing.save()
+            hp.gpib_dev.close()
+        for bus in self.buses.values():
+            bus.close()
+
+
+def _options_argv(options):
+    """Turn a dict of sweep options into command line arguments"""
+    argv = []
+    for k, v in sorted(options.items()):
+        opt = "--" + k.replace("_", "-")
+        if (v is True):
+            argv.append(opt)
+        elif ((v is not False) and (v is not None)):
+            argv += [opt, str(v)]
+
+    return(argv)
+
+
+def station_main(argv):
+    """Sweep several HP 8903s at once, returns exit status
+
+    The configuration file is JSON: "sweep" holds options shared by all
+    instruments, "instruments" a list of options per instrument, each
+    with a "name". Options are those of the sweep command, e.g.
+      {"sweep": {"meas": "thd", "start": 20, "stop": 20000},
+       "instruments": [{"name": "left", "port": "/dev/ttyUSB0", "addr": 28},
+                       {"name": "right", "port": "/dev/ttyUSB1",
+                        "controller": "ni"}]}
+    Galvant instruments given the same port share the adapter."""
+    parser = argparse.ArgumentParser(prog = "hp8903.py station",
+                                     description = "Sweep several HP 8903s in parallel")
+    parser.add_argument("config", help = "Station configuration (JSON)")
+    parser.add_argument("--plot", action = "store_true",
+                        help = "Show live plots while sweeping")
+    args = parser.parse_args(argv)
+
+    with open(args.config) as fid:
+        config = json.load(fid)
+
+    stamp = datetime.now().strftime("%Y-%m-%d-%H%M%S")
+    sweep_parser = _sweep_parser("hp8903.py station", "Station instrument")
+    station = Station()
+    options = {}
+    journals = []
+    connected = False
+    # Connect everything first, instruments may share a controller
+    try:
+        for inst in config["instruments"]:
+            opts = dict(config.get("sweep", {}))
+            opts.update(inst)
+            name = str(opts.pop("name"))
+            if ("output" not in opts):
+                opts["output"] = "%s-%s.txt" % (stamp, name)
+
+            inst_args = sweep_parser.parse_args(_options_argv(opts))
+            setup = _sweep_setup(sweep_parser, inst_args)
+            if (not station.connect(name, inst_args.controller,
+                                    inst_args.port, inst_args.addr)):
+                return(1)
+            setup["points"] = _sweep_points(setup, station.instruments[name])
+
+            journal = None
+            if (inst_args.journal):
+                journal = SweepJournal(inst_args.journal,
+                                       setup["measurements"],
+                                       _metadata(station.instruments[name]),
+                                       sweep = setup)
+                journals.append(journal)
+            station.start(name, setup, journal = journal)
+            options[name] = inst_args
+        connected = True
+    finally:
+        if (not connected):
+            # Nothing was swept, let go of what was already opened
+            for journal in journals:
+                journal.close(aborted = True)
+            station.close()
+
+    station.run()
+    try:
+        if (args.plot):
+            # Only the plot window needs GTK and matplotlib
+            import hp8903_gui
+            hp8903_gui.station_window(station)
+        else:
+            while (station.running()):
+                for name, kind, data in station.poll():
+                    if (kind == "point"):
+                        i, x, m = data
+                        sys.stderr.write("%s %d/%d %g %g\n" % (name, len(station.results[name]),
+                                                               len(station.setups[name]["points"]),
+                                                               x, m.value))
+                    elif (kind == "error"):
+                        print("%s: sweep failed: %s" % (name, data))
+                time.sleep(0.05)
+    except KeyboardInterrupt:
+        print("Sweeps interrupted, saving what was measured")
+    finally:
+        station.close()
+
+    for name in station.names:
+        _save_results(options[name].output, options[name].archive,
+                      station.setups[name]["measurements"],
+                      station.results[name],
+                      _metadata(station.instruments[name]))
+
+    return(0)
+
+
+def main():
+    if ((len(sys.argv) > 1) and (sys.argv[1] == "sweep")):
+        sys.exit(sweep_main(sys.argv[2:]))
+    if ((len(sys.argv) > 1) and (sys.argv[1] == "station")):
+        sys.exit(station_main(sys.argv[2:]))
+
+    # Only the GUI needs GTK and matplotlib
+    import hp8903_gui
+    hp8903_gui.main()
+
 
 if __name__ == '__main__':
-    win = HP8903BWindow()
-    win.connect("delete-event", Gtk.main_quit)
-    win.show_all()
-    Gtk.main()
+    main()
@@ -0,0 +1,400 @@
+#!/usr/bin/python3
+
+# asyncio transports for the GPIB controllers, Python 3 only. Several
+# HP 8903s can be swept from one event loop, e.g. two emulators:
+#   python3 hp8903_async.py --instrument emulator --instrument emulator
+
+import os
+import sys
+import asyncio
+import serial
+from datetime import datetime
+
+from hp8903 import (HP8903, HP8903_controllers, LatencyRecorder,
+                    SweepJournal, _Steps, _averager, _clock, _metadata,
+                    _plan_index, _save_results, _sweep_parser, _sweep_points,
+                    _sweep_setup, _stability, load_timing)
+
+
+class AsyncTransport():
+    def __init__(self, dev):
+        """Non-blocking access to an open GPIBDevice's serial port
+
+        Create from a coroutine. Incoming bytes are collected by an event
+        loop reader, write(), read_until() and query() are awaitable and
+        never block the loop. Framing (++read, pending ++read_tmo_ms
+        etc.) is left to the device, so the Galvant and NI controllers
+        are both supported."""
+        self.dev = dev
+        self.loop = asyncio.get_running_loop()
+        self.fd = dev.ser.fileno()
+        os.set_blocking(self.fd, False)
+
+        # Anything the blocking reads had buffered
+        self.buffer = dev.buffer
+        dev.buffer = ''
+        self.error = None
+        # LatencyRecorder timing the read requests, see AsyncHP8903
+        self.latency = None
+        self.readable = asyncio.Event()
+        self.loop.add_reader(self.fd, self._on_readable)
+
+    @property
+    def generation(self):
+        return(self.dev.generation)
+
+    @property
+    def dev_name(self):
+        return(self.dev.dev_name)
+
+    @property
+    def gpib_addr(self):
+        return(self.dev.gpib_addr)
+
+    def _on_readable(self):
+        try:
+            data = os.read(self.fd, 4096)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            # Device gone, wake readers up to report it
+            self.error = e
+            data = b''
+        if ((not data) and (self.error is None)):
+            # Readable with nothing to read, the port hung up
+            self.error = EOFError("port closed")
+
+        if (self.error is not None):
+            # Stop being called back for the closed port
+            self.loop.remove_reader(self.fd)
+        self.buffer += data.decode('ascii', 'replace')
+        self.readable.set()
+
+    async def _send(self, data):
+        data = data.encode('ascii')
+        while (data):
+            try:
+                data = data[os.write(self.fd, data):]
+            except BlockingIOError:
+                # Port buffer full, wait for room
+                ready = self.loop.create_future()
+                self.loop.add_writer(self.fd, ready.set_result, None)
+                try:
+                    await ready
+                finally:
+                    self.loop.remove_writer(self.fd)
+
+    async def write(self, data, expect_reply = False):
+        """Send data, returns the number of bytes written (0 on failure)"""
+        data = self.dev._frame(data, expect_reply)
+        try:
+            await self._send(data)
+        except OSError as e:
+            print("%s failed write: %s" % (self.dev.name(), str(e)))
+            return(0)
+
+        return(len(data))
+
+    async def read_until(self, end_char = '\n', timeout = 500):
+        """Wait up to timeout (ms) for a reply ending in end_char
+
+        Returns (True, reply) or (False, None) on timeout. Raises
+        IOError if the device went away. Like the device's own read(),
+        the read is requested again when the controller gives up sooner
+        than timeout."""
+        deadline = self.loop.time() + timeout/1000.0
+        while True:
+            request = self.dev._read_request()
+            if (request):
+                start = _clock()
+                await self._send(request)
+                if (self.latency is not None):
+                    self.latency.add("request", _clock() - start)
+
+            remaining = deadline - self.loop.time()
+            wait = self.dev._read_wait(remaining)
+            status, msg = await self._buffered_read(end_char, wait)
+            if (status or (wait >= remaining)):
+                return((status, msg))
+
+    async def _buffered_read(self, end_char, timeout):
+        """Wait up to timeout (s) for a reply ending in end_char"""
+        deadline = self.loop.time() + timeout
+        while True:
+            i = self.buffer.find(end_char)
+            if (i >= 0):
+                msg = self.buffer[:i + len(end_char)]
+                self.buffer = self.buffer[i + len(end_char):]
+                return((True, msg))
+            if (self.error is not None):
+                raise IOError("%s: %s" % (self.dev.name(), str(self.error)))
+
+            remaining = deadline - self.loop.time()
+            if (remaining <= 0):
+                return((False, None))
+            self.readable.clear()
+            try:
+                await asyncio.wait_for(self.readable.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+
+    async def query(self, data, timeout = 500, end_char = '\n'):
+        """write() then read_until(), returns (status, reply)"""
+        if (not await self.write(data, expect_reply = True)):
+            return((False, None))
+
+        return(await self.read_until(end_char, timeout))
+
+    def flush_input(self):
+        self.buffer = ''
+        try:
+            while (os.read(self.fd, 4096)):
+                pass
+        except OSError:
+            pass
+
+    def set_read_timeout(self, timeout):
+        self.dev.set_read_timeout(timeout)
+
+    def name(self):
+        return(self.dev.name())
+
+    def close(self):
+        """Give the port back to the blocking device and close it"""
+        if (self.error is None):
+            self.loop.remove_reader(self.fd)
+        try:
+            os.set_blocking(self.fd, True)
+        except OSError:
+            pass
+        self.dev.buffer = self.buffer
+        self.dev.close()
+
+
+class AsyncHP8903():
+    def __init__(self, transport, timing = None, cache = None,
+                 averaging = None, stability = None):
+        """HP 8903 driver on an AsyncTransport
+
+        Measurements run HP8903's own protocol steps (codes, state,
+        cache, latency, averaging, settling detection and decoding),
+        only the I/O is awaited. The options are those of HP8903, self.hp
+        holds them."""
+        self.transport = transport
+        self.hp = HP8903(transport, timing = timing, cache = cache,
+                         averaging = averaging, stability = stability)
+
+    async def init(self):
+        """Check the HP 8903 responds to a simple measurement"""
+        self.hp.invalidate()
+        self.transport.flush_input()
+        status, meas = await self.transport.query("FR1000.0HZAP0.100E+00VLM1LNL0LNT2",
+                                                  timeout = 1500)
+        if (not status):
+            print("Failed to initialize HP8903!")
+            return(False)
+
+        print(meas.strip())
+        return(True)
+
+    def record_latency(self, latency):
+        """Time the phases of each point, see HP8903.record_latency"""
+        self.hp.latency = latency
+        self.transport.latency = latency
+
+    async def _run(self, steps):
+        """Run HP8903 protocol steps awaiting their I/O, returns the result"""
+        steps = _Steps(steps)
+        value = None
+        try:
+            while (True):
+                op = steps.send(value)
+                if (op[0] == "return"):
+                    return(op[1])
+                elif (op[0] == "write"):
+                    value = await self.transport.write(op[1],
+                                                       expect_reply = op[2])
+                elif (op[0] == "read"):
+                    value = await self.transport.read_until(timeout = op[1])
+                elif (op[0] == "sleep"):
+                    value = await asyncio.sleep(op[1])
+        finally:
+            steps.close()
+
+    async def send_measurement(self, meas, unit, freq, amp, filters, ratio = 0):
+        """Program the HP 8903, trigger and read a measurement
+
+        Like HP8903.send_measurement, returns a Measurement."""
+        return(await self._run(self.hp._measurement_steps(meas, unit, freq,
+                                                          amp, filters,
+                                                          ratio)))
+
+    async def reference(self, meas, units, freq, amp, filters):
+        """Set up ratio mode before a sweep, see HP8903.reference"""
+        return(await self._run(self.hp._reference_steps(meas, units, freq, amp,
+                                                        filters)))
+
+    async def sweep(self, meas, units, filters, points):
+        """Measure each (x, freq, amp) in points, or SweepPoint of a SweepPlan
+
+        Async generator yielding (index, x, Measurement) like
+        HP8903.sweep."""
+        for i, point in enumerate(points):
+            index = _plan_index(points, i)
+            m, timed = await self._run(self.hp._point_steps(meas, units,
+                                                            filters, point,
+                                                            index))
+            if (not timed):
+                yield((index, point[0], m))
+            else:
+                yielded = _clock()
+                yield((index, point[0], m))
+                self.hp.latency.add("consumer", _clock() - yielded)
+            self.hp.check_lost()
+
+
+async def connect_async(controller, port, addr):
+    """Open a controller and its HP 8903 for use from the event loop
+
+    Opening is blocking, so it runs in the default executor. Returns an
+    AsyncHP8903 or None on failure."""
+    loop = asyncio.get_running_loop()
+    dev = HP8903_controllers[controller](gpib_addr = addr)
+    opened = await loop.run_in_executor(None, dev.open, port)
+    if ((not opened) or (not await loop.run_in_executor(None, dev.test))):
+        print("Failed to open GPIB Device: %s at %s" % (dev.name(), port))
+        dev.close()
+        return(None)
+
+    hp = AsyncHP8903(AsyncTransport(dev),
+                     timing = load_timing(dev, port, addr))
+    if (not await hp.init()):
+        print("Failed to initialize HP 8903")
+        hp.transport.close()
+        return(None)
+
+    return(hp)
+
+
+async def _run_instrument(name, connection, setup, output, archive,
+                          journal = None, latency = False):
+    controller, port, addr = connection
+    hp = await connect_async(controller, port, addr)
+    if (hp is None):
+        return(False)
+    if (latency):
+        hp.record_latency(LatencyRecorder())
+    hp.hp.averaging = _averager(setup)
+    hp.hp.stability = _stability(setup)
+
+    metadata = _metadata(hp.hp)
+    # Setup is shared by all instruments
+    setup = dict(setup, points = _sweep_points(setup, hp.hp))
+    if (journal):
+        journal = SweepJournal(journal, setup["measurements"], metadata,
+                               sweep = setup)
+    results = []
+    npoints = len(setup["points"])
+    completed = False
+    try:
+        await hp.reference(setup["meas"], setup["units"], setup["ref_freq"],
+                           setup["ref_amp"], setup["filters"])
+        async for i, px, m in hp.sweep(setup["meas"], setup["units"],
+                                       setup["filters"], setup["points"]):
+            results.append((i, px, m))
+            if (journal):
+                journal.append(i, px, m)
+            sys.stderr.write("%s %d/%d %g %g\n" % (name, len(results), npoints,
+                                                   px, m.value))
+        completed = True
+    except (IOError, OSError, serial.SerialException) as e:
+        print("%s: sweep stopped: %s" % (name, str(e)))
+        if (journal):
+            print("%s: continue it with hp8903.py sweep --resume %s" %
+                  (name, journal.fname))
+    finally:
+        if (journal):
+            journal.close(aborted = not completed)
+        hp.hp.learn_transitions(setup["meas"], setup["points"], results)
+        hp.hp.timing.save()
+        hp.transport.close()
+
+    _save_results(output, archive, setup["measurements"], results, metadata,
+                  latency = hp.hp.latency)
+    if (hp.hp.latency is not None):
+        sys.stderr.write("\n".join("%s %s" % (name, line)
+                                   for line in hp.hp.latency.report()) + "\n")
+
+    return(True)
+
+
+def _connection(parser, spec, args):
+    """CONTROLLER[:PORT[:ADDR]] to (controller, port, addr)"""
+    fields = spec.split(":")
+    controller = fields[0]
+    port = args.port
+    addr = args.addr
+    if ((len(fields) > 1) and fields[1]):
+        port = fields[1]
+    if (len(fields) > 2):
+        try:
+            addr = int(fields[2])
+        except ValueError:
+            parser.error("Bad GPIB address in %s" % spec)
+    if (controller not in HP8903_controllers):
+        parser.error("Unknown controller in %s" % spec)
+    if ((port is None) and (controller != "emulator")):
+        parser.error("A port is required for %s" % spec)
+
+    return((controller, port, addr))
+
+
+def _output_name(output, n, count):
+    """Output file of the n-th instrument"""
+    if ((output == "-") or (count == 1)):
+        return(output)
+    if (output is None):
+        output = datetime.now().strftime("%Y-%m-%d-%H%M%S") + ".txt"
+
+    base, ext = os.path.splitext(output)
+    return("%s-%d%s" % (base, n, ext))
+
+
+async def _run_all(runs):
+    """Run the instruments' sweeps together, returns their results"""
+    return(await asyncio.gather(*runs))
+
+
+def main(argv = None):
+    parser = _sweep_parser("hp8903_async.py",
+                           "Run the same HP 8903 sweep on several instruments from one event loop")
+    parser.add_argument("--instrument", action = "append", default = [],
+                        help = "CONTROLLER[:PORT[:ADDR]] of an instrument, repeat for more (default: --controller/--port/--addr)")
+    args = parser.parse_args(argv)
+
+    if (args.instrument):
+        # Checked per instrument instead
+        args.controller = "emulator"
+    connections = [_connection(parser, spec, args) for spec in args.instrument]
+    setup = _sweep_setup(parser, args)
+    if (not connections):
+        connections = [(args.controller, args.port, args.addr)]
+    if (setup["native"] or setup["adaptive"]):
+        parser.error("--native and --adaptive sweeps aren't supported here")
+
+    count = len(connections)
+    runs = [_run_instrument("#%d" % n, c, setup,
+                            _output_name(args.output, n, count),
+                            args.archive and _output_name(args.archive, n, count),
+                            journal = (args.journal and
+                                       _output_name(args.journal, n, count)),
+                            latency = args.latency)
+            for n, c in enumerate(connections)]
+
+    ok = asyncio.run(_run_all(runs))
+
+    return(0 if all(ok) else 1)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,321 @@
+#!/usr/bin/python
+
+# Throughput benchmarks run against the HP 8903 emulator, results are
+# written as JSON so runs can be compared, e.g.:
+#   python hp8903_bench.py --sizes 10,100,1000 -o before.json
+#
+# transport    raw write/read round trips on each controller
+# sweep        HP8903.sweep (send_measurement) on each controller
+# plot         LivePlot append and redraw per point (needs matplotlib/GTK)
+# save         write_text and write_archive
+
+import os
+import sys
+import json
+import math
+import time
+import platform
+import argparse
+import resource
+import subprocess
+import tempfile
+import numpy as np
+from datetime import datetime
+
+from hp8903 import (HP8903, Galvant_GPIB_USB, Measurement, NI_GPIB_232CV_A,
+                    SweepPlan, _clock, write_archive, write_text)
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+# CPU time of this process (time.clock on Python 2)
+_cpu = getattr(time, 'process_time', None) or time.clock
+
+
+BENCH_SIZES = [10, 100, 1000, 10000]
+BENCH_NAMES = ["transport", "sweep", "plot", "save"]
+BENCH_CONTROLLERS = {"ni": NI_GPIB_232CV_A,
+                     "galvant": Galvant_GPIB_USB}
+# Emulator settling table, by default no settling so only the
+# controller, transport and host costs are measured
+BENCH_SETTLE = "20:0"
+
+
+class BenchEmulator():
+    def __init__(self, controller, settle = BENCH_SETTLE, baud = 0):
+        """HP 8903 emulator process behind one of BENCH_CONTROLLERS
+
+        baud paces the emulator's pty like a serial line, 0 doesn't."""
+        self.controller = controller
+        self.settle = settle
+        self.baud = baud
+        self.proc = None
+        self.dev = None
+
+    def open(self):
+        """Start the emulator, returns the open controller or None"""
+        emulator = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "hp8903_emulator.py")
+        cmd = [sys.executable, emulator, "--controller", self.controller,
+               "--settle", self.settle, "--seed", "1"]
+        if (self.baud):
+            cmd += ["--baud", str(self.baud)]
+        self.proc = subprocess.Popen(cmd, stdout = subprocess.PIPE)
+        pty_name = self.proc.stdout.readline().decode('ascii').strip()
+
+        self.dev = BENCH_CONTROLLERS[self.controller](gpib_addr = 0)
+        if ((not pty_name) or (not self.dev.open(pty_name)) or
+            (not self.dev.test())):
+            print("Failed to open %s on the emulator" % self.dev.name())
+            self.close()
+            return(None)
+
+        return(self.dev)
+
+    def close(self):
+        if (self.dev):
+            self.dev.close()
+            self.dev = None
+        if (self.proc):
+            self.proc.terminate()
+            self.proc.wait()
+            self.proc = None
+
+
+def _maxrss_kb():
+    """Peak resident memory of this process so far (kB)"""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if (sys.platform == "darwin"):
+        # Bytes on Mac OS X
+        rss = rss/1024
+    return(int(rss))
+
+
+def _measure(bench, controller, npoints, run, trace_memory = False):
+    """Time run(), which handles npoints points, returns a result dict
+
+    run returns how many points failed."""
+    if (trace_memory):
+        tracemalloc.start()
+    wall = _clock()
+    cpu = _cpu()
+
+    failed = run()
+
+    wall = _clock() - wall
+    cpu = _cpu() - cpu
+    result = {"bench": bench,
+              "controller": controller,
+              "points": npoints,
+              "failed": failed,
+              "seconds": wall,
+              "points_per_s": npoints/wall,
+              "cpu_ms_per_point": cpu*1e3/npoints,
+              "maxrss_kb": _maxrss_kb()}
+    if (trace_memory):
+        result["alloc_peak_kb"] = tracemalloc.get_traced_memory()[1]/1024.0
+        tracemalloc.stop()
+
+    return(result)
+
+
+def _freqs(npoints):
+    """npoints log spaced frequencies across the audio band"""
+    return(np.logspace(math.log10(20.0), math.log10(20000.0), npoints))
+
+
+def bench_transport(dev, npoints):
+    """Immediately triggered (T2) readings, controller round trips only"""
+    dev.write("FR1000.0HZAP0.100E+00VLM1LNL0LN")
+
+    def run():
+        failed = 0
+        for i in range(npoints):
+            dev.write("T2", expect_reply = True)
+            status, samp = dev.read(timeout = 1000)
+            if (not status):
+                failed += 1
+        return(failed)
+
+    return(run)
+
+
+def bench_sweep(hp, npoints):
+    """Full HP8903.sweep path, a new frequency each point"""
+    plan = SweepPlan.freqs(_freqs(npoints), 0.5)
+
+    def run():
+        failed = 0
+        for i, x, m in hp.sweep(0, 0, [False]*4, plan):
+            if (np.isnan(m.value)):
+                failed += 1
+        return(failed)
+
+    return(run)
+
+
+def _fake_points(npoints):
+    now = time.time()
+    return([(i, f, Measurement(f, 0.5, 0.001, "+01000E-06\r\n", None,
+                               "FR%.4EHZT3" % f, now))
+            for i, f in enumerate(_freqs(npoints))])
+
+
+def bench_plot(npoints):
+    """LivePlot with a redraw after every point, the worst case"""
+    # Only the GUI module needs GTK
+    import hp8903_gui
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    f = Figure(figsize = (5, 4), dpi = 100)
+    a = f.add_subplot(111)
+    a.set_xscale('log')
+    a.set_xlim((20.0, 20000.0))
+    plot = hp8903_gui.LivePlot(a, FigureCanvasAgg(f))
+    points = _fake_points(npoints)
+
+    def run():
+        for i, x, m in points:
+            plot.append(x, m.value, index = i)
+            plot.redraw()
+        return(0)
+
+    return(run)
+
+
+def bench_save(npoints):
+    """Text file and binary archive of a sweep"""
+    measurements = [0.5, [False]*4, 0, 0, "THD+n (%)", "%"]
+    points = _fake_points(npoints)
+    tmp = tempfile.mkdtemp()
+
+    def run():
+        fname = os.path.join(tmp, "bench")
+        with open(fname + ".txt", 'w') as fid:
+            write_text(fid, measurements, [p[1] for p in points],
+                       [p[2].value for p in points])
+        write_archive(fname + ".hp8903", measurements, points)
+        os.remove(fname + ".txt")
+        os.remove(fname + ".hp8903")
+        return(0)
+
+    return(run)
+
+
+def run_benchmarks(sizes, controllers, benches, settle = BENCH_SETTLE,
+                   baud = 0, trace_memory = False):
+    """Run the benchmarks, returns a list of result dicts
+
+    Benchmarks that can't run here are listed with a skipped reason."""
+    results = []
+
+    def report(r):
+        results.append(r)
+        if ("skipped" in r):
+            sys.stderr.write("%-9s %-8s skipped: %s\n" %
+                             (r["bench"], r["controller"], r["skipped"]))
+        else:
+            sys.stderr.write("%-9s %-8s %6d points %9.1f points/s %8.3f ms CPU/point\n" %
+                             (r["bench"], r["controller"], r["points"],
+                              r["points_per_s"], r["cpu_ms_per_point"]))
+
+    for controller in controllers:
+        if (("transport" not in benches) and ("sweep" not in benches)):
+            break
+        emulator = BenchEmulator(controller, settle = settle, baud = baud)
+        dev = emulator.open()
+        if (dev is None):
+            report({"bench": "transport", "controller": controller,
+                    "skipped": "emulator failed to start"})
+            continue
+
+        try:
+            hp = HP8903(dev)
+            for n in sizes:
+                if ("transport" in benches):
+                    report(_measure("transport", controller, n,
+                                    bench_transport(dev, n), trace_memory))
+                if ("sweep" in benches):
+                    hp.invalidate()
+                    report(_measure("sweep", controller, n,
+                                    bench_sweep(hp, n), trace_memory))
+        finally:
+            emulator.close()
+
+    for n in sizes:
+        if ("plot" in benches):
+            try:
+                run = bench_plot(n)
+            except (ImportError, ValueError) as e:
+                report({"bench": "plot", "controller": None,
+                        "skipped": str(e)})
+                benches = [b for b in benches if (b != "plot")]
+            else:
+                report(_measure("plot", None, n, run, trace_memory))
+        if ("save" in benches):
+            report(_measure("save", None, n, bench_save(n), trace_memory))
+
+    return(results)
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(prog = "hp8903_bench.py",
+                                     description = "Throughput benchmarks against the HP 8903 emulator")
+    parser.add_argument("--sizes", default = ",".join(str(n) for n in BENCH_SIZES),
+                        help = "Comma separated sweep sizes (points)")
+    parser.add_argument("--controllers", default = "ni,galvant",
+                        help = "Comma separated controllers (%s)" %
+                        ", ".join(sorted(BENCH_CONTROLLERS)))
+    parser.add_argument("--bench", default = ",".join(BENCH_NAMES),
+                        help = "Comma separated benchmarks (%s)" %
+                        ", ".join(BENCH_NAMES))
+    parser.add_argument("--settle", default = BENCH_SETTLE,
+                        help = "Emulator settling table, freq:ms,freq:ms,...")
+    parser.add_argument("--baud", type = int, default = 0,
+                        help = "Pace the emulator like a serial line at this baud rate (default: no pacing)")
+    parser.add_argument("--trace-memory", action = "store_true",
+                        help = "Also report peak Python allocations (slows the benchmarks down)")
+    parser.add_argument("-o", "--output", default = None,
+                        help = "JSON output file (default: bench-timestamp.json)")
+    args = parser.parse_args(argv)
+
+    try:
+        sizes = [int(n) for n in args.sizes.split(",")]
+    except ValueError:
+        parser.error("--sizes must be a comma separated list of integers")
+    controllers = args.controllers.split(",")
+    for c in controllers:
+        if (c not in BENCH_CONTROLLERS):
+            parser.error("Unknown controller: %s" % c)
+    benches = args.bench.split(",")
+    for b in benches:
+        if (b not in BENCH_NAMES):
+            parser.error("Unknown benchmark: %s" % b)
+    if (args.trace_memory and (tracemalloc is None)):
+        parser.error("--trace-memory needs Python 3")
+
+    results = run_benchmarks(sizes, controllers, benches,
+                             settle = args.settle, baud = args.baud,
+                             trace_memory = args.trace_memory)
+
+    output = args.output
+    if (output is None):
+        output = datetime.now().strftime("bench-%Y-%m-%d-%H%M%S.json")
+    with open(output, 'w') as fid:
+        json.dump({"created": time.time(),
+                   "python": platform.python_version(),
+                   "platform": platform.platform(),
+                   "numpy": np.__version__,
+                   "settle": args.settle,
+                   "baud": args.baud,
+                   "results": results}, fid, indent = 1)
+    print("Saved %s" % output)
+
+    return(0)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
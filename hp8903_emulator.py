@@ -0,0 +1,560 @@
+#!/usr/bin/python
+
+# HP 8903 Audio Analyzer emulator
+#
+# Creates a pseudo-terminal and answers on it like an HP 8903 sitting
+# behind either a Galvant GPIB USB adapter or a NI GPIB-232CV-A. This
+# allows the acquisition software (and anything timing related) to be
+# exercised without an analyzer on the bench.
+#
+# Run standalone and point hp8903 at the printed device name, e.g.:
+#   python hp8903_emulator.py --controller galvant --settle 20:900,1000:80
+#
+# --baud paces traffic like a serial line of that speed (benchmarks).
+#
+# The first line printed on stdout is always the pty device name.
+#
+# Linux/Mac OS X only (needs a pty).
+
+import os
+import sys
+import re
+import math
+import time
+import heapq
+import random
+import select
+import argparse
+
+try:
+    import tty
+except ImportError:
+    tty = None
+
+
+# Default physical settling time (ms) at a few frequencies. Anything in
+# between is interpolated on a log frequency axis.
+DEFAULT_SETTLE = [(20.0, 900.0),
+                  (100.0, 300.0),
+                  (1000.0, 80.0),
+                  (10000.0, 40.0),
+                  (100000.0, 30.0)]
+
+# Instrument limits
+FREQ_MIN = 20.0
+FREQ_MAX = 100000.0
+AMP_MIN = 0.0006
+AMP_MAX = 6.0
+
+# Galvant adapter default read timeout
+GALVANT_READ_TMO_MS = 1000
+
+# Most points in one instrument sweep
+MAX_SWEEP_POINTS = 255
+
+_number = r'([-+]?(?:[0-9]+\.?[0-9]*|\.[0-9]+)(?:E[-+]?[0-9]+)?)'
+
+# Entry codes take a number and a unit suffix
+_entry_re = re.compile(r'(FR|FA|FB|AP|ST)\s*' + _number + r'\s*(HZ|KZ|MZ|VL|MV|UV|EN)')
+# Could the buffer still grow into a valid entry code?
+_entry_partial_re = re.compile(r'(FR|FA|FB|AP|ST)\s*[-+0-9.E]*\s*[HKMVUE]?$')
+_code_re = re.compile(r'M[1-3]|S[1-3]|L[0-2]|LN|LG|H[0-2]|R[01]|T[0-3]|W[01]')
+
+_freq_units = {'HZ': 1.0, 'KZ': 1.0e3, 'MZ': 1.0e6}
+_amp_units = {'VL': 1.0, 'MV': 1.0e-3, 'UV': 1.0e-6}
+
+
+def parse_settle(s):
+    """Parse "freq:ms,freq:ms,..." into a sorted settle table"""
+    table = []
+    for item in s.split(','):
+        f, ms = item.split(':')
+        table.append((float(f), float(ms)))
+
+    table.sort()
+    return(table)
+
+
+def format_reading(value):
+    """Format a value like the HP 8903 does (e.g. +00262E-07)"""
+    if (value == 0.0):
+        return("+00000E+00")
+
+    sign = '+'
+    if (value < 0.0):
+        sign = '-'
+        value = -value
+
+    # 4 significant digits in a 5 digit mantissa
+    exp = int(math.floor(math.log10(value))) - 3
+    mant = int(round(value/10.0**exp))
+    if (mant >= 10000):
+        mant = int(round(mant/10.0))
+        exp += 1
+
+    return("%s%05dE%+03d" % (sign, mant, exp))
+
+
+def format_error(code):
+    """Error codes are sent as a reading larger than 4e9 (e.g. +90024E+09)"""
+    return("+900%02dE+09" % code)
+
+
+class HP8903Emulator(object):
+    def __init__(self, settle = None, t3_margin = 2.0, noise = 0.002,
+                 error_rate = 0.0):
+        """Emulated HP 8903 measurement state
+
+        settle is a list of (frequency Hz, settling ms) pairs, t3_margin
+        scales the physical settling to the fixed delay applied by T3."""
+        if (settle is None):
+            settle = DEFAULT_SETTLE
+        self.settle_table = sorted(settle)
+        self.t3_margin = t3_margin
+        self.noise = noise
+        self.error_rate = error_rate
+
+        self.reset()
+
+    def reset(self):
+        """Power-on state"""
+        self.freq = 1000.0
+        self.amp = 0.1
+        self.meas = 'M1'
+        self.log = False
+        self.lp = 'L0'
+        self.hp = 'H0'
+        self.ratio = None
+        self.trigger = 'T0'
+        self.error = None
+        self.changed = time.time()
+        # Time a triggered reading becomes available
+        self.ready = None
+        # Sweep setup and (freq, ready time) of points still to be output
+        self.sweep_start = 20.0
+        self.sweep_stop = 20000.0
+        self.sweep_step = 10.0
+        self.sweep_points = []
+
+    def settle_time(self, freq = None):
+        """Physical settling time in seconds at freq"""
+        if (freq is None):
+            freq = self.freq
+
+        table = self.settle_table
+        if (freq <= table[0][0]):
+            return(table[0][1]/1000.0)
+        if (freq >= table[-1][0]):
+            return(table[-1][1]/1000.0)
+
+        for (f0, s0), (f1, s1) in zip(table[:-1], table[1:]):
+            if (f0 <= freq <= f1):
+                frac = math.log10(freq/f0)/math.log10(f1/f0)
+                return((s0 + frac*(s1 - s0))/1000.0)
+
+    def _changed(self):
+        self.changed = time.time()
+
+    def feed(self, text, final = False):
+        """Consume HP-IB codes, returns unparsed remainder
+
+        If final is set the remainder is treated as an invalid code."""
+        text = text.upper()
+        while (True):
+            text = text.lstrip(" \t\r\n;,")
+            if (len(text) == 0):
+                break
+
+            m = _entry_re.match(text)
+            if (m):
+                self._entry(m.group(1), float(m.group(2)), m.group(3))
+                text = text[m.end():]
+                continue
+
+            if ((not final) and _entry_partial_re.match(text)):
+                # Wait for the rest of the entry
+                break
+
+            if (len(text) < 2):
+                if (not final):
+                    break
+                self.error = 24
+                text = ''
+                break
+
+            m = _code_re.match(text)
+            if (m):
+                self._code(m.group(0))
+            else:
+                self.error = 24
+            text = text[2:]
+
+        return(text)
+
+    def _entry(self, code, value, unit):
+        if (code in ('FA', 'FB')):
+            freq = value*_freq_units.get(unit, 1.0)
+            if ((freq < FREQ_MIN) or (freq > FREQ_MAX)):
+                self.error = 20
+            elif (code == 'FA'):
+                self.sweep_start = freq
+            else:
+                self.sweep_stop = freq
+        elif (code == 'ST'):
+            if (value < 1.0):
+                self.error = 20
+            else:
+                self.sweep_step = value
+        elif (code == 'FR'):
+            freq = value*_freq_units.get(unit, 1.0)
+            if ((freq < FREQ_MIN) or (freq > FREQ_MAX)):
+                self.error = 18
+                return
+            if (freq != self.freq):
+                self.freq = freq
+                self._changed()
+        elif (code == 'AP'):
+            amp = value*_amp_units.get(unit, 1.0)
+            if ((amp < AMP_MIN) or (amp > AMP_MAX)):
+                self.error = 20
+                return
+            if (amp != self.amp):
+                self.amp = amp
+                self._changed()
+
+    def _code(self, code):
+        if (code[0] in 'MS'):
+            if (code != self.meas):
+                self.meas = code
+                # Ratio is cleared by a measurement change
+                self.ratio = None
+                self._changed()
+        elif (code in ('LN', 'LG')):
+            self.log = (code == 'LG')
+        elif (code[0] == 'L'):
+            if (code != self.lp):
+                self.lp = code
+                self._changed()
+        elif (code[0] == 'H'):
+            if (code != self.hp):
+                self.hp = code
+                self._changed()
+        elif (code == 'R1'):
+            if (self.meas not in ('M1', 'M3')):
+                self.error = 26
+            else:
+                self.ratio = self.settled_value()
+        elif (code == 'R0'):
+            self.ratio = None
+        elif (code == 'W1'):
+            self.start_sweep()
+        elif (code == 'W0'):
+            self.sweep_points = []
+        elif (code[0] == 'T'):
+            self.trigger = code
+            now = time.time()
+            if (code == 'T3'):
+                self.ready = now + self.settle_time()*self.t3_margin
+            elif (code == 'T2'):
+                self.ready = now
+            else:
+                self.ready = None
+
+    def start_sweep(self):
+        """Log sweep from sweep_start to sweep_stop, sweep_step points per decade"""
+        decs = math.log10(self.sweep_stop/self.sweep_start)
+        # Allow for rounding of the entered frequencies
+        npoints = int(math.floor(decs*self.sweep_step + 1.0e-3)) + 1
+        if (npoints > MAX_SWEEP_POINTS):
+            self.error = 32
+            return
+
+        t = time.time()
+        self.sweep_points = []
+        for n in range(npoints):
+            freq = self.sweep_start*10.0**(n/self.sweep_step)
+            t += self.settle_time(freq)*self.t3_margin
+            self.sweep_points.append((freq, t))
+
+    def next_sweep_reading(self):
+        """(ready time, reading) of the next swept point"""
+        freq, ready = self.sweep_points.pop(0)
+        self.freq = freq
+        self.changed = ready - self.settle_time()*self.t3_margin
+        return((ready, self.reading(ready)))
+
+    def settled_value(self):
+        """Fully settled linear reading for the present state"""
+        if (self.meas == 'M1'):
+            # Unity gain DUT
+            return(self.amp)
+        elif (self.meas == 'M3'):
+            # Residual distortion rises at the band edges, noise at low level
+            dist = 1.0e-5*(1.0 + (50.0/self.freq)**2 + (self.freq/40000.0)**2)
+            noise = 2.0e-6/self.amp
+            if (self.lp == 'L1'):
+                noise *= 0.6
+            elif (self.lp == 'L2'):
+                noise *= 0.8
+            return(100.0*math.sqrt(dist**2 + noise**2))
+        else:
+            # SINAD / DC level, not really modelled
+            return(self.amp)
+
+    def value(self, now = None):
+        """Reading at time now including settling transient and noise"""
+        if (now is None):
+            now = time.time()
+
+        v = self.settled_value()
+        tau = self.settle_time()/5.0
+        dt = now - self.changed
+        if (dt < 0.0):
+            dt = 0.0
+        if (tau > 0.0):
+            # Zero settling (--settle 20:0) has no transient
+            v *= (1.0 + 0.5*math.exp(-dt/tau))
+        v *= (1.0 + random.gauss(0.0, self.noise))
+
+        if (self.ratio):
+            v = 100.0*v/self.ratio
+
+        if (self.log):
+            if (self.ratio):
+                v = 20.0*math.log10(v/100.0)
+            elif (self.meas == 'M1'):
+                # dBm in 600 ohms
+                v = 20.0*math.log10(v/0.7746)
+            else:
+                v = 20.0*math.log10(v/100.0)
+
+        return(v)
+
+    def reading(self, now = None):
+        """Formatted reading (with CR LF) or error code"""
+        if ((self.error is None) and (random.random() < self.error_rate)):
+            self.error = 31
+
+        if (self.error is not None):
+            code = self.error
+            self.error = None
+            return(format_error(code) + "\r\n")
+
+        if ((self.meas == 'M3') and (self.amp < 0.05)):
+            return(format_error(96) + "\r\n")
+
+        return(format_reading(self.value(now)) + "\r\n")
+
+
+class EmulatorServer(object):
+    def __init__(self, fd, controller = 'galvant', instruments = None,
+                 baud = 0):
+        """Serve emulated instruments on fd
+
+        instruments maps GPIB address to HP8903Emulator, an address of
+        None answers on any address. baud paces traffic both ways like
+        a serial line (10 bits per character), 0 doesn't."""
+        self.fd = fd
+        self.controller = controller
+        self.baud = baud
+        if (instruments is None):
+            instruments = {None: HP8903Emulator()}
+        self.instruments = instruments
+
+        self.addr = 0
+        self.auto = False
+        self.read_tmo = GALVANT_READ_TMO_MS/1000.0
+        self.eos = 0
+
+        self.inbuf = ''
+        self.events = []
+        self.seq = 0
+
+    def instrument(self, addr = None):
+        if (addr is None):
+            addr = self.addr
+        if (addr in self.instruments):
+            return(self.instruments[addr])
+        return(self.instruments.get(None))
+
+    def schedule(self, when, text):
+        self.seq += 1
+        heapq.heappush(self.events, (when, self.seq, text))
+
+    def send(self, text):
+        self.pace(len(text))
+        os.write(self.fd, text.encode('ascii'))
+
+    def pace(self, nbytes):
+        """Wait as long as nbytes take on the line"""
+        if (self.baud):
+            time.sleep(nbytes*10.0/self.baud)
+
+    def serve_forever(self):
+        while (True):
+            timeout = None
+            if (self.events):
+                timeout = max(0.0, self.events[0][0] - time.time())
+
+            r, w, x = select.select([self.fd], [], [], timeout)
+            if (r):
+                try:
+                    data = os.read(self.fd, 4096)
+                except OSError:
+                    # Other end closed
+                    return
+                if (not data):
+                    return
+                self.pace(len(data))
+                self.handle(data.decode('ascii', 'replace'))
+
+            now = time.time()
+            while (self.events and (self.events[0][0] <= now)):
+                when, seq, text = heapq.heappop(self.events)
+                self.send(text)
+
+    def handle(self, data):
+        if (self.controller == 'galvant'):
+            self.inbuf += data
+            while ('\n' in self.inbuf):
+                line, self.inbuf = self.inbuf.split('\n', 1)
+                line = line.strip('\r')
+                if (line.startswith('++')):
+                    self.galvant_command(line[2:].split())
+                elif (line.strip()):
+                    inst = self.instrument()
+                    if (inst is not None):
+                        inst.feed(line, final = True)
+                        if (self.auto):
+                            self.galvant_read()
+        else:
+            # NI GPIB-232CV-A passes characters straight through, the
+            # address is set by dip switch so any instrument will do.
+            inst = self.instrument()
+            if (inst is None):
+                inst = list(self.instruments.values())[0]
+            self.inbuf = inst.feed(self.inbuf + data)
+            while (inst.sweep_points):
+                ready, text = inst.next_sweep_reading()
+                self.schedule(ready, text)
+            if (inst.ready is not None):
+                self.schedule(inst.ready, inst.reading(inst.ready))
+                inst.ready = None
+
+    def galvant_read(self):
+        inst = self.instrument()
+        if (inst is None):
+            # Nobody listening, adapter times out silently
+            return
+
+        now = time.time()
+        if (inst.sweep_points):
+            ready, text = inst.next_sweep_reading()
+            self.schedule(max(now, ready), text)
+            return
+
+        when = now
+        if (inst.ready is not None):
+            when = max(now, inst.ready)
+        if ((when - now) > self.read_tmo):
+            # Adapter gives up, the instrument keeps its reading for
+            # the next ++read
+            return
+
+        if (inst.trigger == 'T3'):
+            inst.ready = None
+        self.schedule(when, inst.reading(when))
+
+    def galvant_command(self, args):
+        if (len(args) == 0):
+            return
+
+        cmd = args[0].lower()
+        if (cmd == 'ver'):
+            self.send("Version 5 (HP 8903 emulator)\r\n")
+        elif (cmd == 'read'):
+            self.galvant_read()
+        elif (cmd == 'addr'):
+            if (len(args) > 1):
+                self.addr = int(args[1])
+            else:
+                self.send("%d\r\n" % self.addr)
+        elif (cmd == 'auto'):
+            if (len(args) > 1):
+                self.auto = (args[1] == '1')
+            else:
+                self.send("%d\r\n" % int(self.auto))
+        elif (cmd == 'read_tmo_ms'):
+            if (len(args) > 1):
+                self.read_tmo = int(args[1])/1000.0
+        elif (cmd == 'eos'):
+            if (len(args) > 1):
+                self.eos = int(args[1])
+        elif (cmd == 'clr'):
+            inst = self.instrument()
+            if (inst is not None):
+                inst.reset()
+        elif (cmd == 'ifc'):
+            # Interface clear drops pending output
+            self.events = []
+        # ++llo, ++loc, ++debug, ... need no emulation
+
+
+def open_pty():
+    """Open a raw pty, returns (master fd, slave device name)"""
+    master, slave = os.openpty()
+    if (tty is not None):
+        tty.setraw(slave)
+    name = os.ttyname(slave)
+    # Keep slave open so the pty survives clients reconnecting
+    return(master, slave, name)
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "HP 8903 emulator on a pty")
+    parser.add_argument('--controller', choices = ['galvant', 'ni'],
+                        default = 'galvant',
+                        help = "GPIB controller to emulate")
+    parser.add_argument('--addr', type = int, action = 'append',
+                        help = "GPIB address of an emulated instrument, may be repeated (default: answer any address)")
+    parser.add_argument('--settle', type = parse_settle, default = None,
+                        help = "Settling time table, freq:ms,freq:ms,...")
+    parser.add_argument('--t3-margin', type = float, default = 2.0,
+                        help = "T3 settling delay as a multiple of physical settling")
+    parser.add_argument('--noise', type = float, default = 0.002,
+                        help = "Relative reading noise")
+    parser.add_argument('--error-rate', type = float, default = 0.0,
+                        help = "Probability of a reading returning error 31")
+    parser.add_argument('--seed', type = int, default = None)
+    parser.add_argument('--baud', type = int, default = 0,
+                        help = "Pace traffic like a serial line at this baud rate (default: no pacing)")
+    args = parser.parse_args()
+
+    if (args.seed is not None):
+        random.seed(args.seed)
+
+    def make():
+        return(HP8903Emulator(settle = args.settle,
+                              t3_margin = args.t3_margin,
+                              noise = args.noise,
+                              error_rate = args.error_rate))
+
+    if (args.addr):
+        instruments = dict((a, make()) for a in args.addr)
+    else:
+        instruments = {None: make()}
+
+    master, slave, name = open_pty()
+    print(name)
+    sys.stdout.flush()
+
+    server = EmulatorServer(master, controller = args.controller,
+                            instruments = instruments, baud = args.baud)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,1369 @@
+#!/usr/bin/python
+
+# GTK user interface for hp8903, start with "python hp8903.py"
+
+from gi.repository import Gtk, GObject
+
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_gtk3agg import FigureCanvasGTK3Agg as FigureCanvas
+from matplotlib.backends.backend_gtk3 import NavigationToolbar2GTK3 as NavigationToolbar
+
+import serial.tools.list_ports as list_ports
+
+import bisect
+from datetime import datetime
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from hp8903 import (ADAPTIVE_COARSE_PER_DECADE, ADAPTIVE_TOLERANCE_DB,
+                    AVERAGE_MAX_READS, AVERAGE_TARGET, Averager,
+                    HP8903, HP8903_GPIB_devices, LATENCY_BINS, LATENCY_PHASES,
+                    LatencyRecorder, MeasurementCache, STABLE_TOLERANCE,
+                    StabilityDetector, SweepJournal, SweepPlan, SweepWorker,
+                    _clock, _sweep_points, load_timing, plan_order,
+                    resume_setup, write_archive, write_text)
+
+
+UI_INFO = """
+<ui>
+  <menubar name='MenuBar'>
+    <menu action='FileMenu'>
+      <menuitem action='FileSave' />
+      <menuitem action='FileResume' />
+      <menuitem action='ForgetCache' />
+    <separator />
+      <menuitem action='FileQuit' />
+    </menu>
+    <menu action='ViewMenu'>
+      <menuitem action='ViewLatency' />
+    </menu>
+  </menubar>
+</ui>
+"""
+
+
+# Live plot redraws per second during a sweep
+PLOT_FPS = 10
+
+
+class LivePlot():
+    def __init__(self, axes, canvas, fps = PLOT_FPS):
+        """Sweep plot that redraws at most fps times a second
+
+        Points are added with append() and drawn from a GObject timer.
+        Y limits follow the data incrementally, while they don't change
+        only the lines are redrawn (blitted) over a saved background.
+        There is one line (key None) unless more are added with
+        add_line()."""
+        self.axes = axes
+        self.canvas = canvas
+        self.fps = fps
+        # key -> Line2D, in order added
+        self.lines = {}
+        self.keys = []
+        self.data = {}
+        self.order = {}
+        self.background = None
+        self.timer = None
+        # LatencyRecorder redraw times are added to, if any
+        self.latency = None
+
+        self.add_line(None)
+        self.canvas.mpl_connect('draw_event', self._on_draw)
+        self.reset()
+
+    def add_line(self, key, label = None):
+        """Add another line, points go to it with append(x, y, key)"""
+        line = self.axes.plot([], [], marker = 'x', label = label)[0]
+        # Lines are drawn by us on top of the background
+        line.set_animated(True)
+        self.lines[key] = line
+        self.keys.append(key)
+        self.data[key] = ([], [])
+        self.order[key] = []
+        self.background = None
+
+    def reset(self):
+        """Forget all points"""
+        self.data = dict((k, ([], [])) for k in self.keys)
+        self.order = dict((k, []) for k in self.keys)
+        self.ymin = None
+        self.ymax = None
+        self.dirty = False
+        self.limits_changed = False
+        for line in self.lines.values():
+            line.set_data([], [])
+
+    def start(self):
+        """Start redrawing on a timer"""
+        if (self.timer is None):
+            self.timer = GObject.timeout_add(int(1000/self.fps), self._tick)
+
+    def stop(self):
+        """Stop the timer and draw whatever is pending"""
+        if (self.timer is not None):
+            GObject.source_remove(self.timer)
+            self.timer = None
+        self.redraw()
+
+    def append(self, x, y, key = None, index = None):
+        """Add a point, it shows up on the next frame
+
+        index is the point's place in the plan, points measured out of
+        order are put back in it."""
+        xs, ys = self.data[key]
+        order = self.order[key]
+        if (index is None):
+            index = len(order)
+        n = bisect.bisect(order, index)
+        order.insert(n, index)
+        xs.insert(n, x)
+        ys.insert(n, y)
+        self.dirty = True
+
+        # NaN marks a failed point
+        if (y != y):
+            return
+
+        first = (self.ymin is None)
+        if (first or (y < self.ymin)):
+            self.ymin = y
+        if (first or (y > self.ymax)):
+            self.ymax = y
+
+        lo, hi = self.axes.get_ylim()
+        if ((self.ymin < lo) or (self.ymax > hi) or first):
+            self.limits_changed = True
+
+    def _tick(self):
+        self.redraw()
+        return(True)
+
+    def _draw_lines(self):
+        for key in self.keys:
+            self.axes.draw_artist(self.lines[key])
+
+    def redraw(self):
+        """Draw pending points"""
+        if (not self.dirty):
+            return
+
+        if (self.latency is None):
+            self._redraw()
+        else:
+            start = _clock()
+            self._redraw()
+            self.latency.sample("plot", _clock() - start)
+
+    def _redraw(self):
+        self.dirty = False
+        for key in self.keys:
+            self.lines[key].set_data(*self.data[key])
+
+        if (self.limits_changed and (self.ymin is not None)):
+            self.limits_changed = False
+            sep = abs(self.ymax - self.ymin)/10.0
+            if (sep == 0.0):
+                sep = 0.01
+            # Extra room so a trend doesn't change the limits every point
+            self.axes.set_ylim((self.ymin - 2.0*sep, self.ymax + 2.0*sep))
+            self.background = None
+
+        if ((self.background is None) or
+            (not hasattr(self.canvas, 'copy_from_bbox'))):
+            # Full redraw, _on_draw saves the new background
+            self.canvas.draw()
+        else:
+            # One restore and blit per frame, however many lines
+            self.canvas.restore_region(self.background)
+            self._draw_lines()
+            self.canvas.blit(self.axes.bbox)
+
+    def _on_draw(self, event):
+        if (hasattr(self.canvas, 'copy_from_bbox')):
+            self.background = self.canvas.copy_from_bbox(self.axes.bbox)
+        self._draw_lines()
+
+
+class HP8903BWindow(Gtk.Window):
+    def __init__(self):
+        Gtk.Window.__init__(self, title="HP 8903B Control")
+
+        # Serial connection!
+        self.ser = None
+        self.gpib_dev = None
+        self.hp = None
+        self.timing = None
+        self.worker = None
+        self.journal_name = None
+        self.resumed = 0
+        # Readings reused by re-run sweeps when enabled
+        self.cache = MeasurementCache()
+        # Phase timings of the last sweep, when recorded
+        self.latency = None
+        self.devices = list_ports.comports()
+        
+        # Menu Bar junk!
+        action_group = Gtk.ActionGroup("my_actions")
+        action_filemenu = Gtk.Action("FileMenu", "File", None, None)
+        action_group.add_action(action_filemenu)
+        self.action_filesave = Gtk.Action("FileSave", "Save Data", None, None)
+        
+        action_filequit = Gtk.Action("FileQuit", None, None, Gtk.STOCK_QUIT)
+        action_filequit.connect("activate", self.on_menu_file_quit)
+        # Device under test changed, cached readings no longer apply
+        action_forget = Gtk.Action("ForgetCache", "Forget Cached Readings",
+                                   None, None)
+        action_forget.connect("activate", self.forget_cache)
+        self.action_resume = Gtk.Action("FileResume", "Resume Sweep...",
+                                        None, None)
+        self.action_resume.connect("activate", self.resume_sweep)
+        action_group.add_action(self.action_filesave)
+        action_group.add_action(self.action_resume)
+        action_group.add_action(action_forget)
+        action_group.add_action(action_filequit)
+        action_group.add_action(Gtk.Action("ViewMenu", "View", None, None))
+        action_latency = Gtk.Action("ViewLatency", "Latency...", None, None)
+        action_latency.connect("activate", self.show_latency)
+        action_group.add_action(action_latency)
+        self.action_filesave.set_sensitive(False)
+        self.action_filesave.connect('activate', self.save_data)
+
+        
+        uimanager = self.create_ui_manager()
+        uimanager.insert_action_group(action_group)
+
+        menubar = uimanager.get_widget("/MenuBar")
+
+        self.status_bar = Gtk.Statusbar()
+        self.status_bar.push(0, "HP 8903 Audio Analyzer Control")
+        
+        self.master_vbox = Gtk.Box(False, spacing = 2, orientation = 'vertical')
+        self.master_vbox.pack_start(menubar, False, False, 0)
+        master_hsep = Gtk.HSeparator()
+        self.master_vbox.pack_start(master_hsep, False, False, 0)
+        self.add(self.master_vbox)
+
+        self.hbox = Gtk.Box(spacing = 2)
+        self.master_vbox.pack_start(self.hbox, True, True, 0)
+
+        self.master_vbox.pack_start(self.status_bar, False, False, 0)
+
+        # Begin controls
+        bframe = Gtk.Frame(label = "Control")
+        left_vbox = Gtk.Box(spacing = 2, orientation = 'vertical')
+        self.box = Gtk.Box(spacing = 2)
+
+        bframe.add(left_vbox)
+
+        # GPIB device selector
+        gpib_frame = Gtk.Frame(label = "GPIB Communication Device")
+        self.gpib_big_box = Gtk.Box(spacing = 2)
+        gpib_frame.add(self.gpib_big_box)
+        self.gpib_box = Gtk.Box(spacing = 2)
+        self.gpib_vbox = Gtk.Box(spacing = 2, orientation = 'vertical')
+        gpib_label = Gtk.Label("GPIB Device: ")
+        self.gpib_box.pack_start(gpib_label, False, False, 0)
+
+        gpib_store = Gtk.ListStore(int, str)
+        for n, g_dev in enumerate(HP8903_GPIB_devices):
+            gpib_store.append([n, g_dev[1]])
+        self.gpib_combo = Gtk.ComboBox.new_with_model_and_entry(gpib_store)
+        self.gpib_combo.set_entry_text_column(1)
+        self.gpib_combo.set_active(0)
+
+        self.gpib_box.pack_start(self.gpib_combo, False, False, 0)
+
+        gpib_addr_box = Gtk.Box(spacing = 2)
+
+        self.gpib_addr = Gtk.SpinButton()
+        self.gpib_addr.set_range(0, 30)
+        self.gpib_addr.set_digits(0)
+        self.gpib_addr.set_value(0)
+        self.gpib_addr.set_increments(1.0, 1.0)
+
+
+        gpib_addr_label = Gtk.Label("GPIB Address: ")
+        gpib_addr_box.pack_start(gpib_addr_label, False, False, 0)
+        gpib_addr_box.pack_start(self.gpib_addr, False, False, 0)
+
+        self.gpib_vbox.pack_start(self.gpib_box, False, False, 0)
+        self.gpib_vbox.pack_start(gpib_addr_box, False, False, 0)
+
+        self.gpib_big_box.pack_start(self.gpib_vbox, False, False, 0)
+
+        left_vbox.pack_start(gpib_frame, False, False, 0)
+
+        # Device items
+        left_vbox.pack_start(self.box, False, False, 0)
+
+        self.hbox.pack_start(bframe, False, False, 0)
+
+        con_hbox = Gtk.Box(spacing = 2)
+        self.con_button = Gtk.Button(label = "Connect")
+        self.dcon_button = Gtk.Button(label = "Disconnect")
+
+        self.con_button.connect("clicked", self.setup_gpib)
+        self.dcon_button.connect("clicked", self.close_gpib)
+        
+        con_hbox.pack_start(self.con_button, False, False, 0)
+        con_hbox.pack_start(self.dcon_button, False, False, 0)
+
+        left_vbox.pack_start(con_hbox, False, False, 0)
+        
+        device_store = Gtk.ListStore(int, str)
+
+        for i, dev in enumerate(self.devices):
+            device_store.append([i, dev[0]])
+        self.device_combo = Gtk.ComboBox.new_with_model_and_entry(device_store)
+        self.device_combo.set_entry_text_column(1)
+        self.device_combo.set_active(0)
+
+        device_label = Gtk.Label("Device: ")
+        
+        self.box.pack_start(device_label, False, False, 0)
+        self.box.pack_start(self.device_combo, False, False, 0)
+
+        hsep0 = Gtk.HSeparator()
+        left_vbox.pack_start(hsep0, False, False, 2)
+
+        # Measurement Selection
+        mframe = Gtk.Frame(label = "Measurement Selection")
+        meas_box = Gtk.Box(spacing = 2)
+        meas_vbox = Gtk.Box(spacing = 2)
+
+        mframe.add(meas_box)
+        meas_box.pack_start(meas_vbox, False, False, 0)
+
+        meas_store = Gtk.ListStore(int, str)
+        meas_dict = {0: "THD+n",
+                     1:"Frequency Response",
+                     2: "THD+n (Ratio)",
+                     3: "Frequency Response (Ratio)",
+                     4: "Ouput Level"}
+        for k, v in meas_dict.iteritems():
+            meas_store.append([k, v])
+        self.meas_combo = Gtk.ComboBox.new_with_model_and_entry(meas_store)
+        self.meas_combo.set_entry_text_column(1)
+        self.meas_combo.set_active(0)
+
+        self.meas_combo.connect("changed", self.meas_changed)
+        
+        meas_vbox.pack_start(self.meas_combo, False, False, 0)
+        left_vbox.pack_start(mframe, False, False, 0)
+
+
+        units_frame = Gtk.Frame(label = "Units")
+        units_box = Gtk.Box(spacing = 2)
+        units_vbox = Gtk.Box(spacing = 2)
+
+        units_frame.add(units_box)
+        units_box.pack_start(units_vbox, False, False, 0)
+
+        self.thd_units_store = Gtk.ListStore(int, str)
+        self.ampl_units_store = Gtk.ListStore(int, str)
+        self.thdr_units_store = Gtk.ListStore(int, str)
+        self.amplr_units_store = Gtk.ListStore(int, str)
+        self.optlvl_units_store = Gtk.ListStore(int, str)
+        thd_units_dict = {0: "%", 1: "dB"}
+        ampl_units_dict = {0: "V", 1: "dBm"}
+        thdr_units_dict = {0: "%", 1: "dB"}
+        amplr_units_dict = {0: "%", 1:"dB"}
+        optlvl_units_dict = {0: "V"}
+
+        for k, v in thd_units_dict.iteritems():
+            self.thd_units_store.append([k, v])
+        for k, v in ampl_units_dict.iteritems():
+            self.ampl_units_store.append([k, v])
+        for k, v in thdr_units_dict.iteritems():
+            self.thdr_units_store.append([k, v])
+        for k, v in amplr_units_dict.iteritems():
+            self.amplr_units_store.append([k, v])
+        for k, v in optlvl_units_dict.iteritems():
+            self.optlvl_units_store.append([k, v])
+
+            
+        self.units_combo = Gtk.ComboBox.new_with_model_and_entry(self.thd_units_store)
+        self.units_combo.set_entry_text_column(1)
+        self.units_combo.set_active(0)
+
+        self.units_combo.connect("changed", self.units_changed)
+        
+        units_vbox.pack_start(self.units_combo, False, False, 0)
+        left_vbox.pack_start(units_frame, False, False, 0)
+        
+        # units_combo.set_model(ampl_units_store)
+        # units_combo.set_active(0)
+        #left_vbox.pack_start(units_combo, False, False, 0)
+        
+        
+        
+        hsep1 = Gtk.HSeparator()
+        left_vbox.pack_start(hsep1, False, False, 2)
+
+        # Frequency Sweep Control
+        #side_filler = Gtk.Box(spacing = 2, orientation = 'vertical')
+        swconf = Gtk.Frame(label = "Frequency Sweep Control")
+        swhbox = Gtk.Box(spacing = 2)
+        swbox = Gtk.Box(spacing = 2, orientation = 'vertical')
+        swconf.add(swhbox)
+        swhbox.pack_start(swbox, False, False, 0)
+        
+        left_vbox.pack_start(swconf, False, False, 0)
+        
+        startf = Gtk.Frame(label = "Start Frequency (Hz)")
+        
+        self.start_freq = Gtk.SpinButton()
+        self.start_freq.set_range(20.0, 100000.0)
+        self.start_freq.set_digits(5)
+        self.start_freq.set_value(20.0)
+        self.start_freq.set_increments(100.0, 1000.0)
+
+        startf.add(self.start_freq)
+        #left_vbox.pack_start(startf, False, False, 0)
+        swbox.pack_start(startf, False, False, 0)
+        self.start_freq.connect("value_changed", self.freq_callback)
+        
+        stopf = Gtk.Frame(label = "Stop Frequency (Hz)")
+        
+        self.stop_freq = Gtk.SpinButton()
+        self.stop_freq.set_range(20.0, 100000.0)
+        self.stop_freq.set_digits(5)
+        self.stop_freq.set_value(30000.0)
+        self.stop_freq.set_increments(100.0, 1000.0)
+
+        stopf.add(self.stop_freq)
+        #left_vbox.pack_start(stopf, False, False, 0)
+        swbox.pack_start(stopf, False, False, 0)
+        self.stop_freq.connect("value_changed", self.freq_callback)
+
+        stepsf = Gtk.Frame(label = "Steps per Decade")
+        
+        self.steps = Gtk.SpinButton()
+        self.steps.set_range(1.0, 1000.0)
+        self.steps.set_digits(1)
+        self.steps.set_value(10.0)
+        self.steps.set_increments(1.0, 10.0)
+
+        stepsf.add(self.steps)
+        swbox.pack_start(stepsf, False, False, 0)
+        #left_vbox.pack_start(stepsf, False, False, 0)
+
+        # Let the HP 8903 step through the frequencies itself
+        self.native_sweep = Gtk.CheckButton("Native HP-IB sweep")
+        swbox.pack_start(self.native_sweep, False, False, 0)
+
+        # Coarse sweep refined where the curve bends, steps per decade
+        # sets the most points
+        self.adaptive = Gtk.CheckButton("Adaptive")
+        swbox.pack_start(self.adaptive, False, False, 0)
+
+        hsep2 = Gtk.HSeparator()
+        left_vbox.pack_start(hsep2, False, False, 2)
+
+        # Freq Control
+
+        freqf = Gtk.Frame(label = "Frequency")
+        freqbox = Gtk.Box(spacing = 2)
+        freqhbox = Gtk.Box(spacing = 2, orientation = 'vertical')
+
+        freqf.add(freqhbox)
+        freqhbox.pack_start(freqbox, False, False, 0)
+
+        self.freq = Gtk.SpinButton()
+        self.freq.set_range(20.0, 100000.0)
+        self.freq.set_digits(5)
+        self.freq.set_value(1000.0)
+        self.freq.set_increments(100.0, 1000.0)
+
+        self.freq.set_sensitive(False)
+        
+        freqbox.pack_start(self.freq, False, False, 0)
+        left_vbox.pack_start(freqf, False, False, 0)
+
+        freqhsep = Gtk.HSeparator()
+        left_vbox.pack_start(freqhsep, False, False, 2)
+        
+        # Source Control
+        sourcef = Gtk.Frame(label = "Source Control (V RMS)")
+        source_box = Gtk.Box(spacing = 2)
+        sourcef.add(source_box)
+        
+        self.source = Gtk.SpinButton()
+        self.source.set_range(0.0006, 6.0)
+        self.source.set_digits(4)
+        self.source.set_value(0.5)
+        self.source.set_increments(0.5, 1.0)
+        source_box.pack_start(self.source, False, False, 0)
+        left_vbox.pack_start(sourcef, False, False, 0)
+
+        hsep3 = Gtk.HSeparator()
+        left_vbox.pack_start(hsep3, False, False, 2)
+
+
+        vswconf = Gtk.Frame(label = "Voltage Sweep Control")
+        vswhbox = Gtk.Box(spacing = 2)
+        vswbox = Gtk.Box(spacing = 2, orientation = 'vertical')
+        vswconf.add(vswhbox)
+        vswhbox.pack_start(vswbox, False, False, 0)
+        
+        left_vbox.pack_start(vswconf, False, False, 0)
+        
+        startv = Gtk.Frame(label = "Start Voltage (V)")
+        
+        self.start_v = Gtk.SpinButton()
+        self.start_v.set_range(0.0006, 6.0)
+        self.start_v.set_digits(5)
+        self.start_v.set_value(0.1)
+        self.start_v.set_increments(0.1, 1)
+
+        startv.add(self.start_v)
+        #left_vbox.pack_start(startf, False, False, 0)
+        vswbox.pack_start(startv, False, False, 0)
+        self.start_v.connect("value_changed", self.volt_callback)
+        
+        stopv = Gtk.Frame(label = "Stop Voltage (V)")
+        
+        self.stop_v = Gtk.SpinButton()
+        self.stop_v.set_range(0.0006, 6.0)
+        self.stop_v.set_digits(5)
+        self.stop_v.set_value(1.0)
+        self.stop_v.set_increments(0.1, 1.0)
+
+        stopv.add(self.stop_v)
+        #left_vbox.pack_start(stopf, False, False, 0)
+        vswbox.pack_start(stopv, False, False, 0)
+        self.stop_v.connect("value_changed", self.volt_callback)
+
+        stepsv = Gtk.Frame(label = "Total Samples")
+        
+        self.stepsv = Gtk.SpinButton()
+        self.stepsv.set_range(1.0, 1000.0)
+        self.stepsv.set_digits(1)
+        self.stepsv.set_value(10.0)
+        self.stepsv.set_increments(1.0, 10.0)
+
+        stepsv.add(self.stepsv)
+        vswbox.pack_start(stepsv, False, False, 0)
+        #left_vbox.pack_start(stepsf, False, False, 0)
+
+        hsepsv = Gtk.HSeparator()
+        left_vbox.pack_start(hsepsv, False, False, 2)
+
+
+
+        
+        filterf = Gtk.Frame(label = "Filters")
+        filterb = Gtk.Box(spacing = 2)
+        filtervb = Gtk.Box(spacing = 2, orientation = 'vertical')
+        filterf.add(filterb)
+        filterb.pack_start(filtervb, False, False, 0)
+
+        self.f30k = Gtk.CheckButton("30 kHz LP")
+        self.f80k = Gtk.CheckButton("80 kHz LP")
+
+        self.lpi = Gtk.CheckButton("Left Plug-in filter")
+        self.rpi = Gtk.CheckButton("Right Plug-in filter")
+
+        self.f30k.connect("toggled", self.filter1_callback)
+        self.f80k.connect("toggled", self.filter1_callback)
+
+        self.lpi.connect("toggled", self.filter2_callback)
+        self.rpi.connect("toggled", self.filter2_callback)
+        
+        filtervb.pack_start(self.f30k, False, False, 0)
+        filtervb.pack_start(self.f80k, False, False, 0)
+        filtervb.pack_start(self.lpi, False, False, 0)
+        filtervb.pack_start(self.rpi, False, False, 0)
+
+        left_vbox.pack_start(filterf, False, False, 0)
+        
+        hsep = Gtk.HSeparator()
+        left_vbox.pack_start(hsep, False, False, 2)
+        
+        # Re-runs answer unchanged points from recent readings
+        self.use_cache = Gtk.CheckButton("Reuse recent readings")
+        left_vbox.pack_start(self.use_cache, False, False, 0)
+
+        # Fewer range and filter changes, results are shown in plan order
+        self.reorder = Gtk.CheckButton("Optimize point order")
+        left_vbox.pack_start(self.reorder, False, False, 0)
+
+        # Noisy points get more readings, quiet ones still cost one
+        self.average = Gtk.CheckButton("Average noisy readings")
+        left_vbox.pack_start(self.average, False, False, 0)
+
+        # Slow points are read as soon as they settle, not after T3's wait
+        self.stable = Gtk.CheckButton("Detect settling")
+        left_vbox.pack_start(self.stable, False, False, 0)
+
+        # Where sweep time goes, see View > Latency
+        self.record_latency = Gtk.CheckButton("Record latency")
+        left_vbox.pack_start(self.record_latency, False, False, 0)
+
+        self.run_button = Gtk.Button(label = "Start Sequence")
+        self.run_button.set_sensitive(False)
+        left_vbox.pack_start(self.run_button, False, False, 0)
+        self.run_button.connect("clicked", self.run_test)
+        
+        
+        self.f = Figure(figsize=(5,4), dpi=100)
+        self.a = self.f.add_subplot(111)
+        self.a.grid(True)
+        self.a.set_xscale('log')
+        self.a.set_xlim((10.0, 30000.0))
+        self.a.set_ylim((0.0005, 0.01))
+        self.a.set_xlabel("Frequency (Hz)")
+        self.a.set_ylabel("THD+n (%)")
+        
+        self.canvas = FigureCanvas(self.f)
+        self.plot = LivePlot(self.a, self.canvas)
+
+        toolbar = NavigationToolbar(self.canvas, self)
+
+        plot_vbox = Gtk.Box(spacing = 2, orientation = 'vertical')
+        plot_vbox.pack_start(self.canvas, True, True, 0)
+        plot_vbox.pack_start(toolbar, False, False, 0)
+        
+        #self.hbox.pack_start(self.canvas, True, True, 0)
+        self.hbox.pack_start(plot_vbox, True, True, 0)
+
+        # Groups of widgets
+        self.measurement_widgets = [self.meas_combo, self.units_combo,
+                                    self.reorder, self.use_cache,
+                                    self.average, self.stable,
+                                    self.record_latency]
+        self.freq_sweep_widgets = [self.start_freq, self.stop_freq, self.steps,
+                                   self.native_sweep, self.adaptive]
+        self.source_widgets = [self.source]
+        self.filter_widgets = [self.f30k, self.f80k, self.lpi, self.rpi]
+        self.vsweep_widgets = [self.start_v, self.stop_v, self.stepsv]
+        
+        for w in self.measurement_widgets:
+            w.set_sensitive(False)
+        for w in self.freq_sweep_widgets:
+            w.set_sensitive(False)
+        for w in self.source_widgets:
+            w.set_sensitive(False)
+        for w in self.filter_widgets:
+            w.set_sensitive(False)
+        for w in self.vsweep_widgets:
+            w.set_sensitive(False)
+
+        
+        self.meas_string = "THD+n (%)"
+        self.units_string = "%"
+        self.measurements = None
+
+    def setup_gpib(self, button):
+        # Get GPIB info
+        gpib_model = self.gpib_combo.get_model()
+        gpib_tree_iter = self.gpib_combo.get_active_iter()
+
+        # Get address
+        gpib_addr = self.gpib_addr.get_value_as_int()
+
+        # Instantiate GPIB Device class
+        self.gpib_dev = HP8903_GPIB_devices[gpib_model[gpib_tree_iter][0]][0](gpib_addr = gpib_addr)
+        print("Using GPIB Device: %s" % self.gpib_dev.name())
+        print("Using GPIB Address: %s" % str(gpib_addr))
+
+        if (not self.gpib_dev.implements_addr()):
+            print("Warning: this GPIB communication device does not implement")
+            print("    address setting, check your hardware's settings!")
+
+        # Get device info
+        model = self.device_combo.get_model()
+
+        tree_iter = self.device_combo.get_active_iter()
+
+        print("Device: %s" % model[tree_iter][1])
+        dev_name = model[tree_iter][1]
+
+        # Disable gpib and devices buttons
+        self.con_button.set_sensitive(False)
+        self.device_combo.set_sensitive(False)
+        self.gpib_combo.set_sensitive(False)
+        self.gpib_addr.set_sensitive(False)
+
+
+        if(not self.gpib_dev.open(dev_name)):
+            # Make into warning window?
+            print("Failed to open GPIB Device: %s at %s" % (self.gpib_dev.name(), dev_name))
+            print("Verify hardware setup and try to connect again")
+
+            self.con_button.set_sensitive(True)
+            self.device_combo.set_sensitive(True)
+            self.gpib_combo.set_sensitive(True)
+            self.gpib_addr.set_sensitive(True)
+
+            return(False)
+
+        # Do test?
+        if (not self.gpib_dev.test()):
+            print("GPIB device failed self test: %s at %s" % (self.gpib_dev.name(), dev_name))
+            print("Verify hardware setup and try to connect again")
+
+            self.con_button.set_sensitive(True)
+            self.device_combo.set_sensitive(True)
+            self.gpib_combo.set_sensitive(True)
+            self.gpib_addr.set_sensitive(True)
+
+            return(False)
+
+
+        if (self.gpib_dev.is_open()):
+            self.gpib_dev.flush_input()
+            # Initialize the HP 8903
+            self.timing = load_timing(self.gpib_dev, dev_name, gpib_addr)
+            self.hp = HP8903(self.gpib_dev, timing = self.timing)
+            status = self.hp.init()
+            if (not status):
+                print("Failed to initialize HP 8903")
+                print("Verify hardware setup and try to connect again")
+
+                self.gpib_dev.close()
+
+                self.con_button.set_sensitive(True)
+                self.device_combo.set_sensitive(True)
+                self.gpib_combo.set_sensitive(True)
+                self.gpib_addr.set_sensitive(True)
+
+                return(False)
+
+        else:
+            print("Failed to use GPIB device")
+            print("Verify hardware setup and try to connect again")
+
+            self.gpib_dev.close()
+
+            self.con_button.set_sensitive(True)
+            self.device_combo.set_sensitive(True)
+            self.gpib_combo.set_sensitive(True)
+            self.gpib_addr.set_sensitive(True)
+
+            return(False)
+
+        # Enable measurement controls
+        self.run_button.set_sensitive(True)
+        for w in self.measurement_widgets:
+            w.set_sensitive(True)
+        for w in self.freq_sweep_widgets:
+            w.set_sensitive(True)
+        for w in self.source_widgets:
+            w.set_sensitive(True)
+        for w in self.filter_widgets:
+            w.set_sensitive(True)
+        for w in self.vsweep_widgets:
+            w.set_sensitive(False)
+
+
+        self.status_bar.push(0, "Connected to  HP 8903, ready for measurements")
+
+    def close_gpib(self, button):
+        self.stop_sweep()
+        if (self.gpib_dev):
+            self.gpib_dev.close()
+
+        # Activate device/connection buttons
+        self.con_button.set_sensitive(True)
+        self.device_combo.set_sensitive(True)
+        self.gpib_combo.set_sensitive(True)
+        self.gpib_addr.set_sensitive(True)
+
+        # Disable measurement controls
+        for w in self.measurement_widgets:
+            w.set_sensitive(False)
+        for w in self.freq_sweep_widgets:
+            w.set_sensitive(False)
+        for w in self.source_widgets:
+            w.set_sensitive(False)
+        for w in self.filter_widgets:
+            w.set_sensitive(False)
+        for w in self.vsweep_widgets:
+            w.set_sensitive(False)
+
+        self.freq.set_sensitive(False)
+
+        self.run_button.set_sensitive(False)
+
+    def lock_controls(self):
+        # Disable all control widgets during sweep
+        self.run_button.set_sensitive(False)
+        self.action_filesave.set_sensitive(False)
+        self.action_resume.set_sensitive(False)
+
+        for w in self.measurement_widgets:
+            w.set_sensitive(False)
+        for w in self.freq_sweep_widgets:
+            w.set_sensitive(False)
+        for w in self.source_widgets:
+            w.set_sensitive(False)
+        for w in self.filter_widgets:
+            w.set_sensitive(False)
+        for w in self.vsweep_widgets:
+            w.set_sensitive(False)
+
+        self.freq.set_sensitive(False)
+
+    def run_test(self, button):
+        self.lock_controls()
+
+        # 30, 80, LPI, RPI
+        filters = [False, False, False, False]
+        filters[0] = self.f30k.get_active()
+        filters[1] = self.f80k.get_active()
+        filters[2] = self.lpi.get_active()
+        filters[3] = self.rpi.get_active()
+        #print(filters)
+
+        amp = self.source.get_value()
+        
+        strtf = self.start_freq.get_value()
+        stopf = self.stop_freq.get_value()
+        
+        num_steps = self.steps.get_value_as_int()
+
+        meas = self.meas_combo.get_active()
+        units = self.units_combo.get_active()
+
+        center_freq = self.freq.get_value()
+
+        if ((meas < 4) and (meas >= 0)):
+            plan = SweepPlan.log(strtf, stopf, num_steps, amp).clamp()
+            ref_amp = amp
+
+            self.a.set_xlim((plan.x[0]*10**(-2.0/10.0), plan.x[-1]*10**(2.0/10.0)))
+            self.a.set_xscale('log')
+        elif (meas == 4):
+            start_amp = self.start_v.get_value()
+            stop_amp = self.stop_v.get_value()
+            num_vsteps = self.stepsv.get_value()
+            plan = SweepPlan.levels(start_amp, stop_amp, num_vsteps,
+                                    center_freq).clamp()
+            ref_amp = start_amp
+
+            amp_buf = ((stop_amp - start_amp)*0.1)/2.0
+            self.a.set_xlim(((start_amp - amp_buf), (stop_amp + amp_buf)))
+            self.a.set_xscale('linear')
+
+        # center freq...
+        self.measurements = [amp, filters, meas, units, self.meas_string, self.units_string]
+
+        native = None
+        adaptive = None
+        reorder = None
+        if (self.native_sweep.get_active()):
+            native = plan.native()
+        elif (self.adaptive.get_active() and (meas < 4)):
+            adaptive = (ADAPTIVE_TOLERANCE_DB, len(plan))
+            plan = SweepPlan.log(strtf, stopf,
+                                 min(num_steps, ADAPTIVE_COARSE_PER_DECADE),
+                                 amp).clamp()
+        elif (self.reorder.get_active()):
+            # The reference is measured first, the sweep starts there
+            reorder = {}
+            plan = plan.ordered(self.hp.transition_cost(reorder),
+                                start = (center_freq, ref_amp))
+
+        self.hp.cache = None
+        if (self.use_cache.get_active()):
+            self.hp.cache = self.cache
+
+        averaging = None
+        if (self.average.get_active() and (native is None)):
+            averaging = (AVERAGE_TARGET, AVERAGE_MAX_READS)
+        stability = None
+        if (self.stable.get_active() and (native is None)):
+            stability = STABLE_TOLERANCE
+
+        setup = {"meas": meas,
+                 "units": units,
+                 "filters": filters,
+                 "ref_freq": center_freq,
+                 "ref_amp": ref_amp,
+                 "points": plan,
+                 "native": native,
+                 "adaptive": adaptive,
+                 "averaging": averaging,
+                 "stability": stability,
+                 "reorder": reorder,
+                 "measurements": self.measurements}
+        # Every point is logged as it arrives, a crash loses at most a
+        # second and the sweep can be resumed from the journal
+        self.start_sweep(setup,
+                         datetime.now().strftime("%Y-%m-%d-%H%M%S") + ".journal")
+
+    def start_sweep(self, setup, journal_name, measured = []):
+        """Run a sweep (a _sweep_setup style dict), after measured points"""
+        self.points = list(measured)
+        self.resumed = len(measured)
+        self.journal_name = journal_name
+
+        self.latency = None
+        if (self.record_latency.get_active()):
+            self.latency = LatencyRecorder()
+        self.hp.record_latency(self.latency)
+        self.plot.latency = self.latency
+
+        self.hp.averaging = None
+        if (setup.get("averaging")):
+            self.hp.averaging = Averager(*setup["averaging"])
+        self.hp.stability = None
+        if (setup.get("stability")):
+            self.hp.stability = StabilityDetector(tolerance = setup["stability"])
+
+        self.plot.reset()
+        for i, x, m in measured:
+            self.plot.append(x, m.value, index = i)
+        self.plot.start()
+
+        journal = SweepJournal(journal_name, self.measurements, self._metadata(),
+                               sweep = setup, measured = measured)
+
+        # Sweep runs on its own thread, results are collected from the GTK main loop
+        self.worker = SweepWorker(self.hp, setup["meas"], setup["units"],
+                                  setup["filters"], setup["ref_freq"],
+                                  setup["ref_amp"], setup["points"],
+                                  native = setup["native"], journal = journal,
+                                  adaptive = setup["adaptive"],
+                                  measured = measured)
+        self.worker.start()
+        GObject.timeout_add(50, self.poll_sweep, self.worker, setup["meas"])
+
+    def resume_sweep(self, widget):
+        """Continue an interrupted sweep from its journal"""
+        if ((self.hp is None) or (self.worker is not None)):
+            self.status_bar.push(0, "Connect to the HP 8903 to resume a sweep")
+            return
+
+        dialog = Gtk.FileChooserDialog("Resume Sweep", self,
+                                       Gtk.FileChooserAction.OPEN,
+                                       (Gtk.STOCK_CANCEL, Gtk.ResponseType.CANCEL,
+                                        Gtk.STOCK_OPEN, Gtk.ResponseType.OK))
+        journals = Gtk.FileFilter()
+        journals.set_name("Sweep journals")
+        journals.add_pattern("*.journal")
+        journals.add_pattern("*.journal.partial")
+        dialog.add_filter(journals)
+        response = dialog.run()
+        fname = dialog.get_filename()
+        dialog.destroy()
+        if (response != Gtk.ResponseType.OK):
+            return
+
+        if (fname.endswith(".partial")):
+            fname = fname[:-len(".partial")]
+        try:
+            setup, measured = resume_setup(fname)
+        except (IOError, OSError, ValueError) as e:
+            self.status_bar.push(0, "Can't resume: %s" % str(e))
+            return
+
+        # Sets the plot labels and units choices
+        self.meas_combo.set_active(setup["meas"])
+        self.units_combo.set_active(setup["units"])
+        self.measurements = setup["measurements"]
+
+        xs = [pt[1] for pt in measured] + [p[0] for p in setup["points"]]
+        if (setup["meas"] < 4):
+            self.a.set_xscale('log')
+            self.a.set_xlim((min(xs)*10**(-2.0/10.0), max(xs)*10**(2.0/10.0)))
+        else:
+            buf = (max(xs) - min(xs))*0.05
+            self.a.set_xscale('linear')
+            self.a.set_xlim((min(xs) - buf, max(xs) + buf))
+
+        self.lock_controls()
+        self.hp.cache = None
+        setup["points"] = _sweep_points(setup, self.hp)
+        self.start_sweep(setup, fname, measured)
+        self.status_bar.push(0, "Resuming with %d points measured" % len(measured))
+
+    def poll_sweep(self, worker, meas):
+        """Collect results from the sweep worker, returns False when done"""
+        while (True):
+            try:
+                kind, data = worker.results.get_nowait()
+            except queue.Empty:
+                break
+
+            if (kind == "point"):
+                i, x, m = data
+                self.points.append(data)
+                self.plot.append(x, m.value, index = i)
+                if (meas == 4):
+                    print("in: %f, out %f" % (x, m.value))
+                else:
+                    print(m.value)
+                msg = "Freq: %f, Amp: %f, Return: %f,    GPIB: %s" % (m.freq, m.amp, m.value, m.payload)
+                done = len(self.points) - self.resumed
+                eta = self.hp.eta(meas, [p[1] for p in worker.points[done:]])
+                if ((eta is not None) and (worker.adaptive is None)):
+                    msg += ",    ETA: %d s" % int(round(eta))
+                self.status_bar.push(0, msg)
+            elif (kind == "error"):
+                print("Sweep failed: %s" % data)
+                self.status_bar.push(0, "Sweep failed: %s, File > Resume Sweep "
+                                     "continues from %s" % (data, self.journal_name))
+            elif (kind == "done"):
+                self.plot.stop()
+                if ((worker.native is None) and (worker.adaptive is None)):
+                    self.hp.learn_transitions(meas, worker.points,
+                                              self.points[self.resumed:])
+                self.sweep_finished(meas)
+                self.worker = None
+                return(False)
+
+        return(True)
+
+    def stop_sweep(self):
+        """Stop a running sweep and wait for its worker"""
+        if (self.worker):
+            self.worker.stop()
+            self.worker.join(5.0)
+            self.worker = None
+
+    def sweep_finished(self, meas):
+        # Keep what was learned about settle times and transitions
+        self.timing.save()
+
+        for w in self.measurement_widgets:
+            w.set_sensitive(True)
+        for w in self.filter_widgets:
+            w.set_sensitive(True)
+
+        if ((meas < 4) and (meas >= 0)):
+            for w in self.freq_sweep_widgets:
+                w.set_sensitive(True)
+            for w in self.source_widgets:
+                w.set_sensitive(True)
+        if (meas == 4):
+            for w in self.vsweep_widgets:
+                w.set_sensitive(True)
+
+        if (meas > 1):
+            self.freq.set_sensitive(True)
+
+        self.run_button.set_sensitive(True)
+        self.action_filesave.set_sensitive(True)
+        self.action_resume.set_sensitive(True)
+
+    def save_data(self, button):
+        fname = datetime.now().strftime("%Y-%m-%d-%H%M%S")
+        # Reordered sweeps are saved in plan order
+        points = plan_order(self.points)
+        fid = open(fname + '.txt', 'w')
+        write_text(fid, self.measurements, [p[1] for p in points],
+                   [p[2].value for p in points],
+                   [p[2].cached for p in points], self.latency)
+        fid.close()
+
+        # Full precision copy with raw readings
+        metadata = self._metadata()
+        if (self.latency is not None):
+            metadata["latency"] = self.latency.to_dict()
+        write_archive(fname + '.hp8903', self.measurements, points,
+                      metadata = metadata)
+
+    def show_latency(self, widget):
+        if (self.latency is None):
+            self.status_bar.push(0, "Check Record latency and run a sweep first")
+            return
+
+        LatencyWindow(self.latency).show_all()
+
+    def forget_cache(self, widget):
+        self.cache.invalidate()
+        self.status_bar.push(0, "Cached readings forgotten")
+
+    def _metadata(self):
+        """Connection details stored with saved data"""
+        return({"controller": self.gpib_dev.name(),
+                "port": self.gpib_dev.dev_name,
+                "addr": self.gpib_dev.gpib_addr})
+        
+        
+    def freq_callback(self, spinb):
+        if (self.start_freq.get_value() > self.stop_freq.get_value()):
+            self.start_freq.set_value(self.stop_freq.get_value())
+
+    def volt_callback(self, spinb):
+        if (self.start_v.get_value() > self.stop_v.get_value()):
+            self.start_v.set_value(self.stop_v.get_value())
+
+    # 30k/80k toggle
+    def filter1_callback(self, cb):
+        if (cb.get_active()):
+            if (cb.get_label() == "30 kHz LP"):
+                self.f80k.set_active(False)
+            elif (cb.get_label() == "80 kHz LP"):
+                self.f30k.set_active(False)
+
+    # left plugin/right plugin toggle
+    def filter2_callback(self, cb):
+        if (cb.get_active()):
+            if (cb.get_label() == "Left Plug-in filter"):
+                self.rpi.set_active(False)
+            elif (cb.get_label() == "Right Plug-in filter"):
+                self.lpi.set_active(False)
+
+    def on_menu_file_quit(self, widget):
+        self.stop_sweep()
+        if (self.gpib_dev):
+            self.gpib_dev.close()
+        Gtk.main_quit()
+
+    def meas_changed(self, widget):
+        meas_ind = self.meas_combo.get_active()
+        if (meas_ind == 0):
+            self.units_combo.set_model(self.thd_units_store)
+            self.units_combo.set_active(0)
+            self.a.set_ylabel("THD+n (%)")
+            self.a.set_xlabel("Frequency (Hz)")            
+            self.canvas.draw()
+            self.freq.set_sensitive(False)
+            self.source.set_sensitive(True)
+            for w in self.freq_sweep_widgets:
+                w.set_sensitive(True)
+            for w in self.vsweep_widgets:
+                w.set_sensitive(False)
+        elif (meas_ind == 1):
+            self.units_combo.set_model(self.ampl_units_store)
+            self.units_combo.set_active(0)
+            self.a.set_ylabel("AC Level (V RMS)")
+            self.a.set_xlabel("Frequency (Hz)")            
+            self.canvas.draw()
+            self.freq.set_sensitive(False)
+            self.source.set_sensitive(True)
+            for w in self.freq_sweep_widgets:
+                w.set_sensitive(True)
+            for w in self.vsweep_widgets:
+                w.set_sensitive(False)
+        elif (meas_ind == 2):
+            self.units_combo.set_model(self.thdr_units_store)
+            self.units_combo.set_active(0)
+            self.a.set_ylabel("THD+n Ratio (%)")
+            self.a.set_xlabel("Frequency (Hz)")
+            self.canvas.draw()
+            self.freq.set_sensitive(True)
+            self.source.set_sensitive(True)
+            for w in self.freq_sweep_widgets:
+                w.set_sensitive(True)
+            for w in self.vsweep_widgets:
+                w.set_sensitive(False)
+        elif (meas_ind == 3):
+            self.units_combo.set_model(self.amplr_units_store)
+            self.units_combo.set_active(0)
+            self.a.set_ylabel("AC Level Ratio (%)")
+            self.a.set_xlabel("Frequency (Hz)")
+            self.canvas.draw()
+            self.freq.set_sensitive(True)
+            self.source.set_sensitive(True)
+            for w in self.freq_sweep_widgets:
+                w.set_sensitive(True)
+            for w in self.vsweep_widgets:
+                w.set_sensitive(False)
+        elif (meas_ind == 4):
+            self.units_combo.set_model(self.optlvl_units_store)
+            self.units_combo.set_active(0)
+            self.a.set_ylabel("Output Level (V)")
+            self.a.set_xlabel("Input Level (V)")
+            self.canvas.draw()
+            self.freq.set_sensitive(True)
+            self.source.set_sensitive(False)
+            for w in self.freq_sweep_widgets:
+                w.set_sensitive(False)
+            for w in self.vsweep_widgets:
+                w.set_sensitive(True)
+
+
+            
+
+
+    def units_changed(self, widget):
+        meas_ind = self.meas_combo.get_active()
+        units_ind = self.units_combo.get_active()
+        #print("meas ind: %d units ind: %d" % (meas_ind, units_ind))
+        # Set units on plot
+        meas = ""
+        if (meas_ind == 0):
+            meas = "THD+n "
+            if (units_ind == 0):
+                meas += "(%)"
+                self.units_string = "%"
+            elif (units_ind == 1):
+                meas += "(dB)"
+                self.units_string = "dB"
+        elif (meas_ind == 1):
+            meas = "AC Level "
+            if (units_ind == 0):
+                meas += "(V RMS)"
+                self.units_string = "V RMS"
+            elif (units_ind == 1):
+                meas += "(dB V)"
+                self.units_string = "dB V"
+        elif (meas_ind == 2):
+            meas = "THD+n (Ratio) "
+            if (units_ind == 0):
+                meas += "(%)"
+                self.units_string = "%"
+            elif (units_ind == 1):
+                meas += "(dB)"
+                self.units_string = "dB"
+        elif (meas_ind == 3):
+            meas = "AC Level (Ratio) "
+            if (units_ind == 0):
+                meas += "(%)"
+                self.units_string = "%"
+            elif (units_ind == 1):
+                meas += "(dB)"
+                self.units_string = "dB"
+
+        # Save text info about units
+        self.meas_string = meas
+        # Updated plot
+        self.a.set_ylabel(meas)
+        self.canvas.draw()
+
+    # menu bar junk
+    def create_ui_manager(self):
+        uimanager = Gtk.UIManager()
+
+        # Throws exception if something went wrong
+        uimanager.add_ui_from_string(UI_INFO)
+
+        # Add the accelerator group to the toplevel window
+        accelgroup = uimanager.get_accel_group()
+        self.add_accel_group(accelgroup)
+        return uimanager
+
+
+class StationWindow(Gtk.Window):
+    def __init__(self, station):
+        """Live plot of the sweeps running on a Station, one line each"""
+        Gtk.Window.__init__(self, title = "HP 8903 Station")
+        self.set_default_size(800, 500)
+        self.station = station
+
+        self.f = Figure(figsize=(5,4), dpi=100)
+        self.a = self.f.add_subplot(111)
+        self.a.grid(True)
+
+        setup = station.setups[station.names[0]]
+        if (setup["meas"] < 4):
+            freqs = [p[1] for name in station.names
+                     for p in station.setups[name]["points"]]
+            self.a.set_xscale('log')
+            self.a.set_xlim((min(freqs), max(freqs)))
+            self.a.set_xlabel("Frequency (Hz)")
+        else:
+            self.a.set_xlabel("Input Level (V)")
+        self.a.set_ylabel(setup["measurements"][4])
+
+        self.canvas = FigureCanvas(self.f)
+        self.plot = LivePlot(self.a, self.canvas)
+        for name in station.names:
+            self.plot.add_line(name, label = name)
+        self.a.legend(loc = 'best')
+
+        toolbar = NavigationToolbar(self.canvas, self)
+        self.status = Gtk.Statusbar()
+
+        vbox = Gtk.Box(spacing = 2, orientation = 'vertical')
+        vbox.pack_start(self.canvas, True, True, 0)
+        vbox.pack_start(toolbar, False, False, 0)
+        vbox.pack_start(self.status, False, False, 0)
+        self.add(vbox)
+
+        self.plot.start()
+        GObject.timeout_add(50, self.poll)
+
+    def poll(self):
+        for name, kind, data in self.station.poll():
+            if (kind == "point"):
+                i, x, m = data
+                self.plot.append(x, m.value, name, index = i)
+            elif (kind == "error"):
+                print("%s: sweep failed: %s" % (name, data))
+
+        done = len(self.station.finished)
+        self.status.push(0, "%d of %d sweeps finished" %
+                         (done, len(self.station.names)))
+        if (not self.station.running()):
+            self.plot.stop()
+            return(False)
+
+        return(True)
+
+
+class LatencyWindow(Gtk.Window):
+    def __init__(self, latency):
+        """Percentiles and histograms of a LatencyRecorder's phases
+
+        Refreshed every second while open, also during a sweep."""
+        Gtk.Window.__init__(self, title = "HP 8903 Latency")
+        self.set_default_size(700, 550)
+        self.latency = latency
+
+        self.f = Figure(figsize=(5,4), dpi=100)
+        self.a = self.f.add_subplot(111)
+        self.canvas = FigureCanvas(self.f)
+        self.table = Gtk.Label()
+        self.table.set_selectable(True)
+
+        vbox = Gtk.Box(spacing = 2, orientation = 'vertical')
+        vbox.pack_start(self.canvas, True, True, 0)
+        vbox.pack_start(self.table, False, False, 0)
+        self.add(vbox)
+
+        self.refresh()
+        self.timer = GObject.timeout_add(1000, self.refresh)
+        self.connect("destroy", self.on_destroy)
+
+    def refresh(self):
+        stats = self.latency.summary()
+        self.table.set_markup("<tt>%s</tt>" % "\n".join(self.latency.report()))
+
+        self.a.clear()
+        edges = LATENCY_BINS*1e3
+        for phase in LATENCY_PHASES + ["plot"]:
+            if (phase in stats):
+                self.a.step(edges[:-1], stats[phase]["histogram"],
+                            where = 'post', label = phase)
+        self.a.set_xscale('log')
+        self.a.set_xlabel("Time (ms)")
+        self.a.set_ylabel("Count")
+        self.a.grid(True)
+        if (stats):
+            self.a.legend(loc = 'best')
+        self.canvas.draw()
+
+        return(True)
+
+    def on_destroy(self, widget):
+        GObject.source_remove(self.timer)
+
+
+def station_window(station):
+    """Show a Station's sweeps until the window is closed"""
+    GObject.threads_init()
+    win = StationWindow(station)
+    win.connect("delete-event", Gtk.main_quit)
+    win.show_all()
+    Gtk.main()
+
+
+def main():
+    GObject.threads_init()
+    win = HP8903BWindow()
+    win.connect("delete-event", Gtk.main_quit)
+    win.show_all()
+    Gtk.main()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,39 @@
+# Tests run against the HP 8903 emulator (hp8903_emulator.py) on a pty,
+# no instrument or GPIB controller is needed:
+#   python -m pytest tests
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from hp8903_bench import BenchEmulator
+
+# Quick settling so sweeps take a fraction of a second
+FAST_SETTLE = "20:20,1000:5,20000:2"
+
+
+@pytest.fixture
+def emulator():
+    """emulator(controller, settle) starts an emulator, returns its device
+
+    Emulators are stopped after the test."""
+    started = []
+
+    def start(controller = "galvant", settle = FAST_SETTLE):
+        e = BenchEmulator(controller, settle = settle)
+        started.append(e)
+        dev = e.open()
+        assert dev is not None
+        return(dev)
+
+    yield start
+    for e in started:
+        e.close()
+
+
+@pytest.fixture(params = ["galvant", "ni"])
+def controller(request):
+    return(request.param)
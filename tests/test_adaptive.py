@@ -0,0 +1,47 @@
+import numpy as np
+
+from hp8903 import HP8903, SweepPlan, refine_points
+
+FILTERS = [False]*4
+
+
+def test_flat_curve_needs_nothing():
+    freqs = [20.0, 200.0, 2000.0, 20000.0]
+    assert refine_points(freqs, [-80.0]*4, True) == []
+
+
+def test_step_gets_midpoint():
+    freqs = [100.0, 1000.0, 10000.0]
+    added = refine_points(freqs, [-80.0, -80.0, -60.0], True)
+    # The bend the step makes is blamed on both intervals
+    assert np.allclose(sorted(added), [np.sqrt(100.0*1000.0),
+                                       np.sqrt(1000.0*10000.0)])
+
+
+def test_linear_units_compared_in_db():
+    freqs = [100.0, 1000.0, 10000.0]
+    # 10x is 20 dB
+    assert refine_points(freqs, [0.001, 0.001, 0.01], False)
+    assert refine_points(freqs, [0.001, 0.001, 0.00101], False) == []
+
+
+def test_failed_and_narrow_intervals_left_alone():
+    assert refine_points([100.0, 1000.0], [-80.0, np.nan], True) == []
+    # 0.01 decade is finer than 100 points per decade allows
+    assert refine_points([1000.0, 1023.3], [-80.0, -40.0], True) == []
+
+
+def test_adaptive_sweep_budget(emulator, controller):
+    hp = HP8903(emulator(controller))
+    hp.reference(1, 0, 1000.0, 0.5, FILTERS)
+    coarse = SweepPlan.log(20.0, 20000.0, 1, 0.5)
+    results = list(hp.adaptive_sweep(1, 1, FILTERS, coarse, budget = 8))
+
+    assert len(coarse) <= len(results) <= 8
+    freqs = [m.freq for i, x, m in results]
+    # Coarse pass first, then added points in between
+    assert freqs[:len(coarse)] == coarse.freq.tolist()
+    assert len(set(freqs)) == len(freqs)
+    for i, x, m in results:
+        assert i == m.freq
+        assert not np.isnan(m.value)
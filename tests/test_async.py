@@ -0,0 +1,103 @@
+import time
+import asyncio
+
+import numpy as np
+
+from hp8903 import (Averager, LatencyRecorder, MeasurementCache,
+                    NI_GPIB_232CV_A, SweepPlan, read_journal)
+from hp8903_async import AsyncHP8903, AsyncTransport, main
+from test_transport import PipeSerial
+
+FILTERS = [False]*4
+
+
+def run(coro):
+    return(asyncio.run(coro))
+
+
+def test_async_sweep(emulator, controller):
+    dev = emulator(controller)
+
+    async def sweep():
+        hp = AsyncHP8903(AsyncTransport(dev), cache = MeasurementCache(),
+                         averaging = Averager(target = 1e-6, max_reads = 3))
+        hp.record_latency(LatencyRecorder())
+        await hp.reference(0, 0, 1000.0, 0.5, FILTERS)
+        plan = SweepPlan.log(100.0, 10000.0, 2, 0.5)
+        results = [r async for r in hp.sweep(0, 0, FILTERS, plan)]
+        again = await hp.send_measurement(0, 0, 100.0, 0.5, FILTERS)
+        hp.transport.close()
+        return(hp, results, again)
+
+    hp, results, again = run(sweep())
+    assert [i for i, x, m in results] == list(range(5))
+    for i, x, m in results:
+        assert not np.isnan(m.value)
+        # Identical readings can stop averaging early
+        assert 1 < m.reads <= 3
+    assert again.cached
+
+    # Same bookkeeping as HP8903: one record per point, the reference too
+    latency = hp.hp.latency
+    assert [p["index"] for p in latency.points] == [None] + list(range(5))
+    assert ([p["readings"] for p in latency.points[1:]] ==
+            [m.reads for i, x, m in results])
+
+
+def test_async_read_longer_than_adapter_timeout(emulator):
+    dev = emulator("galvant", settle = "20:2000")
+
+    async def read():
+        transport = AsyncTransport(dev)
+        transport.flush_input()
+        transport.set_read_timeout(8000)
+        await transport.write("FR20.0000HZAP0.500E+00VLM1LNL0LNT3",
+                              expect_reply = True)
+        start = time.time()
+        status, samp = await transport.read_until(timeout = 8000)
+        transport.close()
+        return(status, time.time() - start)
+
+    status, elapsed = run(read())
+    assert status
+    assert 3.0 < elapsed < 6.0
+
+
+def test_async_read_hung_up_port_fails():
+    dev = NI_GPIB_232CV_A()
+    dev.ser = PipeSerial()
+
+    async def read():
+        transport = AsyncTransport(dev)
+        start = time.time()
+        try:
+            await transport.read_until(timeout = 2000)
+        except IOError:
+            pass
+        else:
+            assert False, "read on a closed port didn't fail"
+        # Not called back for the closed port any more
+        assert not transport.loop.remove_reader(transport.fd)
+        return(time.time() - start)
+
+    try:
+        assert run(read()) < 0.5
+    finally:
+        dev.ser.close()
+
+
+
+def test_journal_per_instrument(tmp_path):
+    journal = str(tmp_path / "sweep.journal")
+    status = main(["--instrument", "emulator", "--instrument", "emulator",
+                   "--freqs", "1000,2000", "-o", str(tmp_path / "sweep.txt"),
+                   "--journal", journal])
+    assert status == 0
+
+    for n in range(2):
+        fname = str(tmp_path / ("sweep-%d.journal" % n))
+        header, points, state = read_journal(fname)
+        assert state == "finished"
+        assert [p["x"] for p in points] == [1000.0, 2000.0]
+        # Resumable with hp8903.py sweep --resume
+        assert header["sweep"]["plan"]
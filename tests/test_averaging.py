@@ -0,0 +1,52 @@
+import math
+
+from hp8903 import AVERAGE_PRIOR_POINTS, Averager
+
+
+def _stats(values):
+    """n, mean and Welford m2 of values"""
+    n = len(values)
+    mean = sum(values)/n
+    return((n, mean, sum((v - mean)**2 for v in values)))
+
+
+def test_average_until_confident():
+    avg = Averager(target = 0.01, max_reads = 16)
+    assert not avg.done(1000.0, False, *_stats([1.0]))
+    # 5% spread on 3 readings is not within 1%
+    assert not avg.done(1000.0, False, *_stats([0.95, 1.0, 1.05]))
+    assert avg.done(1000.0, False, *_stats([0.999, 1.0, 1.001]))
+
+
+def test_average_max_reads():
+    avg = Averager(target = 1e-9, max_reads = 4)
+    assert not avg.done(1000.0, False, *_stats([1.0, 2.0, 3.0]))
+    assert avg.done(1000.0, False, *_stats([1.0, 2.0, 3.0, 4.0]))
+
+
+def test_quiet_decade_takes_one_reading():
+    avg = Averager(target = 0.01)
+    for i in range(AVERAGE_PRIOR_POINTS):
+        avg.learn(1000.0 + i, False, *_stats([0.9999, 1.0, 1.0001]))
+
+    assert avg.done(5000.0, False, *_stats([2.0]))
+    # Other decades and log units know nothing yet
+    assert not avg.done(50.0, False, *_stats([2.0]))
+    assert not avg.done(5000.0, True, *_stats([-60.0]))
+
+
+def test_noisy_decade_keeps_averaging():
+    avg = Averager(target = 0.01)
+    for i in range(AVERAGE_PRIOR_POINTS):
+        avg.learn(1000.0, False, *_stats([0.9, 1.0, 1.1]))
+
+    assert not avg.done(5000.0, False, *_stats([2.0]))
+
+
+def test_log_units_target_in_db():
+    avg = Averager(target = 0.01)
+    limit = 20.0*math.log10(1.01)
+    assert avg.done(1000.0, True, *_stats([-60.0, -60.0 + limit/10.0,
+                                           -60.0 - limit/10.0]))
+    assert not avg.done(1000.0, True, *_stats([-60.0, -60.0 + 2.0*limit,
+                                               -60.0 - 2.0*limit]))
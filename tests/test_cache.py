@@ -0,0 +1,43 @@
+import math
+
+from hp8903 import HP8903, MeasurementCache
+
+FILTERS = [False]*4
+
+
+def test_key_as_programmed():
+    cache = MeasurementCache()
+    assert (cache.key(0, 0, 1000.0, 0.5, FILTERS) ==
+            cache.key(0, 0, 1000.00001, 0.5, FILTERS))
+    assert (cache.key(0, 0, 1000.0, 0.5, FILTERS) !=
+            cache.key(0, 1, 1000.0, 0.5, FILTERS))
+
+
+def test_hit_and_invalidate(emulator):
+    hp = HP8903(emulator("galvant"), cache = MeasurementCache())
+    m = hp.send_measurement(0, 0, 1000.0, 0.5, FILTERS)
+    assert not m.cached
+
+    again = hp.send_measurement(0, 0, 1000.0, 0.5, FILTERS)
+    assert again.cached
+    assert again.value == m.value
+
+    hp.cache.invalidate()
+    assert not hp.send_measurement(0, 0, 1000.0, 0.5, FILTERS).cached
+
+
+def test_reference_not_cached(emulator):
+    # THD, then a ratio sweep, then THD again: ratio has to be turned
+    # off even though the THD reference was measured before
+    hp = HP8903(emulator("galvant"), cache = MeasurementCache())
+    hp.reference(0, 0, 1000.0, 0.5, FILTERS)
+    hp.reference(2, 0, 1000.0, 0.5, FILTERS)
+    ratio = hp.send_measurement(2, 0, 3000.0, 0.5, FILTERS)
+    assert abs(ratio.value - 100.0) < 5.0
+
+    r = hp.reference(0, 0, 1000.0, 0.5, FILTERS)
+    assert not r.cached
+    assert "R0" in r.payload
+    m = hp.send_measurement(0, 0, 3000.0, 0.5, FILTERS)
+    assert not math.isnan(m.value)
+    assert m.value < 0.01
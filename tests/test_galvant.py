@@ -0,0 +1,63 @@
+import time
+
+import pytest
+
+from conftest import FAST_SETTLE
+from hp8903 import (GALVANT_MAX_READ_TMO_MS, HP8903, HP8903_Emulator,
+                    Galvant_GPIB_USB, Galvant_read_modes, SweepPlan)
+
+FILTERS = [False]*4
+
+
+def test_read_longer_than_adapter_timeout(emulator):
+    # T3 takes 2 x 2 s, more than the adapter's longest read timeout
+    dev = emulator("galvant", settle = "20:2000")
+    dev.set_read_timeout(8000)
+    assert dev.read_tmo == GALVANT_MAX_READ_TMO_MS
+
+    dev.write("FR20.0000HZAP0.500E+00VLM1LNL0LNT3", expect_reply = True)
+    start = time.time()
+    status, samp = dev.read(timeout = 8000)
+    assert status
+    assert 3.0 < (time.time() - start) < 6.0
+    assert HP8903(dev)._decode(20.0, 0.5, status, samp, "").value > 0.0
+
+
+@pytest.mark.parametrize("read_mode", Galvant_read_modes)
+def test_read_mode_framing(read_mode):
+    dev = Galvant_GPIB_USB(read_mode = read_mode)
+    dev.set_read_timeout(700)
+    frame = dev._frame("FR1000.0HZT3", expect_reply = True)
+    # New read timeout goes out with the next write
+    assert frame.startswith("++read_tmo_ms 700\nFR1000.0HZT3\n")
+    request = dev._read_request()
+    if (read_mode == "read"):
+        assert frame.endswith("T3\n")
+        assert request.strip() == "++read"
+    elif (read_mode == "coalesce"):
+        assert frame.endswith("T3\n++read\n")
+        assert request == ""
+    else:
+        assert request == ""
+        assert (dev._frame("FR2000.0HZ") ==
+                "++auto 0\nFR2000.0HZ\n++auto 1\n")
+    # Asking again, e.g. after the adapter timed out, always takes ++read
+    assert dev._read_request().strip() == "++read"
+
+
+@pytest.mark.parametrize("read_mode", Galvant_read_modes)
+def test_read_mode_sweep(read_mode):
+    dev = HP8903_Emulator(settle = FAST_SETTLE, read_mode = read_mode)
+    assert dev.open()
+    try:
+        hp = HP8903(dev)
+        assert hp.init()
+        hp.reference(0, 0, 1000.0, 0.5, FILTERS)
+        plan = SweepPlan.log(20.0, 20000.0, 2, 0.5)
+        results = list(hp.sweep(0, 0, FILTERS, plan))
+    finally:
+        dev.close()
+
+    assert len(results) == len(plan)
+    for i, x, m in results:
+        assert 0.0 < m.value < 0.01
@@ -0,0 +1,132 @@
+import os
+import time
+
+import pytest
+
+from hp8903 import (HP8903, Measurement, SweepJournal, SweepWorker,
+                    TransitionCost, _sweep_parser, _sweep_points, _sweep_setup,
+                    read_journal, resume_setup)
+
+
+def _setup(*argv):
+    parser = _sweep_parser("test", "test")
+    argv = ["--controller", "emulator"] + list(argv)
+    return(_sweep_setup(parser, parser.parse_args(argv)))
+
+
+def _point(i, x):
+    return((i, x, Measurement(x, 0.5, 0.001, "+01000E-06\r\n", None,
+                              "FR%.4EHZT3" % x, time.time())))
+
+
+def _journal(tmp_path, setup, npoints, aborted):
+    fname = str(tmp_path / "sweep.journal")
+    journal = SweepJournal(fname, setup["measurements"], sweep = setup)
+    for i in range(npoints):
+        journal.append(*_point(i, setup["points"][i][0]))
+    journal.close(aborted = aborted)
+    return(fname)
+
+
+def test_finished_journal(tmp_path):
+    setup = _setup("--start", "20", "--stop", "2000", "--steps", "2")
+    fname = _journal(tmp_path, setup, len(setup["points"]), False)
+
+    assert os.path.exists(fname)
+    assert not os.path.exists(fname + ".partial")
+    header, points, state = read_journal(fname)
+    assert state == "finished"
+    assert len(points) == len(setup["points"])
+    with pytest.raises(ValueError):
+        resume_setup(fname)
+
+
+def test_aborted_journal_resumes(tmp_path):
+    setup = _setup("--start", "20", "--stop", "2000", "--steps", "2")
+    fname = _journal(tmp_path, setup, 2, True)
+
+    assert not os.path.exists(fname)
+    header, points, state = read_journal(fname + ".partial")
+    assert state == "aborted"
+
+    resumed, measured = resume_setup(fname)
+    assert [m[0] for m in measured] == [0, 1]
+    assert list(resumed["points"].index) == list(range(2, len(setup["points"])))
+
+
+def test_crashed_journal_resumes(tmp_path):
+    setup = _setup("--start", "20", "--stop", "2000", "--steps", "2")
+    fname = _journal(tmp_path, setup, 3, True)
+    # Cut off the aborted record and half of the last point
+    with open(fname + ".partial") as fid:
+        lines = fid.readlines()
+    with open(fname + ".partial", 'w') as fid:
+        fid.writelines(lines[:-2])
+        fid.write(lines[-2][:20])
+
+    header, points, state = read_journal(fname + ".partial")
+    assert state == "partial"
+    resumed, measured = resume_setup(fname)
+    assert len(measured) == 2
+
+
+def test_stopped_worker_aborts_journal(tmp_path, emulator):
+    setup = _setup("--start", "20", "--stop", "20000", "--steps", "10")
+    fname = str(tmp_path / "sweep.journal")
+    journal = SweepJournal(fname, setup["measurements"], sweep = setup)
+    hp = HP8903(emulator("galvant"))
+    worker = SweepWorker(hp, setup["meas"], setup["units"], setup["filters"],
+                         setup["ref_freq"], setup["ref_amp"], setup["points"],
+                         journal = journal)
+    worker.start()
+    assert worker.results.get(timeout = 10)[0] == "point"
+    worker.stop()
+    worker.join(10)
+
+    header, points, state = read_journal(fname + ".partial")
+    assert state == "aborted"
+    resumed, measured = resume_setup(fname)
+    assert len(measured) + len(resumed["points"]) == len(setup["points"])
+    assert len(resumed["points"]) > 0
+
+
+def test_resume_keeps_journal_until_rewritten(tmp_path):
+    setup = _setup("--start", "20", "--stop", "2000", "--steps", "2")
+    fname = _journal(tmp_path, setup, 2, True)
+    resumed, measured = resume_setup(fname)
+
+    # Logging the resumed sweep to the journal it came from
+    journal = SweepJournal(fname, resumed["measurements"], sweep = resumed,
+                           measured = measured)
+    for n in range(20):
+        # Old points are never missing from the file
+        header, points, state = read_journal(fname + ".partial")
+        assert [p["index"] for p in points][:2] == [0, 1]
+    journal.append(*_point(2, resumed["points"][0][0]))
+    journal.close(aborted = True)
+
+    assert not os.path.exists(fname + ".partial.tmp")
+    header, points, state = read_journal(fname + ".partial")
+    assert [p["index"] for p in points] == [0, 1, 2]
+    again, measured = resume_setup(fname)
+    assert len(measured) == 3
+    assert len(again["points"]) == len(setup["points"]) - 3
+
+
+def test_resume_keeps_reorder(tmp_path):
+    setup = _setup("--start", "20", "--stop", "20000", "--steps", "3",
+                   "--reorder", "--transition-costs", "band=1.0")
+    fname = _journal(tmp_path, setup, 2, True)
+
+    resumed, measured = resume_setup(fname)
+    assert resumed["reorder"] == {"band": 1.0}
+
+    class Dev():
+        generation = 0
+
+    # What is left is ordered again once connected
+    points = _sweep_points(resumed, HP8903(Dev()))
+    expected = resumed["points"].ordered(TransitionCost({"band": 1.0}),
+                                         start = (resumed["ref_freq"],
+                                                  resumed["ref_amp"]))
+    assert list(points.index) == list(expected.index)
@@ -0,0 +1,68 @@
+from hp8903 import (Averager, BusSweep, HP8903, LatencyRecorder,
+                    MeasurementCache, StabilityDetector, TIMING_MIN_SAMPLES,
+                    TimingModel)
+
+FILTERS = [False]*4
+FREQS = [100.0, 300.0, 1000.0, 3000.0, 10000.0, 20000.0]
+POINTS = [(f, f, 0.5) for f in FREQS]
+
+
+def check_points(latency, n):
+    """One record per point, in order, each phase counted once per point"""
+    assert [p["index"] for p in latency.points] == list(range(n))
+    stats = latency.summary()
+    for phase in ("encode", "write", "read", "decode", "total"):
+        assert stats[phase]["count"] == n
+
+
+def test_averaged_point_recorded_once(emulator):
+    hp = HP8903(emulator("ni"), averaging = Averager(target = 1e-6,
+                                                     max_reads = 3))
+    hp.record_latency(LatencyRecorder())
+    results = list(hp.sweep(0, 0, FILTERS, POINTS))
+    reads = [m.reads for i, x, m in results]
+    assert all(n > 1 for n in reads)
+
+    check_points(hp.latency, len(POINTS))
+    assert [p["readings"] for p in hp.latency.points] == reads
+    assert hp.latency.summary()["reading"]["count"] == sum(reads)
+
+
+def test_settled_point_recorded_once(emulator, tmp_path):
+    dev = emulator("galvant", settle = "20:200,20000:200")
+    timing = TimingModel("test", path = str(tmp_path / "timing.json"))
+    hp = HP8903(dev, timing = timing, stability = StabilityDetector())
+    for f in FREQS:
+        code = hp._codes(0, 0, f, 0.5, FILTERS, 0)[2][1]
+        for i in range(TIMING_MIN_SAMPLES):
+            timing.record(code, f, 0.5)
+
+    hp.record_latency(LatencyRecorder())
+    results = list(hp.sweep(0, 0, FILTERS, POINTS))
+    assert len(results) == len(POINTS)
+
+    check_points(hp.latency, len(POINTS))
+    # Polled until settled, several readings per point
+    assert all(p["readings"] > 1 for p in hp.latency.points)
+
+
+def test_cached_point_not_recorded(emulator):
+    hp = HP8903(emulator("galvant"), cache = MeasurementCache())
+    hp.record_latency(LatencyRecorder())
+    list(hp.sweep(0, 0, FILTERS, POINTS[:2]))
+    results = list(hp.sweep(0, 0, FILTERS, POINTS[:2]))
+    assert all(m.cached for i, x, m in results)
+
+    check_points(hp.latency, 2)
+
+
+def test_bus_points_indexed(emulator):
+    hp = HP8903(emulator("galvant"))
+    hp.record_latency(LatencyRecorder())
+    bus = BusSweep()
+    bus.add(hp, 0, 0, FILTERS, 1000.0, 0.5, POINTS[:3])
+    results = list(bus.run())
+    assert len(results) == 3
+
+    # The reference reading is timed too, without an index
+    assert [p["index"] for p in hp.latency.points] == [None, 0, 1, 2]
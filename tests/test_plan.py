@@ -0,0 +1,165 @@
+import numpy as np
+
+from hp8903 import (HP8903, Measurement, SweepPlan, TimingModel,
+                    TransitionCost, _sweep_parser, _sweep_points, _sweep_setup,
+                    plan_order)
+
+
+def _two_level_plan():
+    return(SweepPlan.log(20.0, 20000.0, 4, 0.5) +
+           SweepPlan.log(20.0, 20000.0, 4, 0.05))
+
+
+def test_ordered_keeps_points():
+    plan = _two_level_plan()
+    ordered = plan.ordered()
+
+    assert sorted(ordered.index) == list(range(len(plan)))
+    for i in range(len(ordered)):
+        assert ordered.freq[i] == plan.freq[ordered.index[i]]
+        assert ordered.amp[i] == plan.amp[ordered.index[i]]
+
+    results = [(int(ordered.index[i]), ordered.x[i], None)
+               for i in range(len(ordered))]
+    assert [r[0] for r in plan_order(results)] == list(range(len(plan)))
+
+
+def test_ordered_fewer_transitions():
+    plan = _two_level_plan()
+    cost = TransitionCost()
+    # Alternating between the two levels
+    half = len(plan)//2
+    interleaved = np.ravel(np.column_stack((np.arange(half),
+                                            np.arange(half, len(plan)))))
+
+    assert (cost.cost(plan, cost.order(plan)) <
+            cost.cost(plan, interleaved))
+    assert cost.cost(plan, cost.order(plan)) <= cost.cost(plan)
+
+
+def test_ordered_starts_nearest():
+    # Level groups are walked as a snake, both ends are at 20 Hz
+    plan = _two_level_plan()
+    assert plan.ordered(start = (1000.0, 0.05)).amp[0] == 0.05
+    assert plan.ordered(start = (1000.0, 0.5)).amp[0] == 0.5
+
+
+def test_fit_transition_costs():
+    plan = _two_level_plan()
+    states = TransitionCost().states(plan)
+    rng = np.random.RandomState(0)
+    order = np.r_[np.arange(len(plan))[::2], np.arange(len(plan))[1::2]]
+
+    t = 0.0
+    results = []
+    for n, k in enumerate(order):
+        if (n > 0):
+            changed = states[k] != states[order[n - 1]]
+            t += 0.1 + 0.4*changed[1] + 0.25*changed[2] + rng.normal(0.0, 0.01)
+        results.append((int(plan.index[k]), plan.x[k],
+                        Measurement(plan.freq[k], plan.amp[k], 1.0, "", None,
+                                    "", t)))
+
+    model = TransitionCost.fit(plan, results, weights = {"filters": 0.7})
+    assert abs(model.weights["range"] - 0.4) < 0.05
+    assert abs(model.weights["band"] - 0.25) < 0.05
+    # Never changed, kept
+    assert model.weights["filters"] == 0.7
+    assert sorted(model.fitted) == ["band", "range"]
+
+    assert TransitionCost.fit(plan, results[:3]) is None
+
+
+def test_sweep_points_reordered_from_reference(tmp_path):
+    parser = _sweep_parser("test", "test")
+    args = parser.parse_args(["--controller", "emulator", "--freq", "20000",
+                              "--start", "20", "--stop", "20000",
+                              "--steps", "3", "--reorder",
+                              "--transition-costs", "band=2"])
+    setup = _sweep_setup(parser, args)
+    assert setup["reorder"] == {"band": 2.0}
+
+    class Dev():
+        generation = 0
+
+    hp = HP8903(Dev(), timing = TimingModel("test", path = str(tmp_path / "t.json"),
+                                            transitions = {"band": 0.0,
+                                                           "range": 1.0}))
+    assert hp.transition_cost(setup["reorder"]).weights["band"] == 2.0
+    assert hp.transition_cost(setup["reorder"]).weights["range"] == 1.0
+
+    # Bands cost most, walked from the reference's end
+    points = _sweep_points(setup, hp)
+    assert points.freq[0] == 20000.0
+    assert points.freq[-1] == 20.0
+    assert sorted(points.index) == list(range(len(setup["points"])))
+
+
+def test_learned_transitions_saved(tmp_path):
+    path = str(tmp_path / "timing.json")
+    timing = TimingModel("test", path = path)
+    timing.record("M3", 1000.0, 0.1)
+    timing.transitions = {"range": 0.25}
+    timing.save()
+
+    loaded = TimingModel.load("test", path = path)
+    assert loaded.transitions == {"range": 0.25}
+    assert list(loaded.bins) == list(timing.bins)
+
+
+def test_log_plan():
+    plan = SweepPlan.log(20.0, 20000.0, 10, 0.5)
+    assert len(plan) == 31
+    assert plan.freq[0] == 20.0
+    assert abs(plan.freq[-1] - 20000.0) < 1e-6
+    assert np.all(np.diff(np.log10(plan.freq)) > 0.099)
+    assert np.all(plan.amp == 0.5)
+    assert plan.native() == (20.0, 10, 31)
+
+
+def test_clamp_limits_and_merges():
+    plan = SweepPlan.freqs([10.0, 15.0, 1000.0, 1000.000001, 200000.0], 0.5)
+    assert plan.native() is None
+
+    clamped = plan.clamp()
+    # 10 and 15 Hz both end up at the lowest source frequency
+    assert clamped.freq.tolist() == [20.0, 1000.0, 100000.0]
+    assert clamped.x.tolist() == clamped.freq.tolist()
+
+
+def test_clamp_stops_native():
+    plan = SweepPlan.log(10.0, 1000.0, 5, 0.5)
+    assert plan.native() is not None
+    assert plan.clamp().native() is None
+
+
+def test_levels_plan():
+    plan = SweepPlan.levels(0.1, 1.0, 10, 1000.0)
+    assert np.allclose(plan.x, plan.amp)
+    assert np.all(plan.freq == 1000.0)
+    assert plan.native() is None
+
+
+def test_remaining_keeps_index():
+    plan = SweepPlan.log(20.0, 20000.0, 3, 0.5).ordered()
+    done = [int(i) for i in plan.index[:4]]
+    rest = plan.remaining(done)
+
+    assert len(rest) == len(plan) - 4
+    assert sorted(rest.index.tolist() + done) == list(range(len(plan)))
+    for i, point in enumerate(rest):
+        assert point.freq == plan.freq[list(plan.index).index(rest.index[i])]
+
+
+def test_dict_round_trip():
+    plan = SweepPlan.log(20.0, 20000.0, 3, 0.5)
+    plan.set(lambda f: f > 10000.0, filters = [True, False, False, False])
+    plan = plan.ordered()
+
+    again = SweepPlan.from_dict(plan.to_dict())
+    assert again.x.tolist() == plan.x.tolist()
+    assert again.freq.tolist() == plan.freq.tolist()
+    assert again.amp.tolist() == plan.amp.tolist()
+    assert again.index.tolist() == plan.index.tolist()
+    assert again.settings == plan.settings
+    assert again.per_decade == plan.per_decade
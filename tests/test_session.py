@@ -0,0 +1,51 @@
+import numpy as np
+
+from hp8903 import (HP8903, HP8903_Emulator, NI_GPIB_232CV_A,
+                    RecordingDevice, ReplayDevice, SweepPlan, load_timing,
+                    read_session)
+
+FILTERS = [False]*4
+
+
+def _sweep(hp):
+    hp.reference(0, 0, 1000.0, 0.5, FILTERS)
+    plan = SweepPlan.log(20.0, 20000.0, 2, 0.5)
+    return([m for i, x, m in hp.sweep(0, 0, FILTERS, plan)])
+
+
+def test_record_and_replay(tmp_path, emulator, controller):
+    fname = str(tmp_path / "session.gz")
+    dev = RecordingDevice(emulator(controller), fname)
+    recorded = _sweep(HP8903(dev))
+    dev.close()
+
+    for m in recorded:
+        assert not np.isnan(m.value)
+        if (controller == "ni"):
+            # Recording doesn't change the controller's framing
+            assert m.raw.endswith("\r\n")
+            assert not m.raw.startswith("\n")
+
+    events = read_session(fname)
+    assert events[0]["op"] == "session"
+    reads = [e for e in events if (e["op"] == "read")]
+    assert [e["data"] for e in reads[1:]] == [m.raw for m in recorded]
+
+    replay = ReplayDevice()
+    assert replay.open(fname)
+    replayed = _sweep(HP8903(replay))
+    assert replay.mismatches == 0
+    assert [m.value for m in replayed] == [m.value for m in recorded]
+    assert [m.payload for m in replayed] == [m.payload for m in recorded]
+
+
+def test_simulated_timing_not_saved(tmp_path):
+    session = str(tmp_path / "sweep.session")
+    for dev in (HP8903_Emulator(), ReplayDevice(),
+                RecordingDevice(HP8903_Emulator(), session)):
+        timing = load_timing(dev, "port", 0)
+        assert timing.path is None
+        timing.record("M1", 1000.0, 0.1)
+        assert timing.save()
+
+    assert load_timing(NI_GPIB_232CV_A(), "port", 0).path is not None
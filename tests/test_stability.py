@@ -0,0 +1,43 @@
+from hp8903 import (HP8903, LatencyRecorder, StabilityDetector,
+                    TimingModel)
+
+FILTERS = [False]*4
+POINTS = [(f, f, 0.5) for f in (20.0, 1000.0, 20000.0)]
+
+
+def test_settled_needs_a_full_window():
+    det = StabilityDetector(tolerance = 0.01, span = 0.25, polls = 16)
+    assert det.window == 5
+    assert not det.settled([1.0]*4, False)
+    assert det.settled([1.0]*5, False)
+
+
+def test_settled_window():
+    det = StabilityDetector(tolerance = 0.01, span = 0.25, polls = 16)
+    # Still rising within the window
+    assert not det.settled([0.5, 0.8, 0.95, 0.98, 0.99, 1.0], False)
+    # Earlier readings outside the window don't count
+    assert det.settled([0.5, 0.8, 0.995, 1.0, 0.999, 1.001, 1.0], False)
+
+
+def test_settled_log_units():
+    det = StabilityDetector(tolerance = 0.01, span = 0.25, polls = 16)
+    assert det.settled([-60.0, -60.05, -59.95, -60.0, -60.02], True)
+    assert not det.settled([-60.0, -60.5, -59.95, -60.0, -60.02], True)
+
+
+def test_polls_without_timing_model(emulator):
+    hp = HP8903(emulator("galvant"), stability = StabilityDetector())
+    hp.record_latency(LatencyRecorder())
+    results = list(hp.sweep(0, 0, FILTERS, POINTS))
+    assert len(results) == len(POINTS)
+    assert all(p["readings"] > 1 for p in hp.latency.points)
+
+
+def test_settle_time_learned(emulator, tmp_path):
+    timing = TimingModel("test", path = str(tmp_path / "timing.json"))
+    hp = HP8903(emulator("galvant"), timing = timing,
+                stability = StabilityDetector())
+    list(hp.sweep(0, 0, FILTERS, POINTS))
+    code = hp._codes(0, 0, 1000.0, 0.5, FILTERS, 0)[2][1]
+    assert timing.bins[timing._bin(code + "T2", 1000.0)]
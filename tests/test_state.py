@@ -0,0 +1,53 @@
+from hp8903 import HP8903
+
+FILTERS = [False]*4
+
+
+class Dev():
+    generation = 0
+
+
+def _payload(hp, meas = 0, unit = 0, freq = 1000.0, amp = 0.5,
+             filters = FILTERS, ratio = 0):
+    return(hp._delta(hp._codes(meas, unit, freq, amp, filters, ratio)))
+
+
+def test_only_changes_sent():
+    hp = HP8903(Dev())
+    assert _payload(hp) == "FR1.0000E+03HZAP5.0000E-01VLM3L0H0LN"
+    assert _payload(hp) == ""
+    assert _payload(hp, freq = 2000.0) == "FR2.0000E+03HZ"
+    assert (_payload(hp, freq = 2000.0, filters = [True, False, False, True])
+            == "L1H2")
+
+
+def test_reference_always_sent():
+    hp = HP8903(Dev())
+    _payload(hp)
+    assert _payload(hp, ratio = 1) == "R1"
+    assert _payload(hp, ratio = 1) == "R1"
+    assert _payload(hp, ratio = 2) == "R0"
+    assert _payload(hp, ratio = 2) == ""
+
+
+def test_measurement_change_resends_units_and_ratio():
+    hp = HP8903(Dev())
+    _payload(hp, ratio = 2)
+    # Changing the measurement may reset the HP 8903's units and ratio
+    assert _payload(hp, meas = 1, ratio = 2) == "M1LNR0"
+
+
+def test_reconnect_forgets_state():
+    dev = Dev()
+    hp = HP8903(dev)
+    full = _payload(hp)
+    dev.generation += 1
+    assert _payload(hp) == full
+
+
+def test_failed_reading_forgets_state():
+    hp = HP8903(Dev())
+    full = _payload(hp)
+    m = hp._decode(1000.0, 0.5, False, None, full)
+    assert m.value != m.value
+    assert _payload(hp) == full
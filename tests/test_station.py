@@ -0,0 +1,21 @@
+import json
+
+from hp8903 import read_journal, station_main
+
+
+def test_failed_connect_releases_instruments(tmp_path):
+    journal = str(tmp_path / "left.journal")
+    config = {"sweep": {"freqs": "1000,2000"},
+              "instruments": [{"name": "left", "controller": "emulator",
+                               "journal": journal},
+                              {"name": "right", "controller": "replay",
+                               "port": str(tmp_path / "missing")}]}
+    fname = str(tmp_path / "station.json")
+    with open(fname, 'w') as fid:
+        json.dump(config, fid)
+
+    assert station_main([fname]) == 1
+    # The journal already started is finished off as aborted
+    header, points, state = read_journal(journal + ".partial")
+    assert state == "aborted"
+    assert points == []
@@ -0,0 +1,100 @@
+import numpy as np
+import pytest
+
+from hp8903 import (HP8903, HP8903_MAX_LOST, LatencyRecorder,
+                    RecordingDevice, ReplayDevice, SweepPlan,
+                    TIMING_DEFAULT_MS, TimingModel, plan_order, run_sweep)
+
+FILTERS = [False]*4
+
+
+def test_ordered_sweep(emulator, controller):
+    hp = HP8903(emulator(controller))
+    plan = (SweepPlan.log(20.0, 20000.0, 2, 0.5) +
+            SweepPlan.log(20.0, 20000.0, 2, 0.05))
+    ordered = plan.ordered(start = (1000.0, 0.5))
+    results = list(run_sweep(hp, 0, 0, FILTERS, 1000.0, 0.5, ordered))
+
+    assert len(results) == len(plan)
+    results = plan_order(results)
+    assert [i for i, x, m in results] == list(range(len(plan)))
+    for i, x, m in results:
+        assert m.freq == plan.freq[i]
+        assert m.amp == plan.amp[i]
+        assert 0.0 < m.value < 0.1
+
+
+def test_ratio_sweep(emulator, controller):
+    hp = HP8903(emulator(controller))
+    plan = SweepPlan.freqs([1000.0, 3000.0], 0.5)
+    results = list(run_sweep(hp, 2, 0, FILTERS, 1000.0, 0.5, plan))
+
+    # Relative to the reference taken at 1 kHz (%)
+    assert abs(results[0][2].value - 100.0) < 5.0
+    assert "R1" not in results[0][2].payload
+
+
+def test_native_sweep(emulator, controller):
+    hp = HP8903(emulator(controller))
+    plan = SweepPlan.log(20.0, 20000.0, 3, 0.5)
+    results = list(run_sweep(hp, 0, 0, FILTERS, 1000.0, 0.5, plan,
+                             native = plan.native()))
+
+    assert [i for i, x, m in results] == list(range(len(plan)))
+    assert np.allclose([x for i, x, m in results], plan.freq, rtol = 1e-4)
+    for i, x, m in results:
+        assert 0.0 < m.value < 0.1
+
+
+def test_native_sweep_latency(emulator):
+    hp = HP8903(emulator("galvant"))
+    hp.record_latency(LatencyRecorder())
+    plan = SweepPlan.log(20.0, 20000.0, 2, 0.5)
+    results = list(hp.native_sweep(0, 0, FILTERS, 0.5, *plan.native()))
+
+    points = hp.latency.points
+    assert [p["index"] for p in points] == [i for i, x, m in results]
+    assert all(p["readings"] == 1 for p in points)
+    stats = hp.latency.summary()
+    for phase in ("read", "decode", "total"):
+        assert stats[phase]["count"] == len(plan)
+    # The sweep command goes out with the first point
+    assert stats["write"]["count"] == 1
+
+
+def test_native_sweep_lost(emulator, tmp_path):
+    fname = str(tmp_path / "session.gz")
+    dev = RecordingDevice(emulator("galvant"), fname)
+    plan = SweepPlan.log(20.0, 20000.0, 2, 0.5)
+    hp = HP8903(dev)
+    assert len(list(hp.native_sweep(0, 0, FILTERS, 0.5, 20.0, 2, 2))) == 2
+    dev.close()
+
+    # The instrument goes quiet once the recording runs out
+    replay = ReplayDevice()
+    assert replay.open(fname)
+    hp = HP8903(replay)
+    hp.init()
+    hp.record_latency(LatencyRecorder())
+    results = []
+    with pytest.raises(IOError):
+        for pt in hp.native_sweep(0, 0, FILTERS, 0.5, *plan.native()):
+            results.append(pt)
+    # The failed instrument sweep reading counts as lost too
+    lost = [m for i, x, m in results if np.isnan(m.value)]
+    assert len(lost) == HP8903_MAX_LOST - 1
+    # Points measured by hand keep their place in the sweep
+    assert [i for i, x, m in results] == list(range(len(results)))
+    assert ([p["index"] for p in hp.latency.points] ==
+            [i for i, x, m in results])
+
+
+def test_slow_band_learned(emulator, tmp_path):
+    # T3 at 20 Hz takes longer than the default read deadline
+    timing = TimingModel("test", path = str(tmp_path / "timing.json"))
+    hp = HP8903(emulator("galvant", settle = "20:2000"), timing = timing)
+    m = hp.send_measurement(0, 0, 20.0, 0.5, FILTERS)
+
+    assert not np.isnan(m.value)
+    code = hp._codes(0, 0, 20.0, 0.5, FILTERS, 0)[2][1]
+    assert min(timing.bins[timing._bin(code, 20.0)]) > TIMING_DEFAULT_MS/1000.0
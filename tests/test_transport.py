@@ -0,0 +1,38 @@
+import os
+import time
+import fcntl
+import struct
+import termios
+
+from hp8903 import NI_GPIB_232CV_A
+
+
+class PipeSerial():
+    """Read end of a pipe whose writer has gone, like a hung up port"""
+    def __init__(self):
+        self.fd, w = os.pipe()
+        os.close(w)
+
+    def fileno(self):
+        return(self.fd)
+
+    def inWaiting(self):
+        n = fcntl.ioctl(self.fd, termios.FIONREAD, struct.pack('i', 0))
+        return(struct.unpack('i', n)[0])
+
+    def read(self, n):
+        return(os.read(self.fd, n))
+
+    def close(self):
+        os.close(self.fd)
+
+
+def test_read_hung_up_port_fails_at_once():
+    dev = NI_GPIB_232CV_A()
+    dev.ser = PipeSerial()
+    try:
+        start = time.time()
+        assert dev._buffered_read(0, 2000, '\n') == (False, None)
+        assert (time.time() - start) < 0.5
+    finally:
+        dev.ser.close()